@@ -30,7 +30,7 @@ class AddCardWidget( QWidget ) :
         uic.loadUi( os.path.join(globals.base_dir,"ui/add_card_widget.ui") , self )
         self.lb_cards.setSortingEnabled( True )
         # load the widget
-        sorted_nats = sorted( globals.cards.keys() , key=lambda n: n.lower() )
+        sorted_nats = sorted( db.get_nationalities() , key=lambda n: n.lower() )
         for nat in sorted_nats :
             fname = natinfo.get_flag( nat )
             if fname :
@@ -63,18 +63,10 @@ class AddCardWidget( QWidget ) :
             card_type = db.TAGTYPE_ORDNANCE
         else :
             return
-        cards = globals.cards[ self.cbo_nationality.currentText() ]
-        cards = cards.get( card_type )
-        if cards is None :
-            return
-        # prepare for filtering
-        def filter_val( str ) :
-            return str.replace(" ","").lower()
-        filter_text = filter_val( self.le_filter.text() )
+        filter_text = self.le_filter.text().replace( " " , "" )
+        cards = db.find_cards( self.cbo_nationality.currentText() , card_type , filter_text )
         # reload the available cards
         for card in cards :
-            if filter_text and filter_val(card.name).find( filter_text ) < 0 :
-                continue
             item = QListWidgetItem( card.name )
             item.setData( Qt.UserRole , card )
             self.lb_cards.addItem( item )
@@ -100,11 +92,11 @@ class AddCardWidget( QWidget ) :
     def on_nationality_changed( self , val ) :
         """Update the widget when the active nationality is changed."""
         # reload the available cards for the selected nationality
-        cards = globals.cards[ val ]
+        tag_types = db.get_tag_types( val )
         self.lb_cards.clear()
         # update the vehicle/ordnance radio boxes
-        self.rb_vehicles.setEnabled( db.TAGTYPE_VEHICLE in cards )
-        self.rb_ordnance.setEnabled( db.TAGTYPE_ORDNANCE in cards )
+        self.rb_vehicles.setEnabled( db.TAGTYPE_VEHICLE in tag_types )
+        self.rb_ordnance.setEnabled( db.TAGTYPE_ORDNANCE in tag_types )
         if self.rb_vehicles.isChecked() :
             if not self.rb_vehicles.isEnabled() :
                 self.rb_ordnance.setChecked( True )
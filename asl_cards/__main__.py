@@ -6,8 +6,10 @@ import os
 import getopt
 
 sys.path.append( ".." ) # fudge! need this to allow a script to run within a package :-/
-from asl_cards.parse import PdfParser
+from asl_cards.parse import PdfParser , find_pdf_files , benchmark_renderers , CARD_HEADER_REGIONS
 from asl_cards import db
+from asl_cards import imaging
+from asl_cards import render
 
 # ---------------------------------------------------------------------
 
@@ -15,13 +17,26 @@ def main( args ) :
 
     # parse the arguments
     db_fname = None
+    index_dir = None
+    layout_cache_dir = None
     parse_targets = []
     max_pages = -1
+    image_res = 300
     extract_images = True
+    lazy_images = False
+    image_encoding = imaging.DEFAULT_ENCODING
+    render_backend = None
+    render_profile = render.DEFAULT_PROFILE
+    header_regions = False
+    use_image_pack = False
+    update = False
+    remove_fnames = []
+    workers = 1
     log_progress = False
     dump = False
+    benchmark = False
     try :
-        opts , args = getopt.getopt( args , "f:d:ph?" , ["db=","file=","dir=","maxpages=","noimages","progress","dump","help"] )
+        opts , args = getopt.getopt( args , "f:d:i:ph?" , ["db=","file=","dir=","index=","cachedir=","maxpages=","res=","encoding=","renderer=","profile=","regions","imagepack","update","remove=","noimages","lazy","workers=","progress","dump","benchmark","help"] )
     except getopt.GetoptError as err :
         raise RuntimeError( "Can't parse arguments: {}".format( err ) )
     for opt,val in opts :
@@ -31,12 +46,44 @@ def main( args ) :
             parse_targets.append( val )
         elif opt in ["-d","--dir"] :
             parse_targets.append( val )
+        elif opt in ["-i","--index"] :
+            index_dir = val
+        elif opt in ["--cachedir"] :
+            layout_cache_dir = val
         elif opt in ["--maxpages"] :
             max_pages = int( val )
+        elif opt in ["--res"] :
+            image_res = int( val )
+        elif opt in ["--encoding"] :
+            if val not in [ e[0] for e in imaging.get_encodings() ] :
+                raise RuntimeError( "Unknown image encoding: {}".format( val ) )
+            image_encoding = val
+        elif opt in ["--renderer"] :
+            if val not in [ b[0] for b in render.get_backends() ] :
+                raise RuntimeError( "Unknown or unavailable renderer: {}".format( val ) )
+            render_backend = val
+        elif opt in ["--profile"] :
+            if val not in [ p[0] for p in render.get_profiles() ] :
+                raise RuntimeError( "Unknown render profile: {}".format( val ) )
+            render_profile = val
+        elif opt in ["--regions"] :
+            header_regions = True
+        elif opt in ["--imagepack"] :
+            use_image_pack = True
+        elif opt in ["--update"] :
+            update = True
+        elif opt in ["--remove"] :
+            remove_fnames.append( val )
         elif opt in ["--noimages"] :
             extract_images = False
+        elif opt in ["--lazy"] :
+            lazy_images = True
+        elif opt in ["--workers"] :
+            workers = int( val )
         elif opt in ["-d","--dump"] :
             dump = True
+        elif opt in ["--benchmark"] :
+            benchmark = True
         elif opt in ["-p","--progress"] :
             log_progress = True
         elif opt in ["-h","--help","-?"] :
@@ -44,18 +91,73 @@ def main( args ) :
             sys.exit( 0 )
         else :
             raise RuntimeError( "Unknown argument: {}".format( opt ) )
+
+    # check if we're benchmarking the renderers
+    if benchmark :
+        if not parse_targets : raise RuntimeError( "No files were specified." )
+        fnames = [ f for pt in parse_targets for f in find_pdf_files( pt ) ]
+        results = benchmark_renderers( fnames , image_res ,
+            max_pages = max_pages ,
+            backends = [ render_backend ] if render_backend else None ,
+            profile = render_profile
+        )
+        for backend,npages,elapsed_time,error in results :
+            print( "{}: {} pages in {:.1f}s ({:.2f} pages/sec){}".format(
+                backend , npages , elapsed_time , npages/elapsed_time if elapsed_time > 0 else 0 ,
+                " - ERROR: {}".format( error ) if error else ""
+            ) )
+        return
     if not db_fname : raise RuntimeError( "No database was specified." )
 
     # do the requested processing
-    pdf_parser = PdfParser( progress_callback if log_progress else None )
-    if parse_targets :
-        cards = []
+    file_cards = [] # nb: the cards for the file currently being parsed (if we're updating the database)
+    pdf_parser = PdfParser( index_dir ,
+        progress = progress_callback if log_progress else None ,
+        on_file_completed = ( lambda fname,_: update_source_file( fname , file_cards ) ) if update else lambda fname,cards: db.complete_source_file( fname ) ,
+        layout_cache_dir = layout_cache_dir ,
+        render_backend = render_backend ,
+        render_profile = render_profile ,
+        layout_regions = CARD_HEADER_REGIONS if header_regions else None
+    )
+    if update or remove_fnames :
+        # NOTE: We update the cards for each file separately, leaving the rest of the database alone.
+        db.open_database( db_fname , False )
+        if not db.has_build_cache() :
+            raise RuntimeError( "The database was built by an older version, and needs to be rebuilt." )
+        for fname in remove_fnames :
+            ncards = db.remove_source_file( os.path.abspath( fname ) )
+            print( "Removed {} cards: {}".format( ncards , fname ) , file=sys.stderr )
         for pt in parse_targets :
-            cards.extend (
-                pdf_parser.parse( pt , max_pages=max_pages , images=extract_images )
+            # NOTE: We only hold on to the cards for one file at a time, and save them as soon as
+            # the file has been parsed (see update_source_file()).
+            cards = pdf_parser.iter_cards( pt ,
+                max_pages = max_pages ,
+                image_res = image_res if extract_images else None ,
+                workers = workers ,
+                lazy_images = lazy_images ,
+                image_encoding = image_encoding
             )
-        db.open_database( db_fname , True )
-        db.add_cards( cards )
+            for card in cards :
+                if file_cards and card.source_file is not file_cards[0].source_file :
+                    file_cards.clear() # nb: the previous file failed part-way through, so we ignore its cards
+                file_cards.append( card )
+    elif parse_targets :
+        # NOTE: We save each card as soon as it has been extracted, so that we don't have to hold
+        # all the card images in memory.
+        db.open_database( db_fname , True , use_image_pack=use_image_pack )
+        with db.build_mode() :
+            for pt in parse_targets :
+                cards = pdf_parser.iter_cards( pt ,
+                    max_pages = max_pages ,
+                    image_res = image_res if extract_images else None ,
+                    workers = workers ,
+                    lazy_images = lazy_images ,
+                    image_encoding = image_encoding
+                )
+                for card in cards :
+                    db.add_card( card )
+                if pdf_parser.encoding_report :
+                    print( pdf_parser.encoding_report.format( image_encoding ) , file=sys.stderr )
     elif dump :
         db.open_database( db_fname , False )
         db.dump_database()
@@ -64,6 +166,17 @@ def main( args ) :
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+def update_source_file( fname , cards ) :
+    """Replace the cards for a file that has been parsed (the list of cards is cleared, ready for the next file)."""
+    if cards :
+        ncards = db.replace_source_file( cards[0].source_file , cards )
+        print( "Updated {} cards: {}".format( ncards , fname ) , file=sys.stderr )
+    else :
+        # nb: the file doesn't have any cards any more, so we remove the ones we had for it
+        ncards = db.remove_source_file( os.path.abspath( fname ) )
+        print( "Removed {} cards: {}".format( ncards , fname ) , file=sys.stderr )
+    cards.clear()
+
 def progress_callback( progress , msg ) :
     if progress is not None :
         print( "{:3}% | {}".format(int(100*progress),msg) , file=sys.stderr , flush=True )
@@ -78,9 +191,22 @@ def print_help() :
     print( "      --db         Database file." )
     print( "  -f  --file       PDF file to parse." )
     print( "  -d  --dir        Directory with PDF's to parse." )
+    print( "  -i  --index      Directory with the index files." )
+    print( "      --cachedir   Directory to cache the results of parsing PDF pages in." )
     print( "      --maxpages   Maximum number of pages to pages." )
+    print( "      --res        Resolution of the extracted card images (dpi)." )
+    print( "      --encoding   How to store the card images: {}".format( " , ".join( e[0] for e in imaging.get_encodings() ) ) )
+    print( "      --renderer   How to render the PDF pages: {}".format( " , ".join( b[0] for b in render.get_backends() ) ) )
+    print( "      --profile    Render quality/speed trade-off: {} (default: {})".format( " , ".join( p[0] for p in render.get_profiles() ) , render.DEFAULT_PROFILE ) )
+    print( "      --regions    Only analyze the layout of the card info boxes (faster, but cards outside them are lost)." )
+    print( "      --imagepack  Store the card images in a pack file (next to the database)." )
+    print( "      --update     Update the cards for the specified files in an existing database." )
+    print( "      --remove     Remove the cards for a file from an existing database." )
     print( "      --noimages   Don't extract card images." )
+    print( "      --lazy       Don't extract card images now (they will be extracted when first viewed)." )
+    print( "      --workers    Number of worker processes to analyze files with." )
     print( "      --dump       Dump the database." )
+    print( "      --benchmark  Time how long each renderer takes to render the PDF's." )
     print( "      --progress   Log progress during lengthy operations." )
     print()
 
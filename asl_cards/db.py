@@ -1,8 +1,17 @@
 import sys
 import os
+import hashlib
+import re
+import weakref
+import pathlib
+import sqlite3
 from collections import defaultdict
-from sqlalchemy import sql , orm , create_engine
-from sqlalchemy import Column , ForeignKey , String , Integer , Binary
+from contextlib import contextmanager
+from sqlalchemy import sql , orm , create_engine , inspect , event , or_
+from sqlalchemy import Column , ForeignKey , String , Integer , Boolean , Binary , Index
+from sqlalchemy.pool import QueuePool
+
+from asl_cards.image_pack import ImagePack , get_pack_fname , is_pack_file
 
 # ---------------------------------------------------------------------
 
@@ -10,8 +19,34 @@ from sqlalchemy import Column , ForeignKey , String , Integer , Binary
 TAGTYPE_VEHICLE = "vehicle"
 TAGTYPE_ORDNANCE = "ordnance"
 
+# NOTE: Most of the program works with a single database, so we keep a handle to it here (see open_database()).
+_database = None
 db_engine = None
-db_session = None
+db_session = None # nb: this is a proxy for the current thread's session (see Database.session)
+image_pack = None # nb: this will be None if card images are stored in the database (see image_pack.py)
+
+# NOTE: Background readers get their connections from a pool of read-only connections, this big.
+_READ_POOL_SIZE = 4
+
+# NOTE: When cards are streamed into the database, we commit after this many new objects (each card has
+# several: the card itself, its image, and its pre-scaled images).
+_STREAM_BATCH_SIZE = 100
+
+# NOTE: New cards are written out with bulk inserts, this many at a time.
+_BULK_INSERT_SIZE = 32
+
+# NOTE: When card images are loaded in bulk, we fetch this many at a time.
+_FETCH_BATCH_SIZE = 50
+
+# NOTE: Card images are large, so new databases use a bigger page size than SQLite's default.
+_PAGE_SIZE = 16384
+
+# NOTE: While a new database is being built, we relax SQLite's safety settings, and restore them afterwards
+# (see build_mode()). A database whose build was interrupted is kept, so that the build can be resumed, so we
+# use WAL mode, which is much faster, but still leaves the database intact if we crash (we might just lose
+# the last few transactions).
+_BUILD_PRAGMAS = [ ( "journal_mode" , "WAL" ) , ( "synchronous" , "NORMAL" ) , ( "cache_size" , -64*1024 ) ]
+_SAFE_PRAGMAS = [ ( "journal_mode" , "DELETE" ) , ( "synchronous" , "FULL" ) , ( "cache_size" , -2000 ) ]
 
 # ---------------------------------------------------------------------
 
@@ -33,6 +68,31 @@ class DbBaseMixin :
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+class AslSourceFile( DbBase , DbBaseMixin ) :
+    """Models a PDF file that ASL cards were extracted from."""
+    __tablename__ = "source_file"
+    source_id = Column( Integer , primary_key=True , autoincrement=True )
+    fname = Column( String(1000) , unique=True )
+    content_hash = Column( String(40) )
+    index_hash = Column( String(40) ) # nb: this will be NULL if there was no index file
+    image_res = Column( Integer ) # nb: this will be NULL if card images were not extracted
+    images_extracted = Column( Boolean ) # nb: this will be False if the card images are to be extracted later
+    image_encoding = Column( String(20) ) # nb: see imaging.get_encodings()
+    render_backend = Column( String(20) ) # nb: see render.get_backends()
+    render_profile = Column( String(20) ) # nb: see render.get_profiles()
+    is_complete = Column( Boolean ) # nb: this will be False until all the cards for the file have been saved
+    cards = orm.relationship( "AslCard" , backref="source_file" , cascade="all,delete" , passive_deletes=True )
+
+    def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
+    def __str__( self ) : return self._to_string(AslSourceFile)
+
+    def matches( self , other ) :
+        """Check if the cards for another source file would be the same as ours."""
+        return self.content_hash == other.content_hash and self.index_hash == other.index_hash \
+            and self.image_res == other.image_res and self.images_extracted == other.images_extracted \
+            and self.image_encoding == other.image_encoding \
+            and self.render_backend == other.render_backend and self.render_profile == other.render_profile
+
 class AslCard( DbBase , DbBaseMixin ) :
     """Models an ASL card."""
     __tablename__ = "card"
@@ -42,88 +102,859 @@ class AslCard( DbBase , DbBaseMixin ) :
     name = Column( String(40) )
     page_id = Column( Integer )
     page_pos = Column( Integer )
-    card_image = orm.relationship( "AslCardImage" , uselist=False , backref="parent_card" , cascade="all,delete" )
+    tag_type = Column( String(20) ) # nb: TAGTYPE_xxx (see classify_card_tag())
+    card_no = Column( Integer ) # nb: this will be NULL if the card tag doesn't have a number
+    search_name = Column( String(40) ) # nb: the name, normalized for searching (see _get_search_name())
+    image_hash = Column( String(40) ) # nb: this will be NULL if the card image has not been extracted yet
+    source_id = Column( Integer , ForeignKey("source_file.source_id",ondelete="CASCADE") )
+    card_image = orm.relationship( "AslCardImage" , uselist=False , backref="parent_card" , cascade="all,delete" , passive_deletes=True )
+    image_levels = orm.relationship( "AslCardImageLevel" , order_by="AslCardImageLevel.width" , cascade="all,delete" , passive_deletes=True )
+    # nb: passive_deletes means that the database removes a deleted card's images (see _on_connect())
+    # nb: a relationship for "source_file" is created by AslSourceFile
+    # NOTE: We use AUTOINCREMENT, so that SQLite never gives a new card the ID of one that was deleted.
+    __table_args__ = ( Index( "ix_card_lookup" , "nationality" , "tag_type" , "name" ) , { "sqlite_autoincrement": True } )
 
     def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
     def __str__( self ) : return self._to_string(AslCard)
 
+    def set_card_image( self , image_levels ) :
+        """Set the card's image (as returned by imaging.encode_image_levels())."""
+        self.card_image = AslCardImage( image_data=image_levels[0][2] )
+        self.image_hash = _hash_image( image_levels[0][2] )
+        self.image_levels = [
+            AslCardImageLevel( width=width , height=height , image_data=image_data )
+            for width,height,image_data in sorted( image_levels[1:] ) # nb: smallest first, as if loaded from the database
+        ]
+
+    def find_image_level( self , width , height ) :
+        """Find the smallest pre-scaled image that can be shown in a box of the specified size without being scaled up.
+
+        Returns None if the full-size image should be used.
+        """
+        # NOTE: The image will be scaled to fit the box (keeping its aspect ratio), so it only needs to fill one dimension.
+        # nb: image_data is deferred, so this doesn't load the images for the levels we don't use
+        for level in self.image_levels :
+            if level.width >= width or level.height >= height :
+                return level
+        return None
+
 class AslCardImage( DbBase , DbBaseMixin ) :
     """Models the image data for an ASL card."""
     __tablename__ = "card_image"
     card_id = Column( Integer , ForeignKey("card.card_id",ondelete="CASCADE") , primary_key=True )
-    image_data = Column( Binary() )
+    image_data = orm.deferred( Column( Binary() ) ) # nb: so that we can check if a card has an image without loading it
+    image_ref = Column( String(40) ) # nb: this will be NULL if the image is stored in image_data (see image_pack.py)
     # nb: a relationship for "card_image" is created by AslCard
 
     def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
     def __str__( self ) :
+        if self.image_ref :
+            return "AslCardImage[card_id={}|ref={}]".format( self.card_id , self.image_ref )
         return "AslCardImage[card_id={}|#bytes={}]".format( self.card_id , len(self.image_data) )
 
+class AslCardImageLevel( DbBase , DbBaseMixin ) :
+    """Models a pre-scaled copy of the image for an ASL card."""
+    __tablename__ = "card_image_level"
+    card_id = Column( Integer , ForeignKey("card.card_id",ondelete="CASCADE") , primary_key=True )
+    width = Column( Integer , primary_key=True )
+    height = Column( Integer )
+    image_data = orm.deferred( Column( Binary() ) ) # nb: so that we can check the sizes without loading the images
+    image_ref = Column( String(40) ) # nb: this will be NULL if the image is stored in image_data (see image_pack.py)
+
+    def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
+    def __str__( self ) :
+        return "AslCardImageLevel[card_id={}|{}x{}]".format( self.card_id , self.width , self.height )
+
+@event.listens_for( AslCardImage , "before_insert" )
+@event.listens_for( AslCardImageLevel , "before_insert" )
+def _on_insert_image( mapper , conn , target ) :
+    """Move a new card image into the image pack (if we're using one)."""
+    database = orm.object_session( target ).info.get( "database" )
+    if database and database.image_pack is not None and target.image_data is not None :
+        target.image_ref = database.image_pack.put( target.image_data )
+        target.image_data = None
+
+class AslRenderCheckpoint( DbBase , DbBaseMixin ) :
+    """Models the card images extracted from a range of pages, by an analysis that hasn't finished yet."""
+    __tablename__ = "render_checkpoint"
+    checkpoint_id = Column( Integer , primary_key=True , autoincrement=True )
+    content_hash = Column( String(40) , index=True )
+    image_res = Column( Integer )
+    image_encoding = Column( String(20) )
+    render_backend = Column( String(20) )
+    render_profile = Column( String(20) )
+    first_page = Column( Integer )
+    last_page = Column( Integer )
+    nimages = Column( Integer ) # nb: the number of cards whose images were extracted (see AslCheckpointImage)
+
+    def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
+    def __str__( self ) :
+        return "AslRenderCheckpoint[{}|pages={}-{}]".format( self.content_hash , self.first_page , self.last_page )
+
+class AslCheckpointImage( DbBase , DbBaseMixin ) :
+    """Models a card image saved by a checkpoint (with one row for each of its pre-scaled images)."""
+    __tablename__ = "render_checkpoint_image"
+    checkpoint_id = Column( Integer , ForeignKey("render_checkpoint.checkpoint_id",ondelete="CASCADE") , primary_key=True )
+    image_no = Column( Integer , primary_key=True ) # nb: the card's position in the range of pages
+    level_no = Column( Integer , primary_key=True ) # nb: the image's position in the card's images (0 = full-size)
+    width = Column( Integer )
+    height = Column( Integer )
+    image_data = Column( Binary() )
+    image_ref = Column( String(40) ) # nb: this will be NULL if the image is stored in image_data (see image_pack.py)
+
+    def __init__( self , **kwargs ) : self._init_db_object( **kwargs )
+    def __str__( self ) :
+        return "AslCheckpointImage[checkpoint_id={}|#{}.{}|{}x{}]".format(
+            self.checkpoint_id , self.image_no , self.level_no , self.width , self.height
+        )
+
 # ---------------------------------------------------------------------
 
-def open_database( fname , create ) :
-    """Open the database."""
+class Database :
+    """Handle to an open database.
 
-    # open the database
-    is_new = not os.path.isfile( fname )
-    if create :
-        if not is_new :
-            raise Exception( "File exists: {}".format( fname ) )
-    else :
-        if is_new :
-            raise Exception( "Can't find file: {}".format( fname ) )
-    conn_string = "sqlite:///{}".format( fname )
-    global db_engine
-    db_engine = create_engine( conn_string , convert_unicode=True )
-    #db_engine.echo = True
-
-    # initialize our session
-    global db_session
-    db_session = orm.create_session( bind=db_engine , autocommit=False )
-    db_session.execute( "PRAGMA foreign_keys = on" ) # nb: foreign keys are disabled by default in SQLite
-
-    # check if we are creating a new database
-    if create :
-        # yup - make it so
-        DbBase.metadata.create_all( db_engine )
+    Each thread gets its own session (see the "session" property), so the database can be used from worker threads.
+    Background readers can also use read_session(), which uses a pool of read-only connections.
+    """
+
+    def __init__( self , fname , create , use_image_pack=False ) :
+        """Open the database.
+
+        If use_image_pack is set, new card images will be stored in an image pack file (see image_pack.py).
+        An existing image pack is always opened, since the database will have images stored in it.
+        """
+
+        # open the database
+        self.fname = fname
+        self.is_new = not os.path.isfile( fname )
+        if create :
+            if not self.is_new :
+                raise Exception( "File exists: {}".format( fname ) )
+        else :
+            if self.is_new :
+                raise Exception( "Can't find file: {}".format( fname ) )
+        # NOTE: If we're creating a new database, an image pack that's already there will be deleted (see below),
+        # so we make sure that's what it really is.
+        pack_fname = get_pack_fname( fname )
+        if self.is_new and os.path.isfile( pack_fname ) and not is_pack_file( pack_fname ) :
+            raise RuntimeError( "Not an image pack file: {}".format( pack_fname ) )
+        conn_string = "sqlite:///{}".format( fname )
+        # NOTE: A session's connection is only used by the thread that owns the session, but it may be closed
+        # from another thread (when the database is closed), so we turn off pysqlite's thread check.
+        self.engine = create_engine( conn_string , convert_unicode=True ,
+            connect_args = { "check_same_thread": False }
+        )
+        #self.engine.echo = True
+        event.listen( self.engine , "connect" , _on_connect )
+
+        # create the database tables
+        # nb: for an existing database, this creates any tables that have been added since it was built
+        # NOTE: The page size can only be set before the first table is created.
+        with self.engine.connect() as conn :
+            if self.is_new :
+                conn.execute( "PRAGMA page_size = {}".format( _PAGE_SIZE ) )
+            DbBase.metadata.create_all( conn )
+
+        # initialize our sessions
+        # NOTE: Sessions can't be shared between threads, so each thread gets its own.
+        self._session_factory = orm.sessionmaker( bind=self.engine ,
+            autocommit=False , autoflush=False , expire_on_commit=False ,
+            info = { "database": self }
+        )
+        self._all_sessions = weakref.WeakSet()
+        self.sessions = orm.scoped_session( self._make_session )
+        # NOTE: Images are written to the pack as they are saved, so we make sure they're on disk
+        # before the database rows that reference them are committed.
+        event.listen( self._session_factory , "before_commit" , self._on_before_commit )
+        # NOTE: The read-only connections are pooled (and can be used by any thread, although only by one at a time).
+        # nb: we open the database using a URI, so that SQLite will enforce read-only access
+        # NOTE: We make the connections ourself, since older versions of SQLAlchemy don't understand URI's.
+        uri = pathlib.Path( os.path.abspath( fname ) ).as_uri() + "?mode=ro"
+        self.read_engine = create_engine( "sqlite://" ,
+            creator = lambda: sqlite3.connect( uri , uri=True , check_same_thread=False ) ,
+            convert_unicode = True ,
+            poolclass = QueuePool , pool_size = _READ_POOL_SIZE
+        )
+        self._read_session_factory = orm.sessionmaker( bind=self.read_engine ,
+            autoflush=False , expire_on_commit=False ,
+            info = { "database": self }
+        )
+
+        # open the image pack
+        # NOTE: If we're creating a new database, any image pack that's already there was left over
+        # from a previous database.
+        self.image_pack = None
+        if self.is_new and os.path.isfile( pack_fname ) :
+            os.unlink( pack_fname )
+        if use_image_pack or os.path.isfile( pack_fname ) :
+            self.image_pack = ImagePack( pack_fname )
+
+        # NOTE: When cards are being streamed into the database, we track the changes being made to each source file here.
+        self._source_file_updates = {} # nb: { fname: _SourceFileUpdate }
+
+    def close( self ) :
+        """Close the database."""
+        self._source_file_updates.clear()
+        if self.image_pack is not None :
+            self.image_pack.close()
+            self.image_pack = None
+        for session in list( self._all_sessions ) :
+            session.close()
+        self.sessions.remove()
+        self.engine.dispose()
+        self.read_engine.dispose()
+
+    @property
+    def session( self ) :
+        """Get the session for the current thread."""
+        return self.sessions()
+
+    @contextmanager
+    def read_session( self ) :
+        """Get a read-only session (this can be used from any thread).
+
+        The session only sees changes that have been committed.
+        """
+        session = self._read_session_factory()
+        try :
+            yield session
+        finally :
+            session.close() # nb: this returns the connection to the pool
+
+    def _make_session( self ) :
+        """Make a new session (for the current thread)."""
+        session = self._session_factory()
+        self._all_sessions.add( session )
+        return session
+
+    def _on_before_commit( self , session ) :
+        """Make sure that new card images are on disk before the rows that reference them are committed."""
+        if self.image_pack is not None :
+            self.image_pack.sync()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def has_build_cache( self ) :
+        """Check if the database records where its cards came from (older databases don't)."""
+        if not self.engine.dialect.has_table( self.engine , AslSourceFile.__tablename__ ) :
+            return False
+        # NOTE: We also need to check that the tables have all the columns we know about, since they get added over time.
+        for table in [ AslSourceFile.__table__ , AslCard.__table__ , AslCardImage.__table__ , AslCardImageLevel.__table__ , AslRenderCheckpoint.__table__ ] :
+            col_names = set( c["name"] for c in inspect( self.engine ).get_columns( table.name ) )
+            if not all( c.name in col_names for c in table.columns ) :
+                return False
+        # NOTE: We also need the card table to use AUTOINCREMENT (see AslCard), which older databases didn't.
+        # nb: this can only be set when a table is created
+        table_sql = self.engine.execute(
+            sql.text( "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name" ) ,
+            name = AslCard.__tablename__
+        ).scalar()
+        if "AUTOINCREMENT" not in ( table_sql or "" ).upper() :
+            return False
+        return True
+
+    @contextmanager
+    def build_mode( self ) :
+        """Relax SQLite's safety settings while building a new database (they are restored afterwards).
+
+        This has no effect if the database already existed, since we don't want to risk damaging it.
+        """
+        if not self.is_new :
+            yield
+            return
+        # NOTE: SQLAlchemy uses a new connection for each transaction, so we configure each one as it's made.
+        self.session.commit()
+        event.listen( self.engine , "connect" , _on_build_connect )
+        # nb: we still sync the image pack, since we don't want committed cards pointing to images that were lost
+        try :
+            yield
+        finally :
+            event.remove( self.engine , "connect" , _on_build_connect )
+            self.session.commit()
+            conn = self.session.connection()
+            for key,val in _SAFE_PRAGMAS :
+                conn.execute( "PRAGMA {} = {}".format( key , val ) )
+            self.session.commit()
+
+    def add_cards( self , cards ) :
+        """Build the database from the specified cards."""
+        # add the cards
+        # NOTE: If we already have cards from the same files (i.e. a file has changed since the database was last built),
+        # only the cards that have changed are updated.
+        updates = {}
+        for c in cards :
+            if not c.source_file :
+                classify_card( c )
+                self.session.add( c )
+                continue
+            update = updates.get( id(c.source_file) )
+            if not update :
+                update = updates[ id(c.source_file) ] = _SourceFileUpdate( self , c.source_file )
+            update.add_card( c )
+        for update in updates.values() :
+            update.finish()
+            # we don't need the checkpoints for this file any more
+            self._delete_checkpoints( AslRenderCheckpoint.content_hash == update.source_file.content_hash )
+        # commit the changes
+        self.session.commit()
+
+    def add_card( self , card ) :
+        """Add a card to the database, as part of a streamed build (see PdfParser.iter_cards()).
+
+        The cards for each source file must be added in order, and complete_source_file() called after the last one.
+        """
+        update = self._source_file_updates.get( card.source_file.fname )
+        if not update or update.new_source_file is not card.source_file :
+            # this is the first card for a source file
+            # NOTE: The cards get committed in batches, so the source file is marked as incomplete until
+            # we have all of them, in case the analysis is cancelled or fails part-way through the file.
+            update = self._source_file_updates[ card.source_file.fname ] = _SourceFileUpdate( self , card.source_file )
+        if update.add_card( card ) or len( self.session.new ) + len( self.session.dirty ) >= _STREAM_BATCH_SIZE :
+            self._commit_streamed_cards( update.source_file )
+
+    def complete_source_file( self , fname ) :
+        """Mark the cards for a source file as complete (after they have been added by add_card()).
+
+        Returns the number of cards that were saved for the file.
+        """
+        # nb: source files are recorded using their absolute path (see PdfParser._make_source_file())
+        update = self._source_file_updates.pop( os.path.abspath( fname ) , None )
+        if not update :
+            # no cards were added for this file - remove any we had for it (from a previous version of the file)
+            self.remove_source_file( os.path.abspath( fname ) )
+            return 0
+        update.finish()
+        source_file = update.source_file
+        # we don't need the checkpoints for this file any more
+        self._delete_checkpoints( AslRenderCheckpoint.content_hash == source_file.content_hash )
+        self._commit_streamed_cards( source_file )
+        return self.session.query( AslCard ).filter( AslCard.source_id == source_file.source_id ).count()
+
+    def _commit_streamed_cards( self , source_file ) :
+        """Commit the cards that have been streamed in."""
+        self.session.commit()
+        # NOTE: The source file holds on to its cards (and their images), so we need to tell it to let them go.
+        self.session.expire( source_file , [ "cards" ] )
+
+    def find_cards_without_images( self ) :
+        """Find the cards whose images haven't been extracted yet."""
+        query = self.session.query( AslCard ) \
+            .outerjoin( AslCardImage ) \
+            .filter( AslCardImage.card_id.is_( None ) )
+        return list( query.all() )
+
+    def save_card_image( self , card , image_levels ) :
+        """Save the image for a card."""
+        # NOTE: Card images are normally saved with their card, but this is used when they are extracted on demand.
+        if card.card_image :
+            return
+        card.set_card_image( image_levels )
+        self.session.commit()
+
+    def find_source_file( self , fname ) :
+        """Find the source file record for the specified file."""
+        # nb: we ignore files whose cards weren't all saved
+        return self.session.query( AslSourceFile ) \
+            .filter( AslSourceFile.fname == fname ) \
+            .filter( AslSourceFile.is_complete == True ) \
+            .one_or_none()
+
+    def purge_source_files( self , keep ) :
+        """Remove the cards for all source files, except the specified ones (and for any incomplete files)."""
+        self.session.flush() # nb: so that we see any cards that have been streamed in, but not yet committed
+        self._source_file_updates.clear()
+        self._delete_source_files( or_(
+            AslSourceFile.fname.notin_( keep ) ,
+            AslSourceFile.is_complete != True
+        ) )
+        self.session.commit()
+
+    def add_source_file( self , source_file , cards ) :
+        """Add the cards for a new source file (in a single transaction).
+
+        Returns the number of cards that were saved.
+        """
+        if self.find_source_file( source_file.fname ) :
+            raise Exception( "Source file already exists: {}".format( source_file.fname ) )
+        return self.replace_source_file( source_file , cards )
+
+    def replace_source_file( self , source_file , cards ) :
+        """Replace the cards for a source file (in a single transaction).
+
+        The file is added if it's not already in the database. Returns the number of cards that were saved.
+        """
+        # NOTE: Only the rows for this file are touched (and only the cards that have changed are updated,
+        # see _SourceFileUpdate), so this costs time in proportion to the size of the file, not the whole database.
+        self._source_file_updates.pop( source_file.fname , None ) # nb: this replaces any streamed update in progress
+        try :
+            update = _SourceFileUpdate( self , source_file )
+            for card in cards :
+                update.add_card( card )
+            update.finish()
+            # we don't need the checkpoints for this file any more
+            self._delete_checkpoints( AslRenderCheckpoint.content_hash == source_file.content_hash )
+            self.session.commit()
+        except :
+            self.session.rollback()
+            raise
+        return self.session.query( AslCard ).filter( AslCard.source_id == update.source_file.source_id ).count()
+
+    def remove_source_file( self , fname ) :
+        """Remove a source file and its cards (in a single transaction).
+
+        Returns the number of cards that were removed.
+        """
+        self._source_file_updates.pop( fname , None )
+        source_id = self.session.query( AslSourceFile.source_id ) \
+            .filter( AslSourceFile.fname == fname ) \
+            .scalar()
+        if source_id is None :
+            return 0
+        ncards = self.session.query( AslCard ).filter( AslCard.source_id == source_id ).count()
+        self._delete_source_files( AslSourceFile.source_id == source_id )
+        self.session.commit()
+        return ncards
+
+    def load_checkpoint( self , source_file , first_page , last_page ) :
+        """Load the card images saved for a range of pages in a source file (or None, if there aren't any)."""
+        checkpoint = self.session.query( AslRenderCheckpoint ) \
+            .filter( AslRenderCheckpoint.content_hash == source_file.content_hash ) \
+            .filter( AslRenderCheckpoint.image_res == source_file.image_res ) \
+            .filter( AslRenderCheckpoint.image_encoding == source_file.image_encoding ) \
+            .filter( AslRenderCheckpoint.render_backend == source_file.render_backend ) \
+            .filter( AslRenderCheckpoint.render_profile == source_file.render_profile ) \
+            .filter( AslRenderCheckpoint.first_page == first_page ) \
+            .filter( AslRenderCheckpoint.last_page == last_page ) \
+            .first()
+        if not checkpoint :
+            return None
+        # load the card images
+        table = AslCheckpointImage.__table__
+        query = sql.select( [ table.c.image_no , table.c.width , table.c.height , table.c.image_data , table.c.image_ref ] ) \
+            .where( table.c.checkpoint_id == checkpoint.checkpoint_id ) \
+            .order_by( table.c.image_no , table.c.level_no )
+        card_images = [ [] for _ in range( checkpoint.nimages ) ]
+        for row in self.session.execute( query ) :
+            if row[0] >= len( card_images ) :
+                return None
+            card_images[ row[0] ].append( ( row[1] , row[2] , bytes( self._get_image_data( row[3] , row[4] ) ) ) )
+        if not all( card_images ) :
+            return None # nb: the checkpoint is incomplete, so we extract the card images again
+        return card_images
+
+    def save_checkpoint( self , source_file , first_page , last_page , card_images ) :
+        """Save the card images extracted from a range of pages in a source file."""
+        # NOTE: We commit straight away, so that the card images survive if the analysis is cancelled or fails.
+        checkpoint = AslRenderCheckpoint(
+            content_hash = source_file.content_hash ,
+            image_res = source_file.image_res ,
+            image_encoding = source_file.image_encoding ,
+            render_backend = source_file.render_backend ,
+            render_profile = source_file.render_profile ,
+            first_page = first_page ,
+            last_page = last_page ,
+            nimages = len( card_images )
+        )
+        self.session.add( checkpoint )
+        self.session.flush()
+        # NOTE: If we're using an image pack, the card images are stored there, so when the cards are saved,
+        # they will re-use the same images (rather than the images being written out again).
+        rows = [
+            self._make_image_row( image_data ,
+                checkpoint_id=checkpoint.checkpoint_id , image_no=image_no , level_no=level_no , width=width , height=height
+            )
+            for image_no,levels in enumerate( card_images )
+            for level_no,(width,height,image_data) in enumerate( levels )
+        ]
+        if rows :
+            self.session.connection().execute( AslCheckpointImage.__table__.insert() , rows )
+        self.session.commit()
+
+    def has_checkpoints( self ) :
+        """Check if there are any saved checkpoints."""
+        return self.session.query( AslRenderCheckpoint ).first() is not None
+
+    def clear_checkpoints( self ) :
+        """Remove all saved checkpoints."""
+        self._delete_checkpoints( None )
+        self.session.commit()
+
+    def _delete_checkpoints( self , cond ) :
+        """Delete the specified checkpoints (the foreign keys remove their images)."""
+        query = self.session.query( AslRenderCheckpoint )
+        if cond is not None :
+            query = query.filter( cond )
+        query.delete( synchronize_session=False )
+
+    def _delete_source_files( self , cond ) :
+        """Delete the specified source files (and their cards)."""
+        # NOTE: We do a bulk DELETE, and let the foreign keys remove the cards and their images, rather than
+        # loading every card into the session just to delete it.
+        # nb: any images in the image pack are left there (it's append-only)
+        self.session.flush()
+        nrows = self.session.query( AslSourceFile ).filter( cond ).delete( synchronize_session=False )
+        if nrows > 0 :
+            # nb: the session may be holding some of the deleted objects, so we make it re-load everything
+            self.session.expire_all()
+
+    def load_cards( self ) :
+        """Load the cards from the database."""
+        # load the raw rows
+        # NOTE: We only load what we need to build the index, everything else (including the card images)
+        # is loaded when a card is shown.
+        query = self.session.query( AslCard ) \
+            .options( orm.load_only( *_CARD_INDEX_COLS ) ) \
+            .order_by( AslCard.nationality , AslCard.tag_type , AslCard.name )
+        card_index = defaultdict( lambda: defaultdict(list) )
+        # generate the card index
+        # nb: the cards were classified when they were saved (see classify_card())
+        for card in query :
+            card_index[ card.nationality ][ card.tag_type ].append( card )
+        return card_index
+
+    def get_nationalities( self ) :
+        """Get the nationalities that we have cards for."""
+        query = self.session.query( AslCard.nationality ).distinct()
+        return [ row[0] for row in query ]
+
+    def get_tag_types( self , nationality ) :
+        """Get the types of card (TAGTYPE_xxx) that we have for a nationality."""
+        query = self.session.query( AslCard.tag_type ) \
+            .filter( AslCard.nationality == nationality ) \
+            .distinct()
+        return [ row[0] for row in query ]
+
+    def find_cards( self , nationality , tag_type , name_filter=None ) :
+        """Find the cards of the specified nationality and type.
+
+        If a name filter is given, only cards whose name contain it are returned (ignoring case and spaces).
+        """
+        query = self.session.query( AslCard ) \
+            .options( orm.load_only( *_CARD_INDEX_COLS ) ) \
+            .filter( AslCard.nationality == nationality ) \
+            .filter( AslCard.tag_type == tag_type ) \
+            .order_by( AslCard.name )
+        if name_filter :
+            # NOTE: We compare against the normalized names that were saved with the cards, since SQLite's lower()
+            # only handles ASCII characters.
+            query = query.filter( sql.func.instr( AslCard.search_name , _get_search_name( name_filter ) ) > 0 )
+        return list( query.all() )
+
+    def load_card_images( self , card_ids , level=None ) :
+        """Load the images for the specified cards.
+
+        If a level is given (the width of a pre-scaled image), those images are loaded, instead of the full-size ones.
+        This can be called from any thread (the images are read using a read-only session).
+        The images are returned as a stream of (card_id,image_data), in no particular order (cards that don't have
+        the requested image are skipped). Images that are in the image pack are returned as memoryview's.
+        """
+        # NOTE: We read the images directly from the tables, rather than through the ORM objects, so that they
+        # don't stay in memory after the caller has finished with them.
+        if level :
+            table = AslCardImageLevel.__table__
+            cond = table.c.width == level
+        else :
+            table = AslCardImage.__table__
+            cond = None
+        card_ids = list( card_ids )
+        for i in range( 0 , len(card_ids) , _FETCH_BATCH_SIZE ) :
+            query = sql.select( [ table.c.card_id , table.c.image_data , table.c.image_ref ] ) \
+                .where( table.c.card_id.in_( card_ids[ i : i+_FETCH_BATCH_SIZE ] ) )
+            if cond is not None :
+                query = query.where( cond )
+            # nb: we fetch each batch before returning it, so that the caller can use the database in the meantime
+            with self.read_session() as session :
+                rows = session.execute( query ).fetchall()
+            for row in rows :
+                yield row[0] , self._get_image_data( row[1] , row[2] )
+
+    def _get_image_data( self , image_data , image_ref ) :
+        """Get the data for a card image (from the image pack, if it's stored there)."""
+        if not image_ref :
+            return image_data
+        data = self.image_pack.get( image_ref ) if self.image_pack is not None else None
+        if data is None :
+            raise RuntimeError( "Can't find card image in the image pack: {}".format( image_ref ) )
+        return data
+
+    def _make_image_row( self , image_data , **kwargs ) :
+        """Make a database row for a card image (moving it into the image pack, if we're using one)."""
+        if self.image_pack is not None and image_data is not None :
+            return dict( image_data=None , image_ref=self.image_pack.put( image_data ) , **kwargs )
+        return dict( image_data=image_data , image_ref=None , **kwargs )
+
+    def dump_database( self ) :
+        """Dump the raw database rows."""
+        # dump the source files
+        for source_file in self.session.query( AslSourceFile ) :
+            print( source_file )
+        # dump the ASL cards
+        query = self.session.query( AslCard )
+        for card in query.all() :
+            print( card )
+            if card.card_image :
+                print( "- {}".format( card.card_image ) )
+            for level in card.image_levels :
+                print( "- {}".format( level ) )
+
+# ---------------------------------------------------------------------
+
+def open_database( fname , create , use_image_pack=False ) :
+    """Open the database (see Database).
+
+    Returns the database handle. The module-level functions below work with the database opened here.
+    """
+    global _database , db_engine , db_session , image_pack
+    _database = Database( fname , create , use_image_pack=use_image_pack )
+    db_engine , db_session , image_pack = _database.engine , _database.sessions , _database.image_pack
+    return _database
 
 def close_database() :
     """Close the database"""
-    global db_engine , db_session
-    db_session.close()
-    db_session = None
-    db_engine.dispose()
-    db_engine = None
+    global _database , db_engine , db_session , image_pack
+    _database.close()
+    _database = db_engine = db_session = image_pack = None
 
-# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def get_database() :
+    """Get the database opened by open_database()."""
+    return _database
 
-def add_cards( cards ) :
-    """Build the database from the specified cards."""
-    # add the cards
-    for c in cards :
-        db_session.add( c )
-    # commit the changes
-    db_session.commit()
+# nb: these call the corresponding methods on the database opened by open_database()
+def has_build_cache() : return _database.has_build_cache()
+def build_mode() : return _database.build_mode()
+def add_cards( cards ) : return _database.add_cards( cards )
+def add_card( card ) : return _database.add_card( card )
+def complete_source_file( fname ) : return _database.complete_source_file( fname )
+def find_cards_without_images() : return _database.find_cards_without_images()
+def save_card_image( card , image_levels ) : return _database.save_card_image( card , image_levels )
+def find_source_file( fname ) : return _database.find_source_file( fname )
+def purge_source_files( keep ) : return _database.purge_source_files( keep )
+def add_source_file( source_file , cards ) : return _database.add_source_file( source_file , cards )
+def replace_source_file( source_file , cards ) : return _database.replace_source_file( source_file , cards )
+def remove_source_file( fname ) : return _database.remove_source_file( fname )
+def load_checkpoint( source_file , first_page , last_page ) : return _database.load_checkpoint( source_file , first_page , last_page )
+def save_checkpoint( source_file , first_page , last_page , card_images ) : return _database.save_checkpoint( source_file , first_page , last_page , card_images )
+def has_checkpoints() : return _database.has_checkpoints()
+def clear_checkpoints() : return _database.clear_checkpoints()
+def load_cards() : return _database.load_cards()
+def get_nationalities() : return _database.get_nationalities()
+def get_tag_types( nationality ) : return _database.get_tag_types( nationality )
+def find_cards( nationality , tag_type , name_filter=None ) : return _database.find_cards( nationality , tag_type , name_filter )
+def load_card_images( card_ids , level=None ) : return _database.load_card_images( card_ids , level )
+def read_session() : return _database.read_session()
+def dump_database() : return _database.dump_database()
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-def load_cards() :
-    """Load the cards from the database."""
-    # load the raw rows
-    query = db_session.query( AslCard )
-    cards =  list( query.all() )
-    card_index = defaultdict( lambda: defaultdict(list) )
-    # generate the card index
-    for card in cards :
-        cards2 = card_index[ card.nationality ]
-        card_tag = card.card_tag.lower()
-        if card_tag.startswith( "vehicle" ) :
-            tag_type = TAGTYPE_VEHICLE
-        elif card_tag.startswith( "ordnance" ) :
-            tag_type = TAGTYPE_ORDNANCE
+def _on_connect( dbapi_conn , conn_record ) :
+    """Configure a new database connection."""
+    # NOTE: Foreign keys are disabled by default in SQLite, and it's a per-connection setting, so we have to
+    # enable them for every connection (we rely on them to delete a card's images when the card is deleted).
+    cursor = dbapi_conn.cursor()
+    cursor.execute( "PRAGMA foreign_keys = on" )
+    cursor.close()
+
+def _on_build_connect( dbapi_conn , conn_record ) :
+    """Configure a new database connection, while the database is being built."""
+    cursor = dbapi_conn.cursor()
+    for key,val in _BUILD_PRAGMAS :
+        cursor.execute( "PRAGMA {} = {}".format( key , val ) )
+    cursor.close()
+
+class _SourceFileUpdate :
+    """Save the cards extracted from a source file, changing only what's different from what's already in the database.
+
+    When a new edition of a PDF comes out, usually only a few cards change. Rather than deleting all the cards
+    for the file, and adding them all back again, we match each new card with the one it replaces, and only
+    update the ones that are different. This keeps the card ID's stable for the cards that haven't changed.
+
+    New cards are not added to the session, they are written out in batches using bulk inserts, since
+    creating ORM objects for every card and image is slow when a new database is being built.
+    """
+
+    def __init__( self , database , source_file ) :
+        # initialize
+        self.database = database
+        self.new_source_file = source_file
+        self.old_cards = defaultdict( list ) # nb: { card key: [ (card_id,card values,image hash) ] }
+        self.pending = [] # nb: new cards that haven't been written out yet
+        # check if we already have cards for the file
+        # nb: we also use an incomplete source file, since it may have been left by an update that didn't finish
+        self.source_file = self.database.session.query( AslSourceFile ) \
+            .filter( AslSourceFile.fname == source_file.fname ) \
+            .one_or_none()
+        if self.source_file :
+            # yup - update the existing source file (so that its cards stay with it)
+            for col in AslSourceFile.__table__.columns :
+                if col.name not in ( "source_id" , "fname" ) :
+                    setattr( self.source_file , col.name , getattr( source_file , col.name ) )
+            # NOTE: We only load the card details here, not their images.
+            query = self.database.session.query( AslCard.card_id , *_CARD_VALUE_COLS , AslCard.image_hash ) \
+                .filter( AslCard.source_id == self.source_file.source_id ) \
+                .order_by( AslCard.card_id )
+            for row in query :
+                vals = tuple( row[1:-1] )
+                self.old_cards[ _get_card_key( vals ) ].append( ( row[0] , vals , row[-1] ) )
         else :
-            raise RuntimeError( "Invalid card tag ({}) for AslCard: {}".format( card_tag , card ) )
-        cards2[ tag_type ].append( card )
-    return card_index
+            # nope - add the new source file
+            # NOTE: We insert a copy of the source file, rather than adding it to the session, since that would
+            # also add its cards (which we want to write out ourself).
+            vals = {
+                col.name: getattr( source_file , col.name )
+                for col in AslSourceFile.__table__.columns if col.name != "source_id"
+            }
+            vals[ "is_complete" ] = False
+            result = self.database.session.execute( AslSourceFile.__table__.insert().values( **vals ) )
+            self.source_file = self.database.session.query( AslSourceFile ).get( result.inserted_primary_key[0] )
+        self.source_file.is_complete = False
+
+    def add_card( self , card ) :
+        """Save a card.
+
+        Returns True if a batch of new cards was written out.
+        """
+        classify_card( card )
+        vals = tuple( getattr( card , col.key ) for col in _CARD_VALUE_COLS )
+        image_hash = card.image_hash or ( _hash_image( card.card_image.image_data ) if card.card_image else None )
+        # find the card this one replaces
+        old_cards = self.old_cards.get( _get_card_key( vals ) )
+        if not old_cards :
+            # there isn't one - add it as a new card
+            card.image_hash = image_hash
+            self.pending.append( card )
+            if len( self.pending ) < _BULK_INSERT_SIZE :
+                return False
+            self._write_pending()
+            return True
+        # nb: if there's more than one, we prefer one with the same values
+        old_card = next( ( c for c in old_cards if c[1] == vals ) , old_cards[0] )
+        old_cards.remove( old_card )
+        card_id , old_vals , old_image_hash = old_card
+        # NOTE: The new card is not saved, so we detach it from its source file (so that it doesn't hang on to it).
+        card.source_file = None
+        if vals == old_vals and image_hash == old_image_hash :
+            return False # nb: nothing has changed
+        # update the card
+        old_card = self.database.session.query( AslCard ).get( card_id )
+        for col,val in zip( _CARD_VALUE_COLS , vals ) :
+            setattr( old_card , col.key , val )
+        old_card.search_name = card.search_name
+        if image_hash != old_image_hash :
+            # NOTE: If the card image hasn't been extracted yet, we remove the old one, since it came from
+            # the previous version of the file (the new one will be extracted when it's needed).
+            self._replace_card_image( old_card , card )
+            old_card.image_hash = image_hash
+        return False
+
+    def finish( self ) :
+        """Finish saving the cards."""
+        self._write_pending()
+        # remove the cards that weren't replaced
+        for old_cards in self.old_cards.values() :
+            for card_id,_,_ in old_cards :
+                self.database.session.delete( self.database.session.query( AslCard ).get( card_id ) )
+        self.old_cards.clear()
+        self.source_file.is_complete = True
+        self.database.session.flush()
+
+    def _write_pending( self ) :
+        """Write out the new cards (and their images)."""
+        if not self.pending :
+            return
+        # NOTE: We write the rows using the session's connection, so that they are part of the same transaction.
+        self.database.session.flush()
+        conn = self.database.session.connection()
+        card_rows = []
+        for card in self.pending :
+            row = { col.key: getattr( card , col.key ) for col in _CARD_VALUE_COLS }
+            row.update( tag_type=card.tag_type , card_no=card.card_no , search_name=card.search_name ,
+                image_hash=card.image_hash , source_id=self.source_file.source_id
+            )
+            card_rows.append( row )
+        conn.execute( AslCard.__table__.insert() , card_rows )
+        # NOTE: SQLite doesn't tell us what the card ID's were for a bulk insert, but since the card table
+        # uses AUTOINCREMENT, and we're the only writer (inside this transaction), the new cards were given
+        # the ID's up to (and including) the table's current sequence number, in the order they were inserted.
+        last_card_id = conn.execute(
+            sql.text( "SELECT seq FROM sqlite_sequence WHERE name = :name" ) ,
+            name = AslCard.__tablename__
+        ).scalar()
+        image_rows , level_rows = [] , []
+        for card_id,card in enumerate( self.pending , start=last_card_id-len(self.pending)+1 ) :
+            if card.card_image :
+                image_rows.append( self.database._make_image_row( card.card_image.image_data , card_id=card_id ) )
+            for level in card.image_levels :
+                level_rows.append( self.database._make_image_row( level.image_data ,
+                    card_id=card_id , width=level.width , height=level.height
+                ) )
+        for table,rows in [ (AslCardImage,image_rows) , (AslCardImageLevel,level_rows) ] :
+            if rows :
+                conn.execute( table.__table__.insert() , rows )
+        # NOTE: The cards have been saved, so we let them (and their images) go.
+        self.pending = []
+        orm.attributes.set_committed_value( self.new_source_file , "cards" , [] )
+        self.database.session.expire( self.source_file , [ "cards" ] )
+
+    def _replace_card_image( self , card , new_card ) :
+        """Replace a card's image with the image from another card."""
+        # remove the old image
+        # nb: the images are keyed by card ID, so they have to be deleted before the new ones can be added
+        if card.card_image :
+            self.database.session.delete( card.card_image )
+        for level in card.image_levels :
+            self.database.session.delete( level )
+        self.database.session.flush()
+        self.database.session.expire( card , [ "card_image" , "image_levels" ] )
+        # move the new image over
+        card_image , image_levels = new_card.card_image , list( new_card.image_levels )
+        new_card.card_image , new_card.image_levels = None , []
+        card.card_image = card_image
+        card.image_levels = image_levels
+
+# NOTE: These are the card values we compare, to check if a card has changed (the first 2 identify the card).
+_CARD_VALUE_COLS = [ AslCard.nationality , AslCard.card_tag , AslCard.name , AslCard.page_id , AslCard.page_pos ]
+
+def _get_card_key( vals ) :
+    """Get the key that identifies a card (from its values)."""
+    return vals[:2]
+
+def classify_card_tag( card_tag ) :
+    """Classify a card tag.
+
+    Returns the tag type (TAGTYPE_xxx) and card number e.g. "Vehicle #12.1" => ( TAGTYPE_VEHICLE , 12 ).
+    """
+    card_tag2 = card_tag.lower()
+    if card_tag2.startswith( "vehicle" ) :
+        tag_type = TAGTYPE_VEHICLE
+    elif card_tag2.startswith( "ordnance" ) :
+        tag_type = TAGTYPE_ORDNANCE
+    else :
+        raise RuntimeError( "Invalid card tag: {}".format( card_tag ) )
+    mo = _CARD_NO_REGEX.search( card_tag )
+    return tag_type , int( mo.group(1) ) if mo else None
+
+_CARD_NO_REGEX = re.compile( r"#\s*(\d+)" )
+
+def classify_card( card ) :
+    """Classify a card, before it is saved."""
+    # NOTE: We do this when the card is saved (rather than when the cards are loaded), so that bad card tags
+    # are found when the database is built. The parser also does this for each file's cards, so that a file
+    # with a bad card tag is reported (and skipped) like any other problem with a file.
+    try :
+        card.tag_type , card.card_no = classify_card_tag( card.card_tag )
+    except RuntimeError as ex :
+        raise RuntimeError( "{} ({})".format( ex , card ) ) from ex
+    card.search_name = _get_search_name( card.name )
+
+def _get_search_name( name ) :
+    """Normalize a card name, for searching (we ignore case and spaces)."""
+    return ( name or "" ).replace( " " , "" ).lower()
+
+def _hash_image( image_data ) :
+    """Generate a hash of a card image."""
+    return hashlib.sha1( image_data ).hexdigest()
+
+_CARD_INDEX_COLS = [ "card_id" , "nationality" , "tag_type" , "name" ]
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -134,12 +965,3 @@ def dump_cards( cards ) :
             print( "{} ({}):".format( nationality  , tag_type ) )
             for card in cards[nationality][tag_type] :
                 print( "- {}".format( card ) )
-
-def dump_database() :
-    """Dump the raw database rows."""
-    # dump the ASL cards
-    query = db_session.query( AslCard )
-    for card in query.all() :
-        print( card )
-        if card.card_image :
-            print( "- {}".format( card.card_image ) )
@@ -0,0 +1,141 @@
+""" Store card images in a content-addressed pack file.
+
+Card images can be stored in a pack file (next to the database), rather than in the database itself. This keeps
+the database small (so that it opens quickly), and since images are keyed by a hash of their contents, an image
+that appears in several files (e.g. different editions of the same PDF) is only stored once. The pack file is
+memory-mapped, so images can be read without being copied.
+
+The file is a header, followed by a record for each image. Each record has a header that contains the image's
+key (the SHA1 of its contents) and size, followed by the image data. Records are only ever appended.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+import threading
+
+FILE_HEADER = b"ASLIMGP1"
+
+_RECORD_HEADER = struct.Struct( "<4s20sQ" )
+_RECORD_MARKER = b"IMAG"
+
+# ---------------------------------------------------------------------
+
+class ImagePack :
+    """Content-addressed store for card images."""
+
+    def __init__( self , fname ) :
+        # initialize
+        self.fname = fname
+        self.sync_writes = True # nb: flush new images to disk before the database commits (see sync())
+        self._index = {} # nb: { key: (offset,nbytes) }
+        self._mmap = None
+        self._unsynced = False
+        self._lock = threading.Lock() # nb: images can be read by background threads (see db.Database)
+        # open the pack file
+        # NOTE: We only ever append to the file while it's open, since there may be mappings into any part of it.
+        if not os.path.isfile( fname ) :
+            open( fname , "wb" ).close()
+        self._fp = open( fname , "r+b" )
+        try :
+            self._load_index()
+        except :
+            self._fp.close()
+            raise
+
+    def close( self ) :
+        """Close the pack file."""
+        if self._fp :
+            self._fp.close()
+            self._fp = None
+        self._index = {}
+        self._mmap = None # nb: any images still in use keep their mapping alive
+
+    def __contains__( self , key ) :
+        return key in self._index
+
+    def __len__( self ) :
+        return len( self._index )
+
+    def get( self , key ) :
+        """Get an image (or None, if it's not in the pack).
+
+        The image is returned as a read-only memoryview into the mapped file.
+        """
+        with self._lock :
+            entry = self._index.get( key )
+            if not entry :
+                return None
+            offset , nbytes = entry
+            if not self._mmap or offset + nbytes > len( self._mmap ) :
+                # NOTE: The file has grown since we last mapped it, so we map it again (existing mappings stay valid,
+                # since the file is never truncated while it's open).
+                self._mmap = mmap.mmap( self._fp.fileno() , 0 , access=mmap.ACCESS_READ )
+            return memoryview( self._mmap )[ offset : offset+nbytes ]
+
+    def put( self , data ) :
+        """Add an image to the pack.
+
+        Returns the image's key. If the pack already contains the image, it is not added again.
+        """
+        key = get_image_key( data )
+        with self._lock :
+            if key in self._index :
+                return key
+            offset = self._fp.seek( 0 , os.SEEK_END )
+            self._fp.write( _RECORD_HEADER.pack( _RECORD_MARKER , bytes.fromhex( key ) , len(data) ) )
+            self._fp.write( data )
+            self._fp.flush()
+            self._index[ key ] = ( offset + _RECORD_HEADER.size , len(data) )
+            self._unsynced = True
+        return key
+
+    def sync( self ) :
+        """Make sure that the images that have been added are on disk."""
+        if self._unsynced and self.sync_writes :
+            os.fsync( self._fp.fileno() )
+            self._unsynced = False
+
+    def _load_index( self ) :
+        """Load the index of the images in the pack file."""
+        fsize = self._fp.seek( 0 , os.SEEK_END )
+        self._fp.seek( 0 )
+        if self._fp.read( len(FILE_HEADER) ) != FILE_HEADER :
+            if fsize > 0 :
+                raise RuntimeError( "Not an image pack file: {}".format( self.fname ) )
+            self._fp.write( FILE_HEADER )
+            self._fp.flush()
+            return
+        offset = len( FILE_HEADER )
+        while offset < fsize :
+            self._fp.seek( offset )
+            buf = self._fp.read( _RECORD_HEADER.size )
+            if len(buf) == _RECORD_HEADER.size :
+                marker , digest , nbytes = _RECORD_HEADER.unpack( buf )
+            else :
+                marker = None
+            next_offset = offset + _RECORD_HEADER.size + nbytes if marker == _RECORD_MARKER else None
+            if next_offset is None or next_offset > fsize :
+                # NOTE: The program must've died while it was adding this image, so we throw it away
+                # (the database transaction that referenced it would not have been committed).
+                self._fp.truncate( offset )
+                break
+            self._index[ digest.hex() ] = ( offset + _RECORD_HEADER.size , nbytes )
+            offset = next_offset
+
+# ---------------------------------------------------------------------
+
+def get_pack_fname( db_fname ) :
+    """Get the name of the image pack file for a database."""
+    return os.path.splitext( db_fname )[0] + ".images"
+
+def is_pack_file( fname ) :
+    """Check if a file is an image pack file (an empty file counts, since that's how a new pack file starts out)."""
+    with open( fname , "rb" ) as fp :
+        buf = fp.read( len(FILE_HEADER) )
+    return buf == FILE_HEADER or buf == b""
+
+def get_image_key( data ) :
+    """Get the key for an image."""
+    return hashlib.sha1( data ).hexdigest()
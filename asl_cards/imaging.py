@@ -0,0 +1,207 @@
+""" Crop and encode card images.
+"""
+
+import io
+import time
+import collections
+
+from PIL import Image
+
+# NOTE: Pixels must differ from the background by more than this (in any colour channel) to be considered content.
+DEFAULT_CONTENT_THRESHOLD = 100
+
+# ---------------------------------------------------------------------
+
+def make_content_mask( img , threshold=DEFAULT_CONTENT_THRESHOLD ) :
+    """Generate a mask of the pixels in an image that are not background.
+
+    The background colour is taken from the top-left pixel. The mask is an "L" image, where content pixels
+    are non-zero.
+    """
+    if img.mode not in ("L","RGB") :
+        img = img.convert( "RGB" )
+    # build a lookup table that flags each channel value that is too far from the background
+    bgd_col = img.getpixel( (0,0) )
+    if img.mode == "L" :
+        bgd_col = [ bgd_col ]
+    lut = []
+    for val in bgd_col :
+        lut.extend( 255 if abs(i-val) > threshold else 0 for i in range(0,256) )
+    # generate the mask
+    # NOTE: This is a single pass over the image, and doesn't need a background image to compare against.
+    # When we convert to greyscale, a pixel will be non-zero if any of its channels were flagged.
+    mask = img.point( lut )
+    if mask.mode != "L" :
+        mask = mask.convert( "L" )
+    return mask
+
+def get_content_bounds( mask , bbox=None ) :
+    """Find the bounding box of the content in a mask (or part of it).
+
+    Returns None if there is no content.
+    """
+    # project the mask onto the x and y axes
+    # NOTE: getprojection() does this in C, and gives us a flag for each column and row
+    # that contains at least one non-zero pixel.
+    if bbox :
+        mask = mask.crop( bbox )
+    xproj , yproj = mask.im.getprojection()
+    x0 , x1 = _find_extent( xproj )
+    if x0 is None :
+        return None
+    y0 , y1 = _find_extent( yproj )
+    if bbox :
+        return ( bbox[0]+x0 , bbox[1]+y0 , bbox[0]+x1 , bbox[1]+y1 )
+    return ( x0 , y0 , x1 , y1 )
+
+def _find_extent( proj ) :
+    """Find the first and last (+1) non-zero entries in a projection."""
+    stripped = proj.lstrip( b"\x00" )
+    if not stripped :
+        return None , None
+    return len(proj) - len(stripped) , len( proj.rstrip( b"\x00" ) )
+
+# ---------------------------------------------------------------------
+
+def _save_png( img , buf ) :
+    img.save( buf , "PNG" )
+
+def _save_png_palette( img , buf ) :
+    # NOTE: The cards use a limited number of colours, so they survive being reduced to a palette pretty well.
+    if img.mode not in ("L","P") :
+        img = img.convert( "P" , palette=Image.ADAPTIVE , colors=256 )
+    img.save( buf , "PNG" , optimize=True )
+
+def _save_webp( img , buf ) :
+    img.save( buf , "WEBP" , lossless=True )
+
+def _save_jpeg( img , buf ) :
+    if img.mode not in ("L","RGB") :
+        img = img.convert( "RGB" )
+    img.save( buf , "JPEG" , quality=90 , optimize=True )
+
+# NOTE: The viewer loads card images with QPixmap.loadFromData(), so these all need to be formats that Qt
+# can read (WebP needs Qt's imageformats plugin, which is normally installed with PyQt5).
+_ENCODINGS = collections.OrderedDict( [
+    ( "png" , ( "PNG" , _save_png ) ) ,
+    ( "png-palette" , ( "PNG (palette)" , _save_png_palette ) ) ,
+    ( "webp" , ( "WebP (lossless)" , _save_webp ) ) ,
+    ( "jpeg" , ( "JPEG (quality 90)" , _save_jpeg ) ) ,
+] )
+DEFAULT_ENCODING = "png"
+
+def get_encodings() :
+    """Get the available image encodings."""
+    return [ ( key , vals[0] ) for key,vals in _ENCODINGS.items() ]
+
+def encode_image( img , encoding=DEFAULT_ENCODING ) :
+    """Encode an image."""
+    try :
+        save_image = _ENCODINGS[ encoding or DEFAULT_ENCODING ][ 1 ]
+    except KeyError :
+        raise RuntimeError( "Unknown image encoding: {}".format( encoding ) )
+    buf = io.BytesIO()
+    save_image( img , buf )
+    return buf.getvalue()
+
+# NOTE: As well as the full-size card image, we store pre-scaled copies at these widths (a thumbnail,
+# and something that will fill a typical tab), so that the viewer doesn't have to decode a huge image
+# and scale it down every time it is shown.
+IMAGE_LEVEL_WIDTHS = [ 800 , 200 ]
+
+def encode_image_levels( img , encoding=DEFAULT_ENCODING ) :
+    """Encode an image at full size, and at each of the pre-scaled sizes.
+
+    Returns a list of (width, height, image data), full size first.
+    """
+    levels = [ ( img.width , img.height , encode_image( img , encoding ) ) ]
+    for width in sorted( IMAGE_LEVEL_WIDTHS , reverse=True ) :
+        if width >= img.width :
+            continue # nb: we never scale up
+        # nb: each level is scaled down from the previous one, which is a lot quicker than scaling down from full size
+        height = max( ( img.height * width + img.width//2 ) // img.width , 1 )
+        img = img.resize( (width,height) , Image.LANCZOS )
+        levels.append( ( width , height , encode_image( img , encoding ) ) )
+    return levels
+
+# ---------------------------------------------------------------------
+
+class EncodingReport :
+    """Compare how each image encoding does on a sample of the card images from a build."""
+
+    def __init__( self , max_samples=8 ) :
+        # initialize
+        self.max_samples = max_samples
+        self.samples = []
+        self.total_images = 0
+        self.total_bytes = 0
+        self._sampled_fnames = set()
+
+    def add_images( self , images , fname=None ) :
+        """Add card images extracted from a file."""
+        # NOTE: We take one sample from each file, to get a mix of card types and nationalities.
+        images = [ img for img in images if img ]
+        if images and len(self.samples) < self.max_samples and ( fname is None or fname not in self._sampled_fnames ) :
+            self.samples.append( images[ len(images)//2 ] )
+            self._sampled_fnames.add( fname )
+        self.total_images += len(images)
+        self.total_bytes += sum( len(img) for img in images )
+
+    def generate( self ) :
+        """Generate the report.
+
+        Returns a list of (encoding, average size, encode time, decode time), where the times are
+        the average for each image, in seconds.
+        """
+        if not self.samples :
+            return []
+        images = []
+        for buf in self.samples :
+            img = Image.open( io.BytesIO( buf ) )
+            img.load()
+            images.append( img )
+        results = []
+        for encoding in _ENCODINGS :
+            # encode the sample images
+            start_time = time.time()
+            bufs = [ encode_image( img , encoding ) for img in images ]
+            encode_time = time.time() - start_time
+            # decode them again
+            start_time = time.time()
+            for buf in bufs :
+                Image.open( io.BytesIO( buf ) ).load()
+            decode_time = time.time() - start_time
+            results.append( (
+                encoding ,
+                sum( len(buf) for buf in bufs ) / len(bufs) ,
+                encode_time / len(bufs) ,
+                decode_time / len(bufs)
+            ) )
+        return results
+
+    def format( self , encoding ) :
+        """Format the report, for a build that used the specified encoding."""
+        results = self.generate()
+        if not results :
+            return ""
+        encoding = encoding or DEFAULT_ENCODING
+        results = { r[0]: r[1:] for r in results }
+        # figure out how much space the selected encoding saved (compared to the default)
+        # NOTE: We only have the actual size of the card images for the encoding that was used, so we estimate
+        # what they would have been using the default encoding, from the sample images.
+        ratio = results[ DEFAULT_ENCODING ][ 0 ] / results[ encoding ][ 0 ]
+        bytes_saved = int( self.total_bytes * ratio ) - self.total_bytes
+        lines = [ "Card images: {} ({}), {:.1f} MB (saved {:.1f} MB vs. {}).".format(
+            self.total_images , _ENCODINGS[encoding][0] ,
+            self.total_bytes / 1024 / 1024 ,
+            bytes_saved / 1024 / 1024 , _ENCODINGS[DEFAULT_ENCODING][0]
+        ) ]
+        for key,(caption,_) in _ENCODINGS.items() :
+            size , encode_time , decode_time = results[ key ]
+            lines.append( "- {}: {:.0f} KB/image ({:+.0f}%), encode {:.0f} ms, decode {:.0f} ms{}".format(
+                caption , size / 1024 ,
+                100 * ( size - results[DEFAULT_ENCODING][0] ) / results[DEFAULT_ENCODING][0] ,
+                1000 * encode_time , 1000 * decode_time ,
+                " (*)" if key == encoding else ""
+            ) )
+        return "\n".join( lines )
@@ -2,20 +2,30 @@ import sys
 import os
 import re
 import itertools
+import bisect
 import time
 import datetime
-import tempfile
-import locale
+import io
+import hashlib
+import json
+import threading
+import queue
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor , Future , wait
+from concurrent.futures.process import BrokenProcessPool
 from collections import namedtuple
 
 from PyQt5.QtWidgets import QMessageBox
 
 from pdfminer.pdfinterp import PDFResourceManager , PDFPageInterpreter
 from pdfminer.converter import PDFPageAggregator
-from pdfminer.layout import LAParams , LTTextBoxHorizontal
+from pdfminer.layout import LAParams , LTTextBoxHorizontal , LTChar
 from pdfminer.pdfpage import PDFPage
 
-from asl_cards.db import AslCard , AslCardImage
+from asl_cards.db import AslSourceFile , AslCard , classify_card
+from asl_cards import imaging
+from asl_cards import render
 
 # ---------------------------------------------------------------------
 
@@ -25,131 +35,745 @@ class AnalyzeCancelledException( RuntimeError ) :
 
 # ---------------------------------------------------------------------
 
-# NOTE: Ghostscript extracts PDF pages to image files - this value defines where to put them.
-_EXTRACTED_IMAGES_FILENAME_TEMPLATE = os.path.join( tempfile.gettempdir() , "asl_cards-%d.png" )
-
-def _find_extracted_image_files() :
-    """Find the image files extracted by Ghostscript."""
-    fnames = []
-    # NOTE: We assume there are never more than 500 of these.
-    # This method is used to clean up files left over from a previous (failed) run, so we can't
-    # just start at 1 and increment as we look for files. We could do some funky stuff with
-    # os.listdir() and regex's, but we need the extracted files in page order, and it's more
-    # trouble than it's worth... :-/
-    for i in range(1,500) :
-        fname = _EXTRACTED_IMAGES_FILENAME_TEMPLATE % i
-        if os.path.isfile( fname ) :
-            fnames.append( fname )
-    return fnames
-
-def _run_ghostscript( args ) :
-    """Run Ghostscript.
-
-    We have to do a bit of stuffing around to stop Ghostscript from printing warnings to the console.
-    This code was adapted from ghostscript's _gsprint.py.
+# NOTE: Ghostscript writes the rendered pages to its stdout, and we pick them up from there (rather than
+# having it write them out to temp files), so this defines how many pages we will buffer while we wait
+# for the cropper to catch up.
+_MAX_QUEUED_PAGES = 4
+
+# NOTE: When rendering in parallel, files are split into ranges of this many pages, each of which
+# is rendered by a separate worker.
+_DEFAULT_SHARD_PAGES = 8
+
+# NOTE: When streaming cards (see PdfParser.iter_cards()), this limits how many card images the worker pool
+# can extract ahead of the caller.
+_DEFAULT_MAX_IMAGES = 256
+
+# NOTE: This is how long (in seconds) we wait for Ghostscript to stop, after the analysis has been cancelled.
+_CANCEL_TIMEOUT = 1.0
+
+# NOTE: If a worker process crashes (e.g. because Ghostscript fell over), we restart the worker pool, but give up
+# if it keeps happening.
+_MAX_POOL_RESTARTS = 2
+
+# NOTE: The worker processes are started fresh, rather than forked, since we are often running in a thread
+# of a multi-threaded (Qt) process, and forking from there can leave locks in the child that will never be released.
+_MP_START_METHOD = "spawn"
+
+# NOTE: When analyzing the layout of a page, we only need the info box in the top-left corner of each card
+# (there are 2 cards per page), so we ignore any text outside these regions. Each region is (left,top,right,bottom),
+# as fractions of the page's width and height, measured from the top-left corner.
+# NOTE: This is opt-in (see PdfParser), since if a card's info box falls outside these regions, the card is lost.
+CARD_HEADER_REGIONS = [ (0,0,0.5,0.3) , (0,0.5,0.5,0.8) ]
+
+# NOTE: Worker processes are given an event that gets set when the analysis is cancelled.
+_worker_cancel_event = None
+
+def _render_pages( fname , image_res , first_page , last_page , is_cancelled=None , backend=None , profile=None ) :
+    """Render a range of pages from a PDF file.
+
+    Ghostscript runs in a background thread, and each page is yielded (as PNG data) as soon as
+    it has been rendered, so the caller can work on it while Ghostscript renders the next one.
+
+    If an is_cancelled handler is given, it is checked while we wait for each page, and Ghostscript
+    is stopped if it returns True.
     """
-    # allocate a new Ghostscript instance
-    # NOTE: We only import the ghostscript stuff if it's needed (i.e. when we get here), so that people
-    # can run this program without needing Ghostscript to be installed, if they already have a database.
-    import ghostscript
-    import ghostscript._gsprint as gsp
-    inst = gsp.new_instance()
-    # wrap stdin/stdout/stderr with dummy buffers
-    def wrap( stdin ) :
-        return gsp.c_stdstream_call_t(
-            lambda inst,buf,count: 0 if stdin else count
-        )
-    stdin_buf = wrap( True )
-    stdout_buf = wrap( False )
-    stderr_buf = wrap( False )
-    gsp.set_stdio( inst , stdin_buf , stdout_buf , stderr_buf )
+    pages = queue.Queue( maxsize=_MAX_QUEUED_PAGES )
+    stopping = threading.Event()
+    def put( item ) :
+        # queue the next item for the caller
+        # nb: if the caller has gone away, we stop waiting for them
+        while not stopping.is_set() :
+            try :
+                pages.put( item , timeout=0.1 )
+                return True
+            except queue.Full :
+                pass
+        return False
+    renderer = render.get_renderer( image_res , backend , profile )
+    def run_ghostscript() :
+        try :
+            renderer.render_pages( fname , first_page , last_page ,
+                stdout = _PngStreamSplitter(put).feed ,
+                poll = lambda: not stopping.is_set()
+            )
+        except Exception as ex :
+            put( ex )
+        else :
+            put( None )
+    thread = threading.Thread( target=run_ghostscript , daemon=True )
+    thread.start()
+    cancelled = False
     try :
-        # run Ghostscript
-        args = [ s.encode(locale.getpreferredencoding()) for s in args ]
-        __Ghostscript = getattr( ghostscript , "__Ghostscript" )
-        __Ghostscript( inst , args )
+        while True :
+            try :
+                item = pages.get( timeout=0.1 )
+            except queue.Empty :
+                if is_cancelled and is_cancelled() :
+                    cancelled = True
+                    raise AnalyzeCancelledException()
+                continue
+            if item is None :
+                break
+            if isinstance( item , Exception ) :
+                raise item
+            yield item
     finally :
-        # clean up
-        gsp.delete_instance( inst )
-        del inst
+        stopping.set()
+        # NOTE: If we've been cancelled, Ghostscript might be in the middle of rendering a page, and we don't
+        # want to wait for it. It will stop by the time the page has been rendered, and since the thread
+        # is a daemon, it won't stop the program from exiting.
+        thread.join( _CANCEL_TIMEOUT if cancelled else None )
+
+def _make_page_ranges( npages , shard_pages ) :
+    """Split the pages of a file into ranges (of at most the specified number of pages)."""
+    return [
+        ( first_page , min( first_page+shard_pages-1 , npages ) )
+        for first_page in range( 1 , npages+1 , shard_pages )
+    ]
+
+def _hash_file( fname ) :
+    """Generate a hash of a file's contents."""
+    hasher = hashlib.sha1()
+    with open( fname , "rb" ) as fp :
+        for buf in iter( lambda: fp.read( 1024*1024 ) , b"" ) :
+            hasher.update( buf )
+    return hasher.hexdigest()
+
+def _get_page_count( fname , render_backend=None ) :
+    """Get the number of pages in a PDF file."""
+    return render.get_page_count( fname , render_backend )
+
+class _PngStreamSplitter :
+    """Split a stream of PNG files (one after another, as written by Ghostscript) into separate images."""
+
+    _PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__( self , on_image ) :
+        # initialize
+        self.on_image = on_image # nb: called with the data for each PNG file
+        self._buf = bytearray()
+        self._pos = 0 # nb: where the next chunk starts in the current PNG file
+
+    def feed( self , data ) :
+        """Process the next block of data from the stream."""
+        self._buf.extend( data )
+        while True :
+            if self._pos == 0 :
+                # check that we are at the start of a new PNG file
+                if len(self._buf) < len(self._PNG_SIGNATURE) :
+                    return True
+                if not self._buf.startswith( self._PNG_SIGNATURE ) :
+                    raise RuntimeError( "Unexpected image data from Ghostscript." )
+                self._pos = len( self._PNG_SIGNATURE )
+            # check if we have the next chunk (length, type, data, CRC)
+            if len(self._buf) < self._pos + 8 :
+                return True
+            chunk_len = int.from_bytes( self._buf[ self._pos : self._pos+4 ] , "big" )
+            chunk_type = bytes( self._buf[ self._pos+4 : self._pos+8 ] )
+            chunk_end = self._pos + 12 + chunk_len
+            if len(self._buf) < chunk_end :
+                return True
+            self._pos = chunk_end
+            if chunk_type == b"IEND" :
+                # we have a complete PNG file - pass it on
+                buf = bytes( self._buf[ : chunk_end ] )
+                del self._buf[ : chunk_end ]
+                self._pos = 0
+                if self.on_image( buf ) is False :
+                    return False
+
+# ---------------------------------------------------------------------
+
+class _RegionPageAggregator( PDFPageAggregator ) :
+    """Only analyze the layout of the text in certain regions of a page (see CARD_HEADER_REGIONS)."""
+
+    def __init__( self , rsrcmgr , laparams , regions ) :
+        super().__init__( rsrcmgr , laparams=laparams )
+        self.regions = regions
+
+    def end_page( self , page ) :
+        # NOTE: Layout analysis is the slow part of parsing a page, and it gets a lot slower as the amount of text
+        # goes up, so we throw away everything we're not interested in before it happens. We only look at
+        # the top-level text boxes on a page, so we don't need anything else (e.g. lines or figures).
+        lt_page = self.cur_item
+        width , height = lt_page.width , lt_page.height
+        bboxes = [
+            ( width*left , height*(1-bottom) , width*right , height*(1-top) ) # nb: PDF coordinates start at the bottom
+            for left,top,right,bottom in self.regions
+        ]
+        def in_regions( item ) :
+            x , y = ( item.x0 + item.x1 ) / 2 , ( item.y0 + item.y1 ) / 2
+            return any( b[0] <= x <= b[2] and b[1] <= y <= b[3] for b in bboxes )
+        lt_page._objs = [ item for item in lt_page._objs if isinstance( item , LTChar ) and in_regions( item ) ]
+        super().end_page( page )
+
+# ---------------------------------------------------------------------
+
+class _LayoutCache :
+    """Cache the cards found on each page of a PDF file.
+
+    Analyzing the layout of a PDF page is insanely slow, so we save the cards we find on each page in a file,
+    keyed by the PDF's contents and the layout analysis parameters.
+    """
+
+    # NOTE: This needs to be changed if the way we parse pages changes.
+    _VERSION = 1
+
+    _CARD_ATTRS = [ "card_tag" , "nationality" , "name" , "page_id" , "page_pos" ]
+
+    def __init__( self , cache_dir , fname , laparams , regions=None ) :
+        # initialize
+        params = [ _LayoutCache._VERSION , vars(laparams) ]
+        if regions :
+            params.append( regions ) # nb: pages analyzed in full are keyed as they always have been
+        params = json.dumps( params , sort_keys=True )
+        self.fname = os.path.join( cache_dir , "{}-{}.json".format(
+            _hash_file( fname ) ,
+            hashlib.sha1( params.encode() ).hexdigest()[:16]
+        ) )
+        self.dirty = False
+        # load the cache
+        try :
+            with open( self.fname , "r" ) as fp :
+                self.pages = json.load( fp )
+        except ( IOError , ValueError ) :
+            self.pages = {}
+
+    def get( self , page_no ) :
+        """Get the cards for a page (or None, if the page isn't in the cache)."""
+        cards = self.pages.get( str(page_no) )
+        if cards is None :
+            return None
+        return [ AslCard( **card ) for card in cards ]
+
+    def put( self , page_no , cards ) :
+        """Save the cards for a page."""
+        self.pages[ str(page_no) ] = [
+            { a: getattr(card,a) for a in _LayoutCache._CARD_ATTRS }
+            for card in cards
+        ]
+        self.dirty = True
+
+    def save( self ) :
+        """Save the cache."""
+        if not self.dirty :
+            return
+        # NOTE: We write to a temp file first, in case multiple processes are working on the same PDF.
+        os.makedirs( os.path.dirname( self.fname ) , exist_ok=True )
+        temp_fname = "{}.{}.tmp".format( self.fname , os.getpid() )
+        with open( temp_fname , "w" ) as fp :
+            json.dump( self.pages , fp )
+        os.replace( temp_fname , self.fname )
+        self.dirty = False
+
+# ---------------------------------------------------------------------
+
+class _WorkerJobs :
+    """Manage the jobs for parsing files in a pool of worker processes.
+
+    Each file has a job to get its card details (or if the pages have to be parsed, a job for each range of pages),
+    and jobs to extract its card images, a range of pages at a time. The card image jobs are submitted in order, but only a limited number are allowed to be in flight (i.e. submitted,
+    but their results not yet taken), so that the card images don't pile up in memory.
+
+    If a worker process crashes, a new worker pool is started, and the jobs that were lost are re-submitted.
+    """
+
+    def __init__( self , pdf_parser , make_pool , image_res , image_encoding , max_image_jobs ) :
+        # initialize
+        self.pdf_parser = pdf_parser
+        self.make_pool = make_pool
+        self.pool = make_pool()
+        self.image_res = image_res
+        self.image_encoding = image_encoding
+        self.max_image_jobs = max_image_jobs
+        self.cards_jobs = {} # nb: the jobs to get the card details for each file
+        self.pending = collections.deque() # nb: image jobs that haven't been submitted yet
+        self.in_flight = collections.OrderedDict() # nb: image jobs that have been submitted, in page order
+        self.checkpoints = {} # nb: image jobs whose results need to be checkpointed
+        self.njobs = self.ndone = 0
+        self.nrestarts = 0
+
+    def add_file( self , fname , source_file , max_pages , shard_pages ) :
+        """Add the jobs for a file."""
+        # submit the jobs to get the card details
+        # NOTE: If there is no index file, we have to analyze the layout of each page, which is CPU-bound (and insanely slow),
+        # so we split the pages up between the worker processes, and merge the results back together in get_cards().
+        if self.pdf_parser._find_index_file( fname ) :
+            page_parse = None
+            jobs = [ ( _parse_file_worker , self.pdf_parser.index_dir , self.pdf_parser.layout_cache_dir , fname , max_pages ) ]
+        else :
+            page_parse = self.pdf_parser._start_page_parse( fname , max_pages )
+            page_nos = page_parse[2]
+            jobs = [
+                ( _parse_pages_worker , fname , page_nos[ i : i+shard_pages ] , self.pdf_parser.layout_regions )
+                for i in range( 0 , len(page_nos) , shard_pages )
+            ]
+        self.cards_jobs[ source_file ] = ( page_parse , [ [ job , self.pool.submit(*job) ] for job in jobs ] )
+        self.njobs += len(jobs)
+        if not self.image_res :
+            return
+        # queue the jobs to extract the card images
+        # NOTE: This lets large files be spread over multiple cores, instead of being rendered in one long
+        # Ghostscript run.
+        npages = _get_page_count( fname , self.pdf_parser.render_backend )
+        if max_pages > 0 :
+            npages = min( npages , max_pages )
+        for first_page,last_page in _make_page_ranges( npages , shard_pages ) :
+            self.pending.append( ( fname , source_file , first_page , last_page , npages ) )
+            self.njobs += 1
+        self._submit_image_jobs()
+
+    def get_cards( self , source_file ) :
+        """Get the card details for a file."""
+        page_parse , jobs = self.cards_jobs[ source_file ]
+        results = []
+        for job in jobs :
+            future = self._wait( lambda: job[1] )
+            results.append( future.result() )
+            self.ndone += 1
+        del self.cards_jobs[ source_file ]
+        if not page_parse :
+            return results[0]
+        # merge the cards from each range of pages
+        layout_cache , page_cards , _ = page_parse
+        parsed_cards = {}
+        for result in results :
+            parsed_cards.update( result )
+        return self.pdf_parser._finish_page_parse( layout_cache , page_cards , parsed_cards )
+
+    def iter_card_images( self , source_file ) :
+        """Get the card images for a file, a range of pages at a time."""
+        try :
+            while True :
+                self._submit_image_jobs()
+                job = next( ( j for j in self.in_flight if j[1] is source_file ) , None )
+                if not job :
+                    break
+                future = self._wait( lambda: self.in_flight[ job ] )
+                del self.in_flight[ job ]
+                self.ndone += 1
+                yield future.result()
+        finally :
+            # nb: if the caller stopped early (e.g. because of an error), we don't need the rest of the card images
+            self.discard_file( source_file )
+
+    def discard_file( self , source_file ) :
+        """Discard the remaining jobs for a file."""
+        _ , jobs = self.cards_jobs.pop( source_file , (None,[]) )
+        for job in jobs :
+            job[1].cancel()
+            self.njobs -= 1
+        for job in [ j for j in self.in_flight if j[1] is source_file ] :
+            # nb: jobs that are already running will still get checkpointed
+            self.in_flight.pop( job ).cancel()
+            self.njobs -= 1
+        pending = [ j for j in self.pending if j[1] is not source_file ]
+        self.njobs -= len(self.pending) - len(pending)
+        self.pending = collections.deque( pending )
+
+    def cancel( self ) :
+        """Cancel all outstanding jobs."""
+        for future in itertools.chain( self._cards_futures() , self.in_flight.values() ) :
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown( self ) :
+        """Shut down the worker pool."""
+        self.pool.shutdown()
+
+    def _cards_futures( self ) :
+        """Get the futures for the outstanding card details jobs."""
+        return ( job[1] for _,jobs in self.cards_jobs.values() for job in jobs )
+
+    def _submit_image_job( self , job ) :
+        """Submit a job to extract the card images from a range of pages."""
+        fname , source_file , first_page , last_page , npages = job
+        future = self.pool.submit( _extract_images_worker ,
+            fname , self.image_res , self.image_encoding , first_page , last_page , npages ,
+            self.pdf_parser.render_backend , self.pdf_parser.render_profile
+        )
+        self.checkpoints[ future ] = ( source_file , first_page , last_page )
+        return future
+
+    def _submit_image_jobs( self ) :
+        """Submit image jobs to the worker pool (up to our limit)."""
+        while self.pending and len(self.in_flight) < self.max_image_jobs :
+            job = self.pending.popleft()
+            fname , source_file , first_page , last_page , npages = job
+            card_images = self.pdf_parser._load_checkpoint( source_file , first_page , last_page )
+            if card_images is not None :
+                # nb: we already have the card images for these pages (from a previous analysis)
+                future = Future()
+                future.set_result( card_images )
+            else :
+                future = self._submit_image_job( job )
+            self.in_flight[ job ] = future
+
+    def _wait( self , get_future ) :
+        """Wait for a job to finish.
+
+        get_future returns the job's future, which will change if the job has to be re-submitted. The final one is returned.
+        """
+        while True :
+            self.pdf_parser._check_cancelled()
+            future = get_future()
+            # nb: progress2 tracks how much of the overall work the worker pool has done
+            ndone = self.ndone + sum(
+                1 for f in itertools.chain( self._cards_futures() , self.in_flight.values() ) if f.done()
+            )
+            self.pdf_parser._progress2( float(ndone) / max( self.njobs , 1 ) )
+            # nb: we save the card images as soon as each range of pages is done, not just for the file we're waiting on
+            self._save_checkpoints()
+            if wait( [future] , timeout=0.5 ).not_done :
+                continue
+            if _is_pool_broken( future ) :
+                self._restart_pool()
+                continue
+            break
+        self._save_checkpoints()
+        return future
+
+    def _restart_pool( self ) :
+        """Start a new worker pool, and re-submit the jobs that were lost when the old one broke."""
+        # NOTE: If a worker process dies, the pool can't be used any more, and all of its outstanding jobs fail.
+        # If this keeps happening, it's probably being caused by a particular file, so we give up.
+        if self.nrestarts >= _MAX_POOL_RESTARTS :
+            raise RuntimeError( "The worker processes keep crashing." )
+        self.nrestarts += 1
+        self.pool.shutdown( wait=False )
+        self.pool = self.make_pool()
+        for _,jobs in self.cards_jobs.values() :
+            for job in jobs :
+                if not job[1].done() or _is_pool_broken( job[1] ) :
+                    job[1] = self.pool.submit( *job[0] )
+        for job,future in list( self.in_flight.items() ) :
+            if not future.done() or _is_pool_broken( future ) :
+                self.checkpoints.pop( future , None )
+                self.in_flight[ job ] = self._submit_image_job( job )
+
+    def _save_checkpoints( self ) :
+        """Save the card images for the ranges of pages that the worker pool has finished."""
+        save_checkpoint = self.pdf_parser.save_checkpoint
+        for future in [ f for f in self.checkpoints if f.done() ] :
+            source_file , first_page , last_page = self.checkpoints.pop( future )
+            if save_checkpoint and not future.cancelled() and not future.exception() :
+                save_checkpoint( source_file , first_page , last_page , future.result() )
 
 # ---------------------------------------------------------------------
 
 class PdfParser:
 
-    def __init__( self , index_dir , progress=None , progress2=None , on_file_completed=None , on_ask=None , on_error=None ) :
+    def __init__( self , index_dir , progress=None , progress2=None , on_file_completed=None , on_ask=None , on_error=None , is_cached=None , layout_cache_dir=None , load_checkpoint=None , save_checkpoint=None , render_backend=None , render_profile=None , layout_regions=None ) :
         # initialize
         self.index_dir = index_dir
+        self.layout_cache_dir = layout_cache_dir # nb: where to cache the results of parsing PDF pages
         self.progress = progress # nb: for tracking file progress
         self.progress2 = progress2 # nb: for tracking page progress within a file
         self.on_file_completed = on_file_completed # nb: called at the end of each file
+        self.is_cached = is_cached # nb: for checking if the cards for a file are already available
         self.on_ask = on_ask # nb: for asking the user something during processing
         self.on_error = on_error # nb: for showing the user an error message
+        self.load_checkpoint = load_checkpoint # nb: for getting card images extracted by a previous (unfinished) analysis
+        self.save_checkpoint = save_checkpoint # nb: called each time a range of pages has been extracted
+        self.render_backend = render_backend # nb: how to render the pages (see render.get_backends())
+        self.render_profile = render_profile # nb: the quality/speed trade-off when rendering (see render.get_profiles())
+        self.layout_regions = layout_regions # nb: which parts of each page to analyze (None = the whole page)
+        self.encoding_report = None # nb: compares the image encodings, for the last parse
         self.cancelling = False
 
-    def parse( self , target , max_pages=-1 , image_res=None ) :
-        """Extract the cards from a PDF file."""
-        # FUDGE! The Qt directory browser always returns paths using forward slashes, which confuses Ghostscript :-/
-        if sys.platform == "win32" and target.startswith("//") :
-            target = target.replace( "/" , "\\" )
-        # locate the files we're going to parse
-        if os.path.isfile( target ) :
-            fnames = [ target ]
-        else :
-            fnames = [
-                os.path.join( target , f )
-                for f in os.listdir( target )
-                if os.path.splitext( f )[1].lower() == ".pdf"
-            ]
-        # parse each file
+    def parse( self , target , max_pages=-1 , image_res=None , workers=1 , shard_pages=_DEFAULT_SHARD_PAGES , lazy_images=False , image_encoding=None ) :
+        """Extract the cards from a PDF file.
+
+        If more than one worker is requested, each file is analyzed in its own worker process (or if it has no index file,
+        its pages are split up between the worker processes), and the card images are extracted in separate worker processes,
+        each of which renders a range of pages.
+
+        If lazy_images is set, the card images are not extracted, but the resolution is recorded with each card's
+        source file, so that they can be extracted later (see extract_card_images()).
+
+        Card images are extracted a range of pages at a time, and if checkpoint handlers were given, each range
+        is saved as it is completed, so that an analysis that doesn't finish can be resumed.
+
+        The card images are stored using the specified image encoding (see imaging.get_encodings()). After the parse,
+        encoding_report has a comparison of how each encoding does on a sample of the extracted images.
+        """
         cards = []
-        start_time = time.time()
-        for file_no,fname in enumerate(fnames) :
-            if self.cancelling : raise AnalyzeCancelledException()
+        for fname,source_file,file_cards in self._iter_files( target , max_pages , image_res , workers , shard_pages , lazy_images , image_encoding , _DEFAULT_MAX_IMAGES ) :
             try :
-                file_cards = self._do_parse_file( float(file_no)/len(fnames) , fname , max_pages , image_res )
-                if file_cards is None :
-                    continue
+                file_cards = list( file_cards )
             except AnalyzeCancelledException as ex :
                 raise
             except Exception as ex :
-                if str(ex).lower().find( "can not find ghostscript dll" ) >= 0 :
-                    # NOTE: We get a RuntimeError if Ghostscript is not installed :-/
-                    # We bail, since there's no point trying to parse any more files.
-                    raise
-                # notify the caller of the error
-                if not self.on_error :
-                    raise
-                self.on_error(
-                    "An error occured while processing {}:\n\n{}\n\nThis file will be ignored.".format(
-                        os.path.split(fname)[1] , str(ex)
-                    )
-                )
+                self._on_file_error( fname , ex )
                 continue
-            # filter out placeholder cards
-            file_cards = [ c for c in file_cards if c.nationality != "_unused_" and c.name != "_unused_" ]
             # notify the caller we've finished another file
             if self.on_file_completed :
                 self.on_file_completed( fname , file_cards )
             if file_cards :
                 cards.extend( file_cards )
+        return cards
+
+    def iter_cards( self , target , max_pages=-1 , image_res=None , workers=1 , shard_pages=_DEFAULT_SHARD_PAGES , lazy_images=False , image_encoding=None , max_images=_DEFAULT_MAX_IMAGES ) :
+        """Extract the cards from a PDF file, yielding each one as soon as its image has been extracted.
+
+        This works the same way as parse(), except that the cards are not collected, so memory usage stays flat,
+        no matter how many files there are. max_images limits how many card images the worker pool can extract
+        ahead of the caller.
+
+        on_file_completed is called (with None for the cards) after the last card for each file has been yielded.
+        If an error occurs part-way through a file, on_error is called, and no more cards are yielded for it.
+        """
+        for fname,source_file,file_cards in self._iter_files( target , max_pages , image_res , workers , shard_pages , lazy_images , image_encoding , max_images ) :
+            try :
+                for card in file_cards :
+                    yield card
+            except AnalyzeCancelledException as ex :
+                raise
+            except Exception as ex :
+                self._on_file_error( fname , ex )
+                continue
+            # notify the caller we've finished another file
+            if self.on_file_completed :
+                self.on_file_completed( fname , None )
+
+    def _iter_files( self , target , max_pages , image_res , workers , shard_pages , lazy_images , image_encoding , max_images ) :
+        """Parse each file.
+
+        For each file, this yields its source file and a generator for its cards, which yields each card as soon as
+        its image has been extracted (and raises an exception if something goes wrong).
+        """
+        # locate the files we're going to parse
+        fnames = find_pdf_files( target )
+        # parse each file
+        start_time = time.time()
+        extract_res = None if lazy_images else image_res
+        image_encoding = image_encoding or imaging.DEFAULT_ENCODING
+        self.encoding_report = imaging.EncodingReport() if extract_res else None
+        # NOTE: Getting the card details from an index file is quick, so there's no point starting up
+        # the worker processes if that's all we need to do.
+        if workers > 1 and ( extract_res or not all( self._find_index_file(f) for f in fnames ) ) :
+            yield from self._iter_files_parallel( fnames , max_pages , image_res , extract_res , image_encoding , workers , shard_pages , max_images )
+        else :
+            # NOTE: The same Ghostscript instance is used to render all the files, and we shut it down at the end
+            # of the analysis (in a worker pool, each worker process has its own, which goes away with the process).
+            try :
+                for file_no,fname in enumerate(fnames) :
+                    self._check_cancelled()
+                    pval = float(file_no) / len(fnames)
+                    try :
+                        source_file = self._make_source_file( fname , image_res , extract_res , image_encoding )
+                        if self._check_cached( pval , source_file ) :
+                            continue
+                        file_cards = self._do_parse_file( pval , fname , max_pages )
+                        if file_cards is None :
+                            continue
+                        _classify_cards( file_cards )
+                    except AnalyzeCancelledException as ex :
+                        raise
+                    except Exception as ex :
+                        self._on_file_error( fname , ex )
+                        continue
+                    if extract_res :
+                        image_chunks = self._iter_file_images( pval , fname , source_file , extract_res , image_encoding , max_pages , shard_pages )
+                    else :
+                        image_chunks = None
+                    yield fname , source_file , self._iter_file_cards( fname , source_file , file_cards , image_chunks )
+            finally :
+                render.close_renderer()
         self._progress( 1.0 , "Done." )
         elapsed_time = int( time.time() - start_time )
         #print( "Elapsed time: {}".format( datetime.timedelta( seconds=elapsed_time ) ) )
-        return cards
 
-    def _do_parse_file( self , pval , fname , max_pages , image_res ) :
-        cards = []
-        # check if we have an index for this file
-        # NOTE: We originally tried to get the details of each card by parsing the PDF files but unfortunately,
-        # the text was coming out garbled. We allow corrections to be supplied in an external file, but if we're
-        # going to do that, we might as well not bother parsing the PDF :-/ (especially since it's so insanely slow).
+    def _iter_files_parallel( self , fnames , max_pages , image_res , extract_res , image_encoding , workers , shard_pages , max_images ) :
+        """Parse the files in a pool of worker processes."""
+        # check which files we already have the cards for
+        # NOTE: As with a serial parse, we do this before asking the user anything, so that they don't get asked
+        # about files we already have the cards for.
+        source_files = []
+        for file_no,fname in enumerate(fnames) :
+            try :
+                source_file = self._make_source_file( fname , image_res , extract_res , image_encoding )
+            except Exception as ex :
+                source_file = ex
+            else :
+                if self._check_cached( float(file_no)/len(fnames) , source_file ) :
+                    continue
+                # NOTE: We can't ask the user anything from inside a worker process, so we check up-front
+                # which of the files without an index file they want us to parse.
+                if not self._find_index_file( fname ) and not self._ask_parse_pdf( fname ) :
+                    continue
+            source_files.append( ( fname , source_file ) )
+        if not source_files :
+            return
+        # NOTE: The worker processes check this event, so that they stop as soon as the analysis is cancelled
+        # (rather than running their current job to completion).
+        mp_context = multiprocessing.get_context( _MP_START_METHOD )
+        cancel_event = mp_context.Event()
+        make_pool = lambda: ProcessPoolExecutor( max_workers=workers , mp_context=mp_context , initializer=_init_worker , initargs=(cancel_event,) )
+        # start the jobs for each file
+        # NOTE: The card details are quick to get, and small, so we start those jobs straight away, but we limit
+        # how many ranges of pages can be in flight, so that the card images don't pile up in memory
+        # if the caller is slower than the worker pool.
+        jobs = _WorkerJobs( self , make_pool , extract_res , image_encoding ,
+            max( max_images // ( 2 * shard_pages ) , 1 ) # nb: there are normally 2 cards per page
+        )
+        try :
+            for i,(fname,source_file) in enumerate( source_files ) :
+                if isinstance( source_file , Exception ) :
+                    continue
+                try :
+                    jobs.add_file( fname , source_file , max_pages , shard_pages )
+                except Exception as ex :
+                    jobs.discard_file( source_file )
+                    source_files[i] = ( fname , ex )
+            # NOTE: The files are processed concurrently, but we return the results in order, so that
+            # the caller sees the same sequence of cards as for a serial parse.
+            for file_no,(fname,source_file) in enumerate( source_files ) :
+                self._progress( float(file_no)/len(source_files) , "Analyzing {}...".format( os.path.split(fname)[1] ) )
+                try :
+                    if isinstance( source_file , Exception ) :
+                        raise source_file
+                    file_cards = jobs.get_cards( source_file )
+                    _classify_cards( file_cards )
+                except AnalyzeCancelledException as ex :
+                    raise
+                except Exception as ex :
+                    jobs.discard_file( source_file )
+                    self._on_file_error( fname , ex )
+                    continue
+                image_chunks = jobs.iter_card_images( source_file ) if extract_res else None
+                yield fname , source_file , self._iter_file_cards( fname , source_file , file_cards , image_chunks )
+        except :
+            # nb: don't start any more work, and tell the jobs that are already running to stop
+            # NOTE: We also get here if the caller stops iterating over the cards.
+            cancel_event.set()
+            jobs.cancel()
+            raise
+        finally :
+            jobs.shutdown()
+
+    def _iter_file_cards( self , fname , source_file , cards , image_chunks ) :
+        """Attach the card images to a file's cards, yielding each card as soon as it has its image.
+
+        image_chunks yields lists of card images, in page order (or is None, if the card images are not being extracted).
+        """
+        if image_chunks is None :
+            for card in cards :
+                if not _is_placeholder_card( card ) :
+                    card.source_file = source_file
+                    yield card
+            return
+        nimages = 0
+        for card_images in image_chunks :
+            if self.encoding_report :
+                self.encoding_report.add_images( [ levels[0][2] for levels in card_images ] , fname )
+            for levels in card_images :
+                self._check_cancelled()
+                # NOTE: We will only know if the number of cards and card images match after we've seen them all,
+                # so we just stop yielding cards if there are too many card images.
+                if nimages < len(cards) :
+                    card = cards[ nimages ]
+                    cards[ nimages ] = None # nb: so that we don't hang on to the card images
+                    card.set_card_image( levels )
+                    if not _is_placeholder_card( card ) :
+                        card.source_file = source_file
+                        yield card
+                nimages += 1
+        if nimages != len(cards) :
+            raise RuntimeError(
+                "Card mismatch in {}: found {} cards, {} card images.".format(
+                    fname , len(cards) , nimages
+                )
+            )
+
+    def _iter_file_images( self , pval , fname , source_file , image_res , image_encoding , max_pages , shard_pages ) :
+        """Extract the card images from a file, a page at a time."""
+        self._progress( pval , "Extracting images from {}...".format( os.path.split(fname)[1] ) )
+        npages = _get_page_count( fname , self.render_backend )
+        if max_pages > 0 :
+            npages = min( npages , max_pages )
+        # NOTE: We render the file a range of pages at a time, so that we can checkpoint our progress.
+        for first_page,last_page in _make_page_ranges( npages , shard_pages ) :
+            range_images = self._load_checkpoint( source_file , first_page , last_page )
+            if range_images is not None :
+                yield range_images
+                continue
+            range_images = [] if self.save_checkpoint else None
+            for card_images in self._iter_images( fname , image_res , image_encoding , first_page , last_page , npages ) :
+                if range_images is not None :
+                    range_images.extend( card_images )
+                yield card_images
+            if self.save_checkpoint :
+                self.save_checkpoint( source_file , first_page , last_page , range_images )
+
+    def _make_source_file( self , fname , image_res , extract_res , image_encoding ) :
+        """Record the details of a file we are going to parse."""
+        # NOTE: We record everything that affects the cards we extract from the file, so that we can tell
+        # later if we need to parse it again.
+        index_fname = self._find_index_file( fname )
+        return AslSourceFile(
+            fname = os.path.abspath( fname ) ,
+            content_hash = _hash_file( fname ) ,
+            index_hash = _hash_file( index_fname ) if index_fname else None ,
+            image_res = image_res ,
+            images_extracted = extract_res is not None , # nb: for a lazy build, the images are extracted later
+            image_encoding = image_encoding ,
+            render_backend = render.get_backend_class( self.render_backend ).name if image_res else None ,
+            render_profile = ( self.render_profile or render.DEFAULT_PROFILE ) if image_res else None
+        )
+
+    def _check_cached( self , pval , source_file ) :
+        """Check if the caller already has the cards for a file."""
+        if not self.is_cached or not self.is_cached( source_file ) :
+            return False
+        self._progress( pval , "Using the existing cards for {}...".format( os.path.split(source_file.fname)[1] ) )
+        return True
+
+    def _on_file_error( self , fname , ex ) :
+        """Handle an error that occurred while processing a file."""
+        if str(ex).lower().find( "can not find ghostscript dll" ) >= 0 :
+            # NOTE: We get a RuntimeError if Ghostscript is not installed :-/
+            # We bail, since there's no point trying to parse any more files.
+            raise ex
+        # notify the caller of the error
+        if not self.on_error :
+            raise ex
+        self.on_error(
+            "An error occured while processing {}:\n\n{}\n\nThis file will be ignored.".format(
+                os.path.split(fname)[1] , str(ex)
+            )
+        )
+
+    def _find_index_file( self , fname ) :
+        """Check if we have an index file for the specified PDF."""
         split = os.path.split( fname )
         index_fname = os.path.join(
             self.index_dir if self.index_dir else "" ,
             os.path.splitext(split[1])[0]+".txt"
         )
-        if os.path.isfile( index_fname ) :
+        return index_fname if os.path.isfile( index_fname ) else None
+
+    def _ask_parse_pdf( self , fname ) :
+        """Ask the user if they want to try parsing a PDF that has no index file."""
+        if not self.on_ask :
+            return True
+        rc = self.on_ask(
+            "Can't find an index file for {}.\n\nDo you want to try parsing the PDF (slow and unreliable)?".format(
+                os.path.split( fname )[ 1 ]
+            ) ,
+            QMessageBox.Yes | QMessageBox.No , QMessageBox.No
+        )
+        return rc == QMessageBox.Yes
+
+    def _do_parse_file( self , pval , fname , max_pages ) :
+        """Get the card details from a file."""
+        cards = []
+        # check if we have an index for this file
+        # NOTE: We originally tried to get the details of each card by parsing the PDF files but unfortunately,
+        # the text was coming out garbled. We allow corrections to be supplied in an external file, but if we're
+        # going to do that, we might as well not bother parsing the PDF :-/ (especially since it's so insanely slow).
+        index_fname = self._find_index_file( fname )
+        if index_fname :
             # yup - just generate the AslCard's from that
             # NOTE: It would be nice to store these files as JSON, or something similar, but we want
             # to keep them easy for end-users to change, if some values need to be tweaked.
@@ -167,20 +791,13 @@ class PdfParser:
                     card_tag = fields[0] ,
                     nationality = fields[1] ,
                     name = fields[2] ,
-                    page_id = 1 + ncards/2 ,
+                    page_id = 1 + ncards//2 ,
                     page_pos = ncards % 2
                 ) )
         else :
             # ask the user if they want to try parsing the PDF
-            if self.on_ask :
-                rc = self.on_ask(
-                    "Can't find an index file for {}.\n\nDo you want to try parsing the PDF (slow and unreliable)?".format(
-                        os.path.split( fname )[ 1 ]
-                    ) ,
-                    QMessageBox.Yes | QMessageBox.No , QMessageBox.No
-                )
-                if rc != QMessageBox.Yes :
-                    return None
+            if not self._ask_parse_pdf( fname ) :
+                return None
             # extract each AslCard from the file
             # NOTE: Some of the PDF's have cards that have not been filled out - we detect this correctly (because
             # they don't have a "Vehicle" or "Ordnance" tag, but we barf later because the image extractor thinks
@@ -188,61 +805,81 @@ class PdfParser:
             # It's not really worth fixing this, since we're now using index files instead of extracting the info
             # from the PDF's (because extraction is giving such poor results :-/).
             self._progress( pval , "Analyzing {}...".format( os.path.split(fname)[1] ) )
-            rmgr = PDFResourceManager()
-            laparams = LAParams()
-            dev = PDFPageAggregator( rmgr , laparams=laparams )
-            interp = PDFPageInterpreter( rmgr , dev )
-            with open(fname,"rb") as fp :
-                pages = list( PDFPage.get_pages( fp ) )
-                for page_no,page in enumerate(pages) :
-                    if self.cancelling : raise AnalyzeCancelledException()
-                    self._progress2( float(page_no) / len(pages) )
-                    page_cards = self._parse_page( cards , interp , page_no , page )
-                    cards.extend( page_cards )
-                    if max_pages > 0 and 1+page_no >= max_pages :
-                        break
-        # extract the card images
-        if image_res :
-            self._progress( pval , "Extracting images from {}...".format( os.path.split(fname)[1] ) )
-            card_images = self._extract_images( fname , max_pages , image_res )
-            if len(cards) != len(card_images) :
-                raise RuntimeError(
-                    "Card mismatch in {}: found {} cards, {} card images.".format(
-                        fname , len(cards) , len(card_images)
-                    )
-                )
-            for i in range(0,len(cards)) :
-                if self.cancelling : raise AnalyzeCancelledException()
-                cards[i].card_image = AslCardImage( image_data=card_images[i] )
+            layout_cache , page_cards , page_nos = self._start_page_parse( fname , max_pages )
+            parsed_cards = {}
+            for i,(page_no,cards) in enumerate( self._parse_pages( fname , page_nos ) ) :
+                self._progress2( float(i) / len(page_nos) )
+                parsed_cards[ page_no ] = cards
+            cards = self._finish_page_parse( layout_cache , page_cards , parsed_cards )
         return cards
 
+    def _start_page_parse( self , fname , max_pages ) :
+        """Work out which pages of a file need to have their layout analyzed.
+
+        Returns the layout cache (or None), the cards we already have for each page (from the cache),
+        and the pages that still need to be analyzed (0-based).
+        """
+        layout_cache = _LayoutCache( self.layout_cache_dir , fname , LAParams() , self.layout_regions ) if self.layout_cache_dir else None
+        npages = _get_page_count( fname )
+        if max_pages > 0 :
+            npages = min( npages , max_pages )
+        page_cards = {}
+        for page_no in range( 0 , npages ) :
+            cards = layout_cache.get( page_no ) if layout_cache else None
+            if cards is not None :
+                page_cards[ page_no ] = cards
+        return layout_cache , page_cards , [ p for p in range(0,npages) if p not in page_cards ]
+
+    def _parse_pages( self , fname , page_nos ) :
+        """Analyze the layout of some pages in a file, and yield the cards found on each one."""
+        # NOTE: We set up our own resource manager and interpreter, so that this can be run in a worker process.
+        if not page_nos :
+            return
+        page_nos , last_page_no = set( page_nos ) , max( page_nos )
+        rmgr = PDFResourceManager()
+        if self.layout_regions :
+            dev = _RegionPageAggregator( rmgr , LAParams() , self.layout_regions )
+        else :
+            dev = PDFPageAggregator( rmgr , laparams=LAParams() )
+        interp = PDFPageInterpreter( rmgr , dev )
+        with open(fname,"rb") as fp :
+            for page_no,page in enumerate( PDFPage.get_pages( fp ) ) :
+                if page_no not in page_nos :
+                    continue
+                self._check_cancelled()
+                # nb: the device numbers the pages it sees, and we may have skipped some
+                dev.pageno = 1 + page_no
+                yield page_no , self._parse_page( None , interp , page_no , page )
+                if page_no >= last_page_no :
+                    break
+
+    def _finish_page_parse( self , layout_cache , page_cards , parsed_cards ) :
+        """Merge the cards from the pages we analyzed with the ones we already had, in page order."""
+        for page_no,cards in parsed_cards.items() :
+            page_cards[ page_no ] = cards
+            if layout_cache :
+                layout_cache.put( page_no , cards )
+        if layout_cache :
+            layout_cache.save()
+        return list( itertools.chain.from_iterable(
+            page_cards[ page_no ] for page_no in sorted( page_cards )
+        ) )
+
+    def _load_checkpoint( self , source_file , first_page , last_page ) :
+        """Get the card images for a range of pages, if they were extracted by a previous analysis."""
+        if not self.load_checkpoint or not source_file :
+            return None
+        return self.load_checkpoint( source_file , first_page , last_page )
+
     def _parse_page( self , cards , interp , page_no , page ) :
         """Extract the cards from a PDF page."""
         cards = []
         interp.process_page( page )
         lt_page = interp.device.get_result()
-        # locate the info box for each card (in the top-left corner)
-        info_boxes = []
-        for item in lt_page :
-            if self.cancelling : raise AnalyzeCancelledException()
-            if type(item) is not LTTextBoxHorizontal : continue
-            item_text = item.get_text().strip()
-            if item_text.startswith( ("Vehicle","Ordnance") ) :
-                info_boxes.append( [item] )
-        # get the details from each info box
-        for item in lt_page :
-            if self.cancelling : raise AnalyzeCancelledException()
-            if type(item) is not LTTextBoxHorizontal : continue
-            # check if the next item could be part of an info box - it must be within the left/right boundary
-            # of the first item (within a certain tolerance), and below it (but not too far)
-            eps = 50 # left/right tolerance
-            for info_box in info_boxes :
-                if item.x0 >= info_box[0].x0 - eps and item.x1 <= info_box[0].x1 + eps \
-                    and item.y1 < info_box[0].y1 and info_box[0].y0 - item.y1 < 50 :
-                    # yup - save it
-                    info_box.append( item )
+        self._check_cancelled()
         # generate an AslCard from each info box
-        for info_box in info_boxes :
+        text_boxes = [ item for item in lt_page if type(item) is LTTextBoxHorizontal ]
+        for info_box in _find_info_boxes( text_boxes ) :
             card = self._make_asl_card( lt_page , info_box )
             cards.append( card )
         return cards
@@ -266,86 +903,63 @@ class PdfParser:
             page_pos = page_pos ,
         )
 
-    def _extract_images( self , fname , max_pages , image_res ) :
-        """Extract card images from a file."""
-        # clean up any leftover extracted images from a previous run
-        # NOTE: It's important we do this, otherwise we might think they're part of this run.
-        for f in _find_extracted_image_files() :
-            os.unlink( f )
-        # extract each page from the PDF as an image
-        args = [
-            "_ignored_" , "-dQUIET" , "-dSAFER" , "-dNOPAUSE" ,
-            "-sDEVICE=png16m" , "-r"+str(image_res) ,
-            "-sOutputFile="+_EXTRACTED_IMAGES_FILENAME_TEMPLATE
-        ]
-        if max_pages > 0 :
-            args.append( "-dLastPage={}".format(max_pages) )
-        args.extend( [ "-f" , fname ] )
-        _run_ghostscript( args )
-        image_fnames = _find_extracted_image_files()
-        # extract the cards from each page
+    def _extract_images( self , fname , image_res , image_encoding , first_page , last_page , npages ) :
+        """Extract card images from a range of pages in a file (that has the specified number of pages)."""
+        return list( itertools.chain.from_iterable(
+            self._iter_images( fname , image_res , image_encoding , first_page , last_page , npages )
+        ) )
+
+    def _iter_images( self , fname , image_res , image_encoding , first_page , last_page , npages ) :
+        """Extract card images from a range of pages in a file, yielding the card images for each page."""
+        # extract the cards from each page (as Ghostscript renders them)
         from PIL import Image
-        card_images = []
-        for page_no,fname in enumerate(image_fnames) :
-            if self.cancelling : raise AnalyzeCancelledException()
+        pages = _render_pages( fname , image_res , first_page , last_page , is_cancelled=self._is_cancelled ,
+            backend=self.render_backend , profile=self.render_profile
+        )
+        for page_no,page_data in enumerate( pages , start=first_page-1 ) : # nb: page_no is 0-based
+            self._check_cancelled()
             # open the next page image
-            self._progress2( float(page_no) / len(image_fnames) )
-            img = Image.open( fname )
-            img_width , img_height = img.size
-            # extract the cards (by splitting the page in half)
-            fname2 = list( os.path.split( fname ) )
-            fname2[1] = os.path.splitext( fname2[1] )
-            ypos = img_height * 48/100 # nb: the cards are not perfectly aligned in the page
-            buf1 , size1 = self._crop_image(
-                img , (0,0,img_width,ypos) ,
-                os.path.join( fname2[0] , fname2[1][0]+"a"+fname2[1][1] )
-            )
-            buf2 , size2 = self._crop_image(
-                img , (0,ypos+1,img_width,img_height) ,
-                os.path.join( fname2[0] , fname2[1][0]+"b"+fname2[1][1] )
-            )
-            if not buf1 and not buf2 :
-                continue # nb: blank page
-            # check if this is the last page, and it has just 1 card (centred) on it (e.g. ItalianOrdnance.pdf)
-            cutoff = img_height / 4
-            if page_no == len(image_fnames)-1 and size1[1] < cutoff and size2[1] < cutoff :
-                # yup - extract it
-                buf , _ = self._crop_image(
-                    img , (0,0,img_width,img_height) ,
-                    os.path.join( fname2[0] , fname2[1][0]+"a"+fname2[1][1] )
-                )
-                card_images.append( buf )
-            else :
-                # nope - save the extracted card(s)
-                if buf1 :
-                    card_images.append( buf1 )
-                if buf2 :
-                    card_images.append( buf2 )
-            # clean up
-            os.unlink( fname )
-        return card_images
-
-    def _crop_image( self , img , bbox , fname ) :
-        # crop the image
-        rgn = img.crop( bbox )
-        # trim the cropped region
-        bgd_col = img.getpixel( (0,0) )
-        from PIL import Image , ImageChops
-        bgd_img = Image.new( img.mode , img.size , bgd_col )
-        diff = ImageChops.difference( rgn , bgd_img )
-        diff = ImageChops.add(diff, diff, 2.0, -100)
-        bbox = diff.getbbox()
-        if bbox :
-            # save the cropped image
-            rgn = rgn.crop( bbox )
-            rgn.save( fname )
-            with open( fname , "rb" ) as fp :
-                buf = fp.read()
-            os.unlink( fname )
-            return buf , rgn.size
+            self._progress2( float(page_no) / npages )
+            img = Image.open( io.BytesIO( page_data ) )
+            if img.mode not in ("L","RGB") :
+                # nb: some render profiles produce paletted pages, which don't crop and scale well
+                img = img.convert( "RGB" )
+            yield self._extract_page_images( img , page_no == npages-1 , image_encoding )
+
+    def _extract_page_images( self , img , is_last_page , image_encoding=None ) :
+        """Extract the card images from a page."""
+        # find the content in each half of the page
+        # NOTE: We find where everything is in a single pass over the page, then work out
+        # what to crop from that.
+        img_width , img_height = img.size
+        mask = imaging.make_content_mask( img )
+        ypos = img_height * 48 // 100 # nb: the cards are not perfectly aligned in the page
+        bbox1 = imaging.get_content_bounds( mask , (0,0,img_width,ypos) )
+        bbox2 = imaging.get_content_bounds( mask , (0,ypos+1,img_width,img_height) )
+        if not bbox1 and not bbox2 :
+            return [] # nb: blank page
+        # check if this is the last page, and it has just 1 card (centred) on it (e.g. ItalianOrdnance.pdf)
+        cutoff = img_height / 4
+        def height( bbox ) : return bbox[3] - bbox[1] if bbox else 0
+        if is_last_page and height(bbox1) < cutoff and height(bbox2) < cutoff :
+            # yup - extract it
+            bboxes = [ imaging.get_content_bounds( mask ) ]
         else :
-            # nb: we get here if the entire region is blank (e.g. the bottom half of a single-card page)
-            return None , None
+            # nope - extract the card(s)
+            # nb: one of the halves will be blank if there is only 1 card on the page
+            bboxes = [ b for b in (bbox1,bbox2) if b ]
+        return [ imaging.encode_image_levels( img.crop(bbox) , image_encoding ) for bbox in bboxes ]
+
+    def _is_cancelled( self ) :
+        """Check if the analysis has been cancelled."""
+        if _worker_cancel_event is not None and _worker_cancel_event.is_set() :
+            return True
+        return self.cancelling
+
+    def _check_cancelled( self ) :
+        """Stop processing if the analysis has been cancelled."""
+        if self._is_cancelled() :
+            raise AnalyzeCancelledException()
 
     def _progress( self , pval , msg ) :
         """Call the progress callback."""
@@ -358,5 +972,153 @@ class PdfParser:
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+def _find_info_boxes( text_boxes ) :
+    """Find the info box for each card on a page (in the top-left corner).
+
+    Each info box is returned as a list of text boxes, the first of which is the one with the card tag.
+    """
+    # locate the first text box of each info box
+    info_boxes = [
+        [ item ] for item in text_boxes
+        if item.get_text().strip().startswith( ("Vehicle","Ordnance") )
+    ]
+    if not info_boxes :
+        return []
+    # index the text boxes by their top edge
+    # NOTE: This lets us find the text boxes that are vertically in range of each info box with a binary search,
+    # instead of checking every text box against every info box.
+    index = sorted( range(len(text_boxes)) , key=lambda i: text_boxes[i].y1 )
+    index_y1 = [ text_boxes[i].y1 for i in index ]
+    # get the details from each info box
+    for info_box in info_boxes :
+        # check which items could be part of this info box - they must be within the left/right boundary
+        # of the first item (within a certain tolerance), and below it (but not too far)
+        eps = 50 # left/right tolerance
+        first = info_box[0]
+        start = bisect.bisect_right( index_y1 , first.y0 - 50 )
+        end = bisect.bisect_left( index_y1 , first.y1 )
+        for i in sorted( index[start:end] ) : # nb: we keep the items in page order
+            item = text_boxes[i]
+            if item.x0 >= first.x0 - eps and item.x1 <= first.x1 + eps :
+                # yup - save it
+                info_box.append( item )
+    return info_boxes
+
+def find_pdf_files( target ) :
+    """Find the PDF files to parse (target can be a file or a directory)."""
+    # FUDGE! The Qt directory browser always returns paths using forward slashes, which confuses Ghostscript :-/
+    if sys.platform == "win32" and target.startswith("//") :
+        target = target.replace( "/" , "\\" )
+    if os.path.isfile( target ) :
+        return [ target ]
+    return [
+        os.path.join( target , f )
+        for f in os.listdir( target )
+        if os.path.splitext( f )[1].lower() == ".pdf"
+    ]
+
+def benchmark_renderers( fnames , image_res , max_pages=-1 , backends=None , profile=None ) :
+    """Time how long each render backend takes to render the pages of some PDF files.
+
+    Returns a list of (backend, number of pages, elapsed time, error message). If a backend can't render a file,
+    it carries on with the next one, and the first error is returned.
+
+    Each backend is first checked (see check_renderer()), and isn't timed if it fails, since its numbers
+    wouldn't mean anything.
+    """
+    if backends is None :
+        backends = [ b[0] for b in render.get_backends() ]
+    results = []
+    for backend in backends :
+        try :
+            if fnames :
+                check_renderer( fnames[0] , image_res , backend , profile )
+        except Exception as ex :
+            results.append( ( backend , 0 , 0 , "Failed the renderer check: {}".format( ex ) ) )
+            continue
+        finally :
+            render.close_renderer()
+        npages , error = 0 , None
+        start_time = time.time()
+        for fname in fnames :
+            try :
+                last_page = _get_page_count( fname , backend )
+                if max_pages > 0 :
+                    last_page = min( last_page , max_pages )
+                for page_data in _render_pages( fname , image_res , 1 , last_page , backend=backend , profile=profile ) :
+                    npages += 1
+            except Exception as ex :
+                if not error :
+                    error = "{}: {}".format( os.path.split(fname)[1] , ex )
+        # nb: starting the backend is part of what we're timing, so each one starts from scratch
+        render.close_renderer()
+        results.append( ( backend , npages , time.time() - start_time , error ) )
+    return results
+
+def check_renderer( fname , image_res , backend=None , profile=None ) :
+    """Check that a render backend renders the right pages, when it's given several jobs in a row.
+
+    The file is rendered a page at a time, then all at once (using the same renderer), and a RuntimeError
+    is raised if the wrong number of pages comes back for any of them.
+    """
+    npages = min( _get_page_count( fname , backend ) , 3 )
+    for first_page,last_page in _make_page_ranges( npages , 1 ) + [ ( 1 , npages ) ] :
+        n = sum( 1 for _ in _render_pages( fname , image_res , first_page , last_page , backend=backend , profile=profile ) )
+        if n != last_page - first_page + 1 :
+            raise RuntimeError( "Got {} pages, when rendering pages {}-{} of {}.".format(
+                n , first_page , last_page , os.path.split(fname)[1]
+            ) )
+
+def extract_card_images( fname , image_res , page_id , image_encoding=None , render_backend=None , render_profile=None ) :
+    """Extract the card images from a single page of a PDF file.
+
+    This is used to extract card images on demand, for databases that were built without them. The images
+    are returned in page position order (see imaging.encode_image_levels()).
+    """
+    # NOTE: We rely on the card's page_id being correct, which will be the case if it came from an index file
+    # that matches the PDF (i.e. 2 cards per page, and no blank pages).
+    npages = _get_page_count( fname , render_backend )
+    if page_id < 1 or page_id > npages :
+        raise RuntimeError( "Invalid page ({}) for {}.".format( page_id , os.path.split(fname)[1] ) )
+    pdf_parser = PdfParser( None , render_backend=render_backend , render_profile=render_profile )
+    return pdf_parser._extract_images( fname , image_res , image_encoding , page_id , page_id , npages )
+
+def _classify_cards( cards ) :
+    """Classify a file's cards (see db.classify_card())."""
+    for card in cards :
+        if not _is_placeholder_card( card ) :
+            classify_card( card )
+
+def _is_placeholder_card( card ) :
+    """Check if a card is a placeholder (i.e. a card that has not been filled out)."""
+    return card.nationality == "_unused_" or card.name == "_unused_"
+
+def _is_pool_broken( future ) :
+    """Check if a job failed because its worker process died."""
+    return not future.cancelled() and isinstance( future.exception() , BrokenProcessPool )
+
+def _init_worker( cancel_event ) :
+    """Initialize a worker process."""
+    global _worker_cancel_event
+    _worker_cancel_event = cancel_event
+
+def _parse_file_worker( index_dir , layout_cache_dir , fname , max_pages ) :
+    """Get the card details from a file (in a worker process)."""
+    # NOTE: The parent process has already asked the user if files without an index file should be parsed,
+    # so we don't need any callbacks here.
+    pdf_parser = PdfParser( index_dir , layout_cache_dir=layout_cache_dir )
+    return pdf_parser._do_parse_file( 0 , fname , max_pages )
+
+def _parse_pages_worker( fname , page_nos , layout_regions ) :
+    """Get the cards from some of the pages in a file (in a worker process)."""
+    return dict( PdfParser( None , layout_regions=layout_regions )._parse_pages( fname , page_nos ) )
+
+def _extract_images_worker( fname , image_res , image_encoding , first_page , last_page , npages , render_backend , render_profile ) :
+    """Extract the card images from a range of pages in a file (in a worker process)."""
+    pdf_parser = PdfParser( None , render_backend=render_backend , render_profile=render_profile )
+    return pdf_parser._extract_images( fname , image_res , image_encoding , first_page , last_page , npages )
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
 _tidy_regex = re.compile( r"[,.()+-]" )
 def _tidy( val ) : return _tidy_regex.sub(" ",val).strip()
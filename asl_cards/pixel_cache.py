@@ -0,0 +1,171 @@
+""" Cache decoded card images in a memory-mapped file.
+
+Decoding a compressed card image takes a noticeable amount of time, so we keep a copy of the decoded pixels
+in a sidecar file (next to the database), which the viewer can map into memory, and show straight away.
+
+The file is a header, followed by a record for each cached image. Each record has a header that identifies
+the card and image level, followed by the raw pixel data (4 bytes per pixel, in R,G,B,X order, i.e. Qt's
+Format_RGBX8888, or Pillow's "RGBX" mode). The pixel data is 16-byte aligned, so that it can be used in-place.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+
+FILE_HEADER = b"ASLPIXC1"
+
+# NOTE: The record header contains: a marker, the card ID, the image level (its width, or 0 for the full-size image),
+# a fingerprint of where the card image came from, the image width, height and stride, and the size of the pixel data.
+_RECORD_HEADER = struct.Struct( "<4sII8sIIIQ" )
+_RECORD_MARKER = b"CARD"
+_ALIGNMENT = 16
+
+# NOTE: We stop adding images once the cache file gets this big (and start again the next time it's opened).
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# ---------------------------------------------------------------------
+
+class CachedPixels :
+    """Decoded pixels for a card image (in memory mapped from the cache file)."""
+
+    def __init__( self , width , height , stride , data ) :
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.data = data # nb: a read-only memoryview (that keeps the mapping alive)
+
+    def __str__( self ) :
+        return "CachedPixels[{}x{}|stride={}]".format( self.width , self.height , self.stride )
+
+# ---------------------------------------------------------------------
+
+class PixelCache :
+    """Cache of decoded card images, indexed by card ID."""
+
+    def __init__( self , fname , max_bytes=DEFAULT_MAX_BYTES ) :
+        # initialize
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self._index = {} # nb: { (card_id,level): (fingerprint,offset,width,height,stride,nbytes) }
+        # open the cache file
+        # NOTE: We only ever append to the file while it's open, since there may be mappings into
+        # any part of it (and truncating a mapped file makes accessing it crash the program).
+        if not os.path.isfile( fname ) :
+            open( fname , "wb" ).close()
+        self._fp = open( fname , "r+b" )
+        try :
+            self._load_index()
+        except :
+            self._fp.close()
+            raise
+
+    def close( self ) :
+        """Close the cache file."""
+        if self._fp :
+            self._fp.close()
+            self._fp = None
+        self._index = {}
+
+    def get( self , card , level=None ) :
+        """Get the decoded pixels for a card image (or None, if they're not in the cache)."""
+        fingerprint = get_card_fingerprint( card )
+        entry = self._index.get( ( card.card_id , level or 0 ) )
+        if not entry or not fingerprint or entry[0] != fingerprint :
+            return None
+        _ , offset , width , height , stride , nbytes = entry
+        # map the pixel data into memory
+        # nb: mappings have to start on a page boundary
+        map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mm = mmap.mmap( self._fp.fileno() , offset - map_offset + nbytes , access=mmap.ACCESS_READ , offset=map_offset )
+        return CachedPixels( width , height , stride , memoryview( mm )[ offset-map_offset : ] )
+
+    def put( self , card , level , width , height , stride , data ) :
+        """Add the decoded pixels for a card image to the cache.
+
+        Returns False if the image couldn't be cached.
+        """
+        fingerprint = get_card_fingerprint( card )
+        if not fingerprint or len(data) != stride * height or stride < width * 4 :
+            return False
+        # check if there's room for the image
+        offset = self._fp.seek( 0 , os.SEEK_END )
+        header_size = _align( _RECORD_HEADER.size )
+        data_size = _align( len(data) )
+        if offset + header_size + data_size > self.max_bytes :
+            return False
+        # add the image to the cache
+        # nb: any previous entry for this card/level is replaced (it's still in the file, but will never be used)
+        self._fp.write( _RECORD_HEADER.pack(
+            _RECORD_MARKER , card.card_id , level or 0 , fingerprint , width , height , stride , len(data)
+        ) )
+        self._fp.write( bytes( header_size - _RECORD_HEADER.size ) )
+        self._fp.write( data )
+        self._fp.write( bytes( data_size - len(data) ) )
+        self._fp.flush()
+        self._index[ ( card.card_id , level or 0 ) ] = ( fingerprint , offset+header_size , width , height , stride , len(data) )
+        return True
+
+    def _load_index( self ) :
+        """Load the index of the images in the cache file."""
+        fsize = self._fp.seek( 0 , os.SEEK_END )
+        self._fp.seek( 0 )
+        if fsize > self.max_bytes or self._fp.read( len(FILE_HEADER) ) != FILE_HEADER :
+            # the file is new, full, or not one of ours - start again
+            self._reset()
+            return
+        offset = _align( len(FILE_HEADER) )
+        header_size = _align( _RECORD_HEADER.size )
+        while offset < fsize :
+            self._fp.seek( offset )
+            buf = self._fp.read( _RECORD_HEADER.size )
+            if len(buf) == _RECORD_HEADER.size :
+                marker , card_id , level , fingerprint , width , height , stride , nbytes = _RECORD_HEADER.unpack( buf )
+            else :
+                marker = None
+            next_offset = offset + header_size + _align( nbytes ) if marker == _RECORD_MARKER else None
+            if next_offset is None or next_offset > fsize :
+                # NOTE: The program must've died while it was adding this image, so we throw it away.
+                self._fp.truncate( offset )
+                break
+            self._index[ ( card_id , level ) ] = ( fingerprint , offset+header_size , width , height , stride , nbytes )
+            offset = next_offset
+
+    def _reset( self ) :
+        """Start a new (empty) cache file."""
+        self._fp.seek( 0 )
+        self._fp.truncate()
+        self._fp.write( FILE_HEADER )
+        self._fp.write( bytes( _align( len(FILE_HEADER) ) - len(FILE_HEADER) ) )
+        self._fp.flush()
+        self._index = {}
+
+# ---------------------------------------------------------------------
+
+def get_cache_fname( db_fname ) :
+    """Get the name of the pixel cache file for a database."""
+    return os.path.splitext( db_fname )[0] + ".pixels"
+
+def get_card_fingerprint( card ) :
+    """Generate a fingerprint of where a card's image came from.
+
+    Card ID's can be re-used when a database is re-built, and a card's image can change when a new version
+    of its PDF is analyzed, so we also check that a cached image is for the same card image.
+    Returns None if the card can't be cached.
+    """
+    if card.image_hash :
+        return bytes.fromhex( card.image_hash )[ :8 ]
+    # nb: the card image hasn't been saved yet - we use where it will come from
+    source_file = card.source_file
+    if not source_file or not source_file.image_res :
+        return None
+    key = "|".join( str(v) for v in [
+        source_file.content_hash , source_file.image_res , source_file.image_encoding ,
+        source_file.render_backend , source_file.render_profile ,
+        card.page_id , card.page_pos
+    ] )
+    return hashlib.md5( key.encode() ).digest()[ :8 ]
+
+def _align( val ) :
+    """Round a value up to our alignment."""
+    return ( val + _ALIGNMENT - 1 ) // _ALIGNMENT * _ALIGNMENT
@@ -0,0 +1,423 @@
+""" Render the pages of PDF files.
+"""
+
+import os
+import io
+import threading
+import ctypes
+import locale
+import hashlib
+import collections
+
+from pdfminer.pdfinterp import PDFResourceManager , PDFPageInterpreter
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LTChar , LTContainer
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdftypes import resolve1
+
+# NOTE: Ghostscript only supports one instance per process :-/
+_ghostscript_lock = threading.Lock()
+
+# NOTE: Each process keeps a renderer running, so that it can be re-used for each range of pages it is asked to render.
+_renderer = None
+_renderer_lock = threading.Lock()
+
+# ---------------------------------------------------------------------
+
+# NOTE: A render profile trades off quality against speed:
+# - device: the Ghostscript output device (png256 produces paletted images, which are much smaller and quicker
+#     to write out and decode, and the cards use few enough colours that they still look OK)
+# - text_alpha_bits/graphics_alpha_bits: how much anti-aliasing to do (1 = none, 4 = the most)
+# - rendering_threads: how many threads Ghostscript uses to render the bands of a page
+# - buffer_space: the size of the band buffer, in bytes (bigger bands means less overhead per page)
+# Settings of None are left at Ghostscript's defaults.
+RenderProfile = collections.namedtuple( "RenderProfile" , [
+    "caption" , "device" , "text_alpha_bits" , "graphics_alpha_bits" , "rendering_threads" , "buffer_space"
+] )
+
+# NOTE: The default profile renders the pages the way we always have (without any anti-aliasing), so that
+# the other profiles are opt-in.
+_PROFILES = collections.OrderedDict( [
+    ( "standard" , RenderProfile( "Standard" , "png16m" , None , None , None , None ) ) ,
+    ( "fast-draft" , RenderProfile( "Fast (draft)" , "png256" , 1 , 1 , 4 , 64*1024*1024 ) ) ,
+    ( "balanced" , RenderProfile( "Balanced" , "png16m" , 4 , 2 , 2 , 16*1024*1024 ) ) ,
+    ( "archival" , RenderProfile( "Archival (best quality)" , "png16m" , 4 , 4 , None , None ) ) ,
+] )
+DEFAULT_PROFILE = "standard"
+
+def get_profiles() :
+    """Get the available render profiles."""
+    return [ ( key , vals.caption ) for key,vals in _PROFILES.items() ]
+
+def get_profile( profile=None ) :
+    """Get the settings for a render profile (or the default one, if none is specified)."""
+    try :
+        return _PROFILES[ profile or DEFAULT_PROFILE ]
+    except KeyError :
+        raise RuntimeError( "Unknown render profile: {}".format( profile ) )
+
+# ---------------------------------------------------------------------
+
+class RenderBackend :
+    """Base class for the backends that render PDF pages.
+
+    A backend renders pages at a fixed resolution (image_res, in dpi) and render profile, and writes them out
+    as a stream of PNG data.
+    """
+
+    name = None
+    caption = None
+    is_synthetic = False # nb: set for backends that don't really render the PDF (so they never get used by default)
+
+    def __init__( self , image_res , profile=None ) :
+        self.image_res = image_res
+        self.profile = profile or DEFAULT_PROFILE
+        self.profile_settings = get_profile( profile )
+
+    @classmethod
+    def is_available( cls ) :
+        """Check if the backend can be used."""
+        return True
+
+    @classmethod
+    def page_count( cls , fname ) :
+        """Get the number of pages in a PDF file."""
+        with open( fname , "rb" ) as fp :
+            doc = PDFDocument( PDFParser( fp ) )
+            return resolve1( doc.catalog["Pages"] )[ "Count" ]
+
+    def render_pages( self , fname , first_page , last_page , stdout , poll=None ) :
+        """Render a range of pages from a PDF file.
+
+        Each page is passed (as PNG data) to the stdout handler, which can return False to abort the job. If a poll
+        handler is given, it is called periodically while rendering, and can also return False to abort the job.
+        """
+        raise NotImplementedError()
+
+    def close( self ) :
+        """Release any resources held by the backend."""
+        pass
+
+# ---------------------------------------------------------------------
+
+class GhostscriptRenderer( RenderBackend ) :
+    """A long-lived Ghostscript instance, that renders pages from PDF files.
+
+    Starting Ghostscript (loading its initialization files, fonts, etc.) takes a significant amount of time, so rather
+    than starting a new instance for every file, we start one, then feed it a PostScript command for each range of pages
+    we want rendered. If anything goes wrong, the instance is thrown away, and a new one started for the next job.
+
+    Jobs are cancelled by the poll handler (see render_pages()). Newer versions of Ghostscript no longer have
+    gsapi_set_poll(), in which case the poll handler is checked each time Ghostscript writes out some data, and the job
+    is aborted by having the stdout handler return an error, which means the current page is always finished first.
+    """
+
+    name = "ghostscript"
+    caption = "Ghostscript"
+
+    def __init__( self , image_res , profile=None ) :
+        # initialize
+        super().__init__( image_res , profile )
+        self.nstarts = 0 # nb: how many times we've had to start Ghostscript
+        self._inst = None
+        self._callbacks = None
+        self._read_dirs = set()
+        self._stdout = self._poll = None
+        self._has_poll = False # nb: if Ghostscript will call our poll handler (see _start())
+        self._errors = []
+
+    @classmethod
+    def is_available( cls ) :
+        try :
+            import ghostscript._gsprint
+        except Exception : # nb: this fails if the Ghostscript library can't be found, as well as if the module isn't installed
+            return False
+        return True
+
+    def render_pages( self , fname , first_page , last_page , stdout , poll=None ) :
+        fname = os.path.abspath( fname )
+        with _ghostscript_lock :
+            # make sure we have a working Ghostscript instance
+            # NOTE: When running in SAFER mode, Ghostscript will only read files from the directories it was started with,
+            # so we have to restart it if we're given a file from somewhere new.
+            dname = os.path.dirname( fname )
+            if dname not in self._read_dirs :
+                self._read_dirs.add( dname )
+                self._stop()
+            if self._inst is not None and not self._ping() :
+                self._stop()
+            if self._inst is None :
+                self._start()
+            # render the pages
+            # nb: the page range is defined inside a save/restore, so that it doesn't carry over to the next job
+            cmd = "save /FirstPage {} def /LastPage {} def ({}) (r) file runpdf restore\n".format(
+                first_page , last_page , _escape_ps_string( fname )
+            )
+            self._stdout , self._poll = stdout , poll
+            try :
+                self._run_string( cmd )
+            except :
+                # nb: we don't know what state Ghostscript has been left in, so we start a new instance next time
+                self._stop()
+                raise
+            finally :
+                self._stdout = self._poll = None
+
+    def ping( self ) :
+        """Check if Ghostscript is running, and responding to commands."""
+        with _ghostscript_lock :
+            return self._ping()
+
+    def close( self ) :
+        """Shut down Ghostscript."""
+        with _ghostscript_lock :
+            self._stop()
+
+    def _start( self ) :
+        """Start a new Ghostscript instance."""
+        # NOTE: We only import the ghostscript stuff if it's needed (i.e. when we get here), so that people
+        # can run this program without needing Ghostscript to be installed, if they already have a database.
+        import ghostscript._gsprint as gsp
+        inst = gsp.new_instance()
+        try :
+            # wrap stdin/stdout/stderr
+            # NOTE: We have to do a bit of stuffing around to stop Ghostscript from printing warnings to the console.
+            # This code was adapted from ghostscript's _gsprint.py.
+            def wrap( stdin ) :
+                return gsp.c_stdstream_call_t(
+                    lambda inst,buf,count: 0 if stdin else count
+                )
+            stdin_buf , stdout_buf , stderr_buf = wrap( True ) , gsp.c_stdstream_call_t( self._on_stdout ) , wrap( False )
+            gsp.set_stdio( inst , stdin_buf , stdout_buf , stderr_buf )
+            # NOTE: The ghostscript module doesn't wrap gsapi_set_poll(), so we call it ourself. It has been removed
+            # from newer versions of Ghostscript, in which case the stdout handler checks the poll handler instead.
+            poll_func = None
+            if hasattr( gsp.libgs , "gsapi_set_poll" ) :
+                poll_func = ctypes.CFUNCTYPE( ctypes.c_int , ctypes.c_void_p )( self._on_poll )
+                gsp.libgs.gsapi_set_poll( inst , poll_func )
+            self._has_poll = poll_func is not None
+            # nb: we need to hang on to the callbacks, for as long as Ghostscript might call them
+            self._callbacks = ( stdin_buf , stdout_buf , stderr_buf , poll_func )
+            # start Ghostscript
+            args = [
+                "_ignored_" , "-dQUIET" , "-dSAFER" , "-dNOPAUSE" , "-dBATCH" ,
+                "-sDEVICE="+self.profile_settings.device , "-r"+str(self.image_res) ,
+                "-sOutputFile=-" ,
+                "-sstdout=%stderr" # nb: so that PostScript output and PDF repair warnings don't get mixed in with the pages
+            ]
+            if self.profile_settings.text_alpha_bits is not None :
+                args.append( "-dTextAlphaBits={}".format( self.profile_settings.text_alpha_bits ) )
+            if self.profile_settings.graphics_alpha_bits is not None :
+                args.append( "-dGraphicsAlphaBits={}".format( self.profile_settings.graphics_alpha_bits ) )
+            if self.profile_settings.rendering_threads is not None :
+                args.append( "-dNumRenderingThreads={}".format( self.profile_settings.rendering_threads ) )
+            if self.profile_settings.buffer_space is not None :
+                args.append( "-dBufferSpace={}".format( self.profile_settings.buffer_space ) )
+            if gsp.revision().revision >= 950 :
+                # nb: older versions of Ghostscript let SAFER mode read any file
+                args.extend( "--permit-file-read={}{}".format( d , os.sep ) for d in sorted( self._read_dirs ) )
+            args = [ s.encode(locale.getpreferredencoding()) for s in args ]
+            gsp.init_with_args( inst , args )
+        except :
+            gsp.delete_instance( inst )
+            self._callbacks = None
+            raise
+        self._inst = inst
+        self.nstarts += 1
+
+    def _stop( self ) :
+        """Stop the Ghostscript instance (if it's running)."""
+        if self._inst is None :
+            return
+        import ghostscript._gsprint as gsp
+        inst , self._inst = self._inst , None
+        try :
+            gsp.exit( inst )
+        except Exception :
+            pass # nb: there's nothing we can do if Ghostscript is in a bad way, we just want to get rid of it
+        finally :
+            gsp.delete_instance( inst )
+            self._callbacks = None
+
+    def _ping( self ) :
+        """Check if Ghostscript is running, and responding to commands."""
+        if self._inst is None :
+            return False
+        try :
+            self._run_string( "0 pop\n" )
+        except Exception :
+            return False
+        return True
+
+    def _run_string( self , cmd ) :
+        """Send a PostScript command to Ghostscript."""
+        import ghostscript._gsprint as gsp
+        self._errors = []
+        try :
+            gsp.run_string( self._inst , cmd.encode( locale.getpreferredencoding() ) )
+        except Exception :
+            # nb: if the stdout handler failed, that's the real problem, not the error it caused Ghostscript to report
+            if self._errors :
+                raise self._errors[0]
+            raise
+        if self._errors :
+            raise self._errors[0]
+
+    def _on_stdout( self , inst , buf , count ) :
+        # nb: a negative return value tells Ghostscript to stop
+        if not self._stdout :
+            return count
+        if not self._has_poll and self._poll and self._poll() is False :
+            return -1 # nb: we can't be polled, so we abort the job from here (see _start())
+        try :
+            return count if self._stdout( buf[:count] ) is not False else -1
+        except Exception as ex :
+            self._errors.append( ex )
+            return -1
+
+    def _on_poll( self , handle ) :
+        if not self._poll :
+            return 0
+        return 0 if self._poll() is not False else -1
+
+# ---------------------------------------------------------------------
+
+class SyntheticRenderer( RenderBackend ) :
+    """Generates synthetic page images, instead of really rendering the PDF.
+
+    A card is drawn in each half of a page that has some text in it, with a pattern that depends only on the file name,
+    page number and position, so the output is the same every time. This lets the rest of the pipeline (cropping,
+    encoding and the database) be run and benchmarked on machines that don't have Ghostscript installed.
+    """
+
+    name = "synthetic"
+    caption = "Synthetic pages (for testing)"
+    is_synthetic = True
+
+    def render_pages( self , fname , first_page , last_page , stdout , poll=None ) :
+        rmgr = PDFResourceManager()
+        device = PDFPageAggregator( rmgr , laparams=None ) # nb: we only need to know where the text is
+        interp = PDFPageInterpreter( rmgr , device )
+        with open( fname , "rb" ) as fp :
+            for page_no,page in enumerate( PDFPage.get_pages( fp ) , start=1 ) :
+                if page_no < first_page :
+                    continue
+                if page_no > last_page :
+                    break
+                if poll and poll() is False :
+                    raise RuntimeError( "Rendering was aborted." )
+                interp.process_page( page )
+                buf = self._make_page( os.path.split(fname)[1] , page_no , page.mediabox , device.get_result() )
+                if stdout( buf ) is False :
+                    raise RuntimeError( "Rendering was aborted." )
+
+    def _make_page( self , fname , page_no , mediabox , lt_page ) :
+        """Generate the image for a page."""
+        from PIL import Image , ImageDraw
+        x0 , y0 , x1 , y1 = mediabox
+        width = int( ( x1 - x0 ) * self.image_res / 72 )
+        height = int( ( y1 - y0 ) * self.image_res / 72 )
+        img = Image.new( "RGB" , (width,height) , "white" )
+        draw = ImageDraw.Draw( img )
+        # figure out which halves of the page have text in them
+        # nb: PDF coordinates start at the bottom of the page, image coordinates at the top
+        halves = set()
+        items = list( lt_page )
+        while items :
+            item = items.pop()
+            if isinstance( item , LTChar ) :
+                halves.add( 0 if (item.y0+item.y1)/2 > (y0+y1)/2 else 1 )
+            elif isinstance( item , LTContainer ) :
+                items.extend( item )
+        # draw a card in each of them
+        # NOTE: The cards have to stay clear of the middle of the page, since that's where the cropper splits it.
+        border = max( self.image_res // 100 , 1 )
+        for page_pos in sorted( halves ) :
+            digest = hashlib.md5( "{}:{}:{}".format( fname , page_no , page_pos ).encode() ).digest()
+            top = height * ( 4 if page_pos == 0 else 52 ) // 100
+            bbox = ( width//10 , top , width*9//10 , top + height*40//100 )
+            # nb: we draw the border as a black rectangle behind the card, since Pillow < 5.3 can't draw thick outlines
+            draw.rectangle( bbox , fill="black" )
+            draw.rectangle( ( bbox[0]+border , bbox[1]+border , bbox[2]-border , bbox[3]-border ) , fill=tuple(digest[0:3]) )
+            for i in range( 0 , 8 ) :
+                ypos = bbox[1] + ( bbox[3] - bbox[1] ) * ( i+1 ) // 10
+                xpos = bbox[0] + ( bbox[2] - bbox[0] ) * ( 50 + digest[3+i] % 40 ) // 100
+                draw.line( ( bbox[0]+4*border , ypos , xpos , ypos ) , fill="black" , width=border )
+        # nb: we generate the same kind of image that Ghostscript would, for the render profile
+        if self.profile_settings.device == "png256" :
+            img = img.convert( "P" , palette=Image.ADAPTIVE , colors=256 )
+        buf = io.BytesIO()
+        img.save( buf , "PNG" )
+        return buf.getvalue()
+
+# ---------------------------------------------------------------------
+
+# NOTE: These are in order of preference (the first available one is used by default).
+_BACKENDS = collections.OrderedDict(
+    ( b.name , b ) for b in [ GhostscriptRenderer , SyntheticRenderer ]
+)
+
+def get_backends() :
+    """Get the available render backends."""
+    return [ ( b.name , b.caption ) for b in _BACKENDS.values() if b.is_available() ]
+
+def get_backend_class( backend=None ) :
+    """Get the class for a render backend (or the default one, if none is specified)."""
+    if backend :
+        try :
+            return _BACKENDS[ backend ]
+        except KeyError :
+            raise RuntimeError( "Unknown render backend: {}".format( backend ) )
+    for backend_class in _BACKENDS.values() :
+        if not backend_class.is_synthetic and backend_class.is_available() :
+            return backend_class
+    # nb: nothing is installed - we return the Ghostscript backend, which will report the problem when it's used
+    return GhostscriptRenderer
+
+def get_renderer( image_res , backend=None , profile=None ) :
+    """Get this process's renderer (for the specified resolution, backend and render profile)."""
+    global _renderer
+    backend_class = get_backend_class( backend )
+    profile = profile or DEFAULT_PROFILE
+    with _renderer_lock :
+        old_renderer = None
+        if _renderer is not None and (
+            type(_renderer) is not backend_class or _renderer.image_res != image_res or _renderer.profile != profile
+        ) :
+            old_renderer , _renderer = _renderer , None
+        if _renderer is None :
+            _renderer = backend_class( image_res , profile )
+        renderer = _renderer
+    if old_renderer :
+        old_renderer.close()
+    return renderer
+
+def close_renderer() :
+    """Shut down this process's renderer."""
+    global _renderer
+    with _renderer_lock :
+        renderer , _renderer = _renderer , None
+    if renderer :
+        renderer.close()
+
+def get_page_count( fname , backend=None ) :
+    """Get the number of pages in a PDF file."""
+    return get_backend_class( backend ).page_count( fname )
+
+def _escape_ps_string( val ) :
+    """Escape a string, for use in a PostScript command."""
+    return val.replace( "\\" , "\\\\" ).replace( "(" , "\\(" ).replace( ")" , "\\)" )
+
+def _reset_after_fork() :
+    """Reset our state in a new (forked) process."""
+    # NOTE: A forked process gets a copy of its parent's Ghostscript instance (which it can't use), and possibly
+    # a lock that some other thread in the parent was holding.
+    global _renderer , _ghostscript_lock , _renderer_lock
+    _renderer = None
+    _ghostscript_lock = threading.Lock()
+    _renderer_lock = threading.Lock()
+
+if hasattr( os , "register_at_fork" ) :
+    os.register_at_fork( after_in_child=_reset_after_fork )
@@ -6,19 +6,21 @@ base_dir = os.path.split( __file__ )[ 0 ]
 
 sys.path.append( "../.." ) # fudge! need this to allow a script to run within a package :-/
 from asl_cards.parse import PdfParser
+from asl_cards.db import classify_card
 
 # ---------------------------------------------------------------------
 
 class TestCaseBase( unittest.TestCase ) :
     """Base for all test classes."""
 
-    def _test_pdf_parser( self , fname , expected_cards ) :
+    def _test_pdf_parser( self , fname , expected_cards , layout_cache_dir=None ) :
         # parse the specified PDF
         fname2 = os.path.join( base_dir , fname )
         if not os.path.isfile( fname2 ) :
             raise RuntimeError( "Missing data file: {}".format( fname2 ) )
         pdf_parser = PdfParser(
             None ,
+            layout_cache_dir = layout_cache_dir ,
             #progress = lambda _,msg: print( msg , file=sys.stderr , flush=True )
         )
         cards = pdf_parser.parse( fname2 , image_res=None )
@@ -28,9 +30,13 @@ class TestCaseBase( unittest.TestCase ) :
         if len(cards) == 0 :
             return
         # get the attributes we're interested in
+        # nb: the parser also classifies the cards
+        for card in expected_cards :
+            classify_card( card )
         card = expected_cards[0]
         attrs = [ a for a in dir(card) if not a.startswith("_") and not callable(getattr(card,a)) ]
         attrs.remove( "card_image" ) # this is messing things up :-/
+        attrs.remove( "source_file" )
         # compare the extracted cards with the expected results
         for i in range(0,len(cards)) :
             if not all( getattr(cards[i],a) == getattr(expected_cards[i],a) for a in attrs ) :
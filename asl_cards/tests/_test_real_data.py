@@ -2,6 +2,7 @@
 
 import sys
 import os
+import tempfile
 import unittest
 
 from _test_case_base import TestCaseBase
@@ -18,7 +19,10 @@ class TestRealData( TestCaseBase ) :
 
     def _test_pdf_parser( self , fname , expected_cards ) :
         """Test the PDF parser."""
-        super()._test_pdf_parser( os.path.join("real-data",fname) , expected_cards )
+        # NOTE: We cache the results of parsing each page, so that only the first run is slow.
+        super()._test_pdf_parser( os.path.join("real-data",fname) , expected_cards ,
+            layout_cache_dir = os.path.join( tempfile.gettempdir() , "asl_cards-test-layout-cache" )
+        )
 
     def test_italian_ordnance( self ) :
         self._test_pdf_parser( "ItalianOrdnance.pdf" , [
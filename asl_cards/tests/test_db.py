@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import tempfile
+import sqlite3
+import weakref
+import gc
+import threading
+import unittest
+from unittest import mock
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+
+from _test_case_base import TestCaseBase
+from asl_cards import db
+from asl_cards.db import AslSourceFile , AslCard , AslCardImage , AslCardImageLevel
+from asl_cards.image_pack import get_pack_fname
+
+# ---------------------------------------------------------------------
+
+class TestDb( TestCaseBase ) :
+    """Test the database."""
+
+    def setUp( self ) :
+        # create a new database
+        self.temp_dir = tempfile.TemporaryDirectory()
+        db.open_database( os.path.join( self.temp_dir.name , "test.db" ) , True )
+
+    def tearDown( self ) :
+        # clean up
+        db.close_database()
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def _make_cards( fname , names , content_hash="abc" ) :
+        """Generate some cards for a source file."""
+        source_file = AslSourceFile( fname=fname , content_hash=content_hash , index_hash=None , image_res=300 )
+        cards = []
+        for i,name in enumerate(names) :
+            card = AslCard( card_tag="Vehicle #{}".format(1+i) , nationality="Moldovian" , name=name , page_id=1+i//2 , page_pos=i%2 )
+            card.card_image = AslCardImage( image_data=name.encode() )
+            card.source_file = source_file
+            cards.append( card )
+        return cards
+
+    def _get_card_names( self ) :
+        """Get the names of the cards in the database."""
+        cards = db.load_cards()
+        return sorted( c.name for c in cards["Moldovian"][db.TAGTYPE_VEHICLE] )
+
+    def test_build_cache( self ) :
+        """Test re-using the cards from unchanged source files."""
+        # add cards from 2 files
+        self.assertTrue( db.has_build_cache() )
+        db.add_cards( self._make_cards( "/tmp/a.pdf" , ["a1","a2"] ) )
+        db.add_cards( self._make_cards( "/tmp/b.pdf" , ["b1"] ) )
+        source_file = db.find_source_file( "/tmp/a.pdf" )
+        self.assertEqual( [ c.name for c in source_file.cards ] , ["a1","a2"] )
+        self.assertTrue( source_file.matches( AslSourceFile( content_hash="abc" , index_hash=None , image_res=300 ) ) )
+        self.assertFalse( source_file.matches( AslSourceFile( content_hash="abc" , index_hash=None , image_res=600 ) ) )
+        self.assertFalse( source_file.matches( AslSourceFile( content_hash="xyz" , index_hash=None , image_res=300 ) ) )
+        self.assertFalse( source_file.matches( AslSourceFile( content_hash="abc" , index_hash=None , image_res=300 , image_encoding="webp" ) ) )
+        self.assertFalse( source_file.matches( AslSourceFile( content_hash="abc" , index_hash=None , image_res=300 , render_backend="synthetic" ) ) )
+        self.assertIsNone( db.find_source_file( "/tmp/unknown.pdf" ) )
+        # update one of the files
+        db.add_cards( self._make_cards( "/tmp/a.pdf" , ["a3"] , content_hash="def" ) )
+        self.assertEqual( self._get_card_names() , ["a3","b1"] )
+        self.assertEqual( db.find_source_file( "/tmp/a.pdf" ).content_hash , "def" )
+        # remove one of the files
+        db.purge_source_files( [ "/tmp/a.pdf" ] )
+        self.assertEqual( self._get_card_names() , ["a3"] )
+        self.assertEqual( db.db_session.query( AslCardImage ).count() , 1 )
+
+    def test_old_card_table( self ) :
+        """Test checking a database whose card table was created without AUTOINCREMENT."""
+        # create a database, then re-create its card table the way older databases had it
+        db.close_database()
+        fname = os.path.join( self.temp_dir.name , "old.db" )
+        db.open_database( fname , True )
+        db.close_database()
+        conn = sqlite3.connect( fname )
+        table_sql = conn.execute( "SELECT sql FROM sqlite_master WHERE name = 'card'" ).fetchone()[0]
+        conn.execute( "PRAGMA legacy_alter_table = on" ) # nb: so that the other tables keep referring to "card"
+        conn.execute( "ALTER TABLE card RENAME TO card_old" )
+        conn.execute( table_sql.replace( "AUTOINCREMENT" , "" ) )
+        conn.execute( "DROP TABLE card_old" )
+        conn.commit()
+        conn.close()
+        # check that the database gets rebuilt
+        # nb: the card ID's of deleted cards could otherwise be re-used
+        db.open_database( fname , False )
+        self.assertFalse( db.has_build_cache() )
+
+    def test_delta_update( self ) :
+        """Test updating the cards for a new version of a source file."""
+        # add the cards for a file
+        db.add_cards( self._make_cards( "/tmp/a.pdf" , ["a1","a2","a3"] ) )
+        card_ids = { c.name: c.card_id for c in db.find_source_file( "/tmp/a.pdf" ).cards }
+        self.assertIsNotNone( db.find_source_file( "/tmp/a.pdf" ).cards[0].image_hash )
+        # stream in a new version of the file
+        # nb: the 1st card is unchanged, the 2nd has a new name and image, and the 3rd has been removed
+        cards = self._make_cards( "/tmp/a.pdf" , ["a1","a2b"] , content_hash="def" )
+        for card in cards :
+            db.add_card( card )
+        self.assertEqual( len( db.db_session.new ) , 1 ) # nb: just the new image for the 2nd card
+        self.assertEqual( db.complete_source_file( "/tmp/a.pdf" ) , 2 )
+        # check that the card ID's were kept
+        source_file = db.find_source_file( "/tmp/a.pdf" )
+        self.assertEqual( source_file.content_hash , "def" )
+        self.assertEqual(
+            [ ( c.card_id , c.name , c.card_image.image_data ) for c in source_file.cards ] ,
+            [ ( card_ids["a1"] , "a1" , b"a1" ) , ( card_ids["a2"] , "a2b" , b"a2b" ) ]
+        )
+        self.assertEqual( db.db_session.query( AslCardImage ).count() , 2 )
+        # add another version of the file, with a new card, and where one card's image hasn't been extracted yet
+        cards = self._make_cards( "/tmp/a.pdf" , ["a1","a2b","a4"] , content_hash="ghi" )
+        cards[0].card_image = None
+        db.add_cards( cards )
+        source_file = db.find_source_file( "/tmp/a.pdf" )
+        self.assertEqual( [ c.card_id for c in source_file.cards[:2] ] , [ card_ids["a1"] , card_ids["a2"] ] )
+        self.assertEqual( [ c.name for c in db.find_cards_without_images() ] , ["a1"] )
+        self.assertEqual( len( source_file.cards ) , 3 )
+        # nb: the new card shouldn't have been given the ID of the card that was removed
+        self.assertGreater( source_file.cards[2].card_id , card_ids["a3"] )
+        self.assertEqual( source_file.cards[2].card_image.image_data , b"a4" )
+
+    def test_lazy_images( self ) :
+        """Test saving card images that are extracted on demand."""
+        # add some cards without images
+        cards = self._make_cards( "/tmp/a.pdf" , ["a1","a2"] )
+        for card in cards :
+            card.card_image = None
+        db.add_cards( cards )
+        cards = db.find_cards_without_images()
+        self.assertEqual( [ c.name for c in cards ] , ["a1","a2"] )
+        # save an image
+        db.save_card_image( cards[1] , [ (1000,500,b"image data") , (200,100,b"thumbnail") ] )
+        self.assertEqual( [ c.name for c in db.find_cards_without_images() ] , ["a1"] )
+        self.assertEqual( cards[1].card_image.image_data , b"image data" )
+        self.assertEqual( [ l.image_data for l in cards[1].image_levels ] , [ b"thumbnail" ] )
+
+    def test_streamed_cards( self ) :
+        """Test streaming cards into the database."""
+        # stream in some cards
+        cards = self._make_cards( "/tmp/a.pdf" , [ "a{}".format(i) for i in range(0,100) ] )
+        card_ref = weakref.ref( cards[0] )
+        for card in cards :
+            db.add_card( card )
+        self.assertIsNone( db.find_source_file( "/tmp/a.pdf" ) ) # nb: the file is not complete yet
+        # check that the cards that have been committed can be freed
+        del cards[:]
+        del card
+        gc.collect()
+        self.assertIsNone( card_ref() )
+        # complete the file
+        self.assertEqual( db.complete_source_file( "/tmp/a.pdf" ) , 100 )
+        self.assertTrue( db.find_source_file( "/tmp/a.pdf" ).is_complete )
+        self.assertEqual( len( self._get_card_names() ) , 100 )
+        # stream in the cards for another file, but don't complete it
+        for card in self._make_cards( "/tmp/b.pdf" , ["b1","b2"] ) :
+            db.add_card( card )
+        self.assertIsNone( db.find_source_file( "/tmp/b.pdf" ) )
+        db.purge_source_files( [ "/tmp/a.pdf" , "/tmp/b.pdf" ] )
+        self.assertEqual( len( self._get_card_names() ) , 100 )
+        # complete a new version of the first file, that has no cards
+        # nb: its old cards should be removed
+        self.assertEqual( db.complete_source_file( "/tmp/a.pdf" ) , 0 )
+        self.assertIsNone( db.find_source_file( "/tmp/a.pdf" ) )
+        self.assertEqual( self._get_card_names() , [] )
+
+    def test_build_mode( self ) :
+        """Test building a new database."""
+        def get_pragma( key ) :
+            return db.db_session.execute( "PRAGMA {}".format( key ) ).scalar()
+        # build the database
+        self.assertEqual( get_pragma( "page_size" ) , db._PAGE_SIZE )
+        with db.build_mode() :
+            self.assertEqual( get_pragma( "synchronous" ) , 1 )
+            self.assertEqual( get_pragma( "journal_mode" ) , "wal" )
+            cards = self._make_cards( "/tmp/a.pdf" , [ "a{}".format(i) for i in range(0,2*db._BULK_INSERT_SIZE+5) ] )
+            cards[3].set_card_image( [ (200,100,b"full") , (20,10,b"thumbnail") ] )
+            cards[4].card_image = None
+            db.add_cards( cards )
+        # check that the safe settings were restored
+        db.db_session.commit() # nb: so that we get a new connection
+        self.assertEqual( get_pragma( "synchronous" ) , 2 )
+        self.assertEqual( get_pragma( "journal_mode" ) , "delete" )
+        # check the cards that were saved
+        source_file = db.find_source_file( "/tmp/a.pdf" )
+        self.assertEqual( [ c.name for c in source_file.cards ] , [ c.name for c in cards ] )
+        self.assertEqual( len( set( c.card_id for c in source_file.cards ) ) , len(cards) )
+        card = source_file.cards[3]
+        self.assertEqual( card.card_image.image_data , b"full" )
+        self.assertEqual( [ (l.width,l.image_data) for l in card.image_levels ] , [ (20,b"thumbnail") ] )
+        self.assertEqual( [ c.name for c in db.find_cards_without_images() ] , ["a4"] )
+        # build mode has no effect on an existing database
+        db.close_database()
+        db.open_database( os.path.join( self.temp_dir.name , "test.db" ) , False )
+        with db.build_mode() :
+            self.assertEqual( get_pragma( "synchronous" ) , 2 )
+
+    def test_load_images( self ) :
+        """Test loading card images separately from the cards."""
+        # add some cards
+        cards = self._make_cards( "/tmp/a.pdf" , [ "a{}".format(i) for i in range(0,5) ] )
+        for card in cards :
+            card.set_card_image( [ (200,100,card.name.encode()) , (20,10,card.name.encode()+b"-thumb") ] )
+        cards[2].card_image = None
+        db.add_cards( cards )
+        # load the card index
+        # nb: only the card details needed for the index should be loaded
+        cards = sorted( db.load_cards()["Moldovian"][db.TAGTYPE_VEHICLE] , key=lambda c: c.name )
+        self.assertIn( "page_id" , inspect( cards[0] ).unloaded )
+        self.assertIn( "image_data" , inspect( cards[0].card_image ).unloaded )
+        # load the card images
+        with mock.patch.object( db , "_FETCH_BATCH_SIZE" , 2 ) :
+            card_ids = [ c.card_id for c in cards ]
+            self.assertEqual(
+                sorted( db.load_card_images( card_ids ) ) ,
+                [ ( c.card_id , c.name.encode() ) for c in cards if c.name != "a2" ]
+            )
+            self.assertEqual(
+                sorted( db.load_card_images( card_ids[:2] , 20 ) ) ,
+                [ ( c.card_id , c.name.encode()+b"-thumb" ) for c in cards[:2] ]
+            )
+            self.assertEqual( list( db.load_card_images( card_ids , 999 ) ) , [] )
+
+    def test_image_pack( self ) :
+        """Test storing card images in an image pack."""
+        # create a database that uses an image pack
+        db.close_database()
+        fname = os.path.join( self.temp_dir.name , "pack.db" )
+        db.open_database( fname , True , use_image_pack=True )
+        # add some cards (one of them without an image, that is saved later)
+        # nb: the 2 cards have the same thumbnail, so it should only be stored once
+        cards = self._make_cards( "/tmp/a.pdf" , ["a1","a2"] )
+        cards[0].card_image = None
+        cards[1].set_card_image( [ (200,100,b"a2") , (20,10,b"thumbnail") ] )
+        # nb: the checkpointed images are re-used when the cards are saved
+        db.save_checkpoint( cards[0].source_file , 1 , 1 , [ [ (200,100,b"a2") , (20,10,b"thumbnail") ] ] )
+        self.assertEqual( len( db.image_pack ) , 2 )
+        db.add_cards( cards )
+        db.add_cards( self._make_cards( "/tmp/b.pdf" , ["b1"] ) )
+        db.save_card_image( db.find_cards_without_images()[0] , [ (200,100,b"a1") , (20,10,b"thumbnail") ] )
+        self.assertEqual( len( db.image_pack ) , 4 )
+        self.assertEqual( db.db_session.query( AslCardImage ).filter( AslCardImage.image_data != None ).count() , 0 )
+        # check that we can read the images back (after re-opening the database)
+        db.close_database()
+        db.open_database( fname , False )
+        card_ids = { c.name: c.card_id for c in db.load_cards()["Moldovian"][db.TAGTYPE_VEHICLE] }
+        self.assertEqual(
+            sorted( ( card_id , bytes(data) ) for card_id,data in db.load_card_images( card_ids.values() ) ) ,
+            sorted( ( card_ids[name] , name.encode() ) for name in ["a1","a2","b1"] )
+        )
+        images = dict( db.load_card_images( card_ids.values() , 20 ) )
+        self.assertIsInstance( images[ card_ids["a1"] ] , memoryview )
+        self.assertEqual( bytes( images[ card_ids["a2"] ] ) , b"thumbnail" )
+        # creating a new database replaces the old image pack
+        db.close_database()
+        os.unlink( fname )
+        db.open_database( fname , True )
+        self.assertIsNone( db.image_pack )
+        # nb: but only if it really is an image pack
+        db.close_database()
+        os.unlink( fname )
+        with open( get_pack_fname( fname ) , "wb" ) as fp :
+            fp.write( b"Someone else's file." )
+        self.assertRaises( RuntimeError , db.open_database , fname , True )
+        self.assertFalse( os.path.isfile( fname ) )
+        with open( get_pack_fname( fname ) , "rb" ) as fp :
+            self.assertEqual( fp.read() , b"Someone else's file." )
+        db.open_database( os.path.join( self.temp_dir.name , "test.db" ) , False ) # nb: so that tearDown() has something to close
+
+    def test_card_lookups( self ) :
+        """Test looking up cards."""
+        # add some cards
+        cards = self._make_cards( "/tmp/a.pdf" , [ "Big Tank" , "Little Tank" , "Big Gun" ] )
+        cards[2].card_tag = "Ordnance #12.1"
+        cards.extend( self._make_cards( "/tmp/b.pdf" , [ "Other Tank" , "ÉCLAIR Tank" ] ) )
+        cards[3].nationality = cards[4].nationality = "Ruritanian"
+        db.add_cards( cards )
+        self.assertEqual( db.classify_card_tag( "Ordnance #12.1" ) , ( db.TAGTYPE_ORDNANCE , 12 ) )
+        self.assertEqual( db.classify_card_tag( "Vehicle" ) , ( db.TAGTYPE_VEHICLE , None ) )
+        self.assertEqual( [ (c.tag_type,c.card_no) for c in db.find_source_file("/tmp/a.pdf").cards ] , [
+            ( db.TAGTYPE_VEHICLE , 1 ) , ( db.TAGTYPE_VEHICLE , 2 ) , ( db.TAGTYPE_ORDNANCE , 12 )
+        ] )
+        # look up the cards
+        self.assertEqual( sorted( db.get_nationalities() ) , [ "Moldovian" , "Ruritanian" ] )
+        self.assertEqual( sorted( db.get_tag_types( "Moldovian" ) ) , [ db.TAGTYPE_ORDNANCE , db.TAGTYPE_VEHICLE ] )
+        self.assertEqual( db.get_tag_types( "Ruritanian" ) , [ db.TAGTYPE_VEHICLE ] )
+        def find_cards( *args ) :
+            return [ c.name for c in db.find_cards( *args ) ]
+        self.assertEqual( find_cards( "Moldovian" , db.TAGTYPE_VEHICLE ) , [ "Big Tank" , "Little Tank" ] )
+        self.assertEqual( find_cards( "Moldovian" , db.TAGTYPE_VEHICLE , "LE TAN" ) , [ "Little Tank" ] )
+        self.assertEqual( find_cards( "Moldovian" , db.TAGTYPE_ORDNANCE , "tank" ) , [] )
+        self.assertEqual( find_cards( "Ruritanian" , db.TAGTYPE_ORDNANCE ) , [] )
+        self.assertEqual( find_cards( "Ruritanian" , db.TAGTYPE_VEHICLE , "écl" ) , [ "ÉCLAIR Tank" ] ) # nb: non-ASCII capitals
+        # try adding a card with a bad tag
+        # nb: this should be caught when the database is built
+        cards = self._make_cards( "/tmp/c.pdf" , [ "Bad Card" ] )
+        cards[0].card_tag = "Something #1"
+        self.assertRaises( RuntimeError , db.add_cards , cards )
+
+    def test_threads( self ) :
+        """Test using the database from background threads."""
+        db.add_cards( self._make_cards( "/tmp/a.pdf" , [ "a{}".format(i) for i in range(0,5) ] ) )
+        card_ids = { c.name: c.card_id for c in db.find_source_file( "/tmp/a.pdf" ).cards }
+        # read the database from some worker threads
+        database = db.get_database()
+        results = {}
+        def worker( thread_no ) :
+            try :
+                results[ thread_no ] = (
+                    database.session is not database.session , # nb: should be the same session each time
+                    database.session ,
+                    sorted( name for name in database.get_nationalities() ) ,
+                    sorted( ( card_id , bytes(data) ) for card_id,data in database.load_card_images( card_ids.values() ) )
+                )
+            except Exception as ex :
+                results[ thread_no ] = ex
+        threads = [ threading.Thread( target=worker , args=(i,) ) for i in range(0,3) ]
+        for thread in threads :
+            thread.start()
+        for thread in threads :
+            thread.join()
+        expected_images = sorted( ( card_ids[name] , name.encode() ) for name in card_ids )
+        for thread_no in range(0,3) :
+            self.assertEqual( results[thread_no][0] , False )
+            self.assertIsNot( results[thread_no][1] , database.session )
+            self.assertEqual( results[thread_no][2:] , ( ["Moldovian"] , expected_images ) )
+        # make sure that read-only sessions are read-only
+        with db.read_session() as session :
+            self.assertEqual( session.query( AslCard ).count() , 5 )
+            self.assertRaises( OperationalError , session.execute , "DELETE FROM card" )
+        # open another database at the same time
+        database2 = db.Database( os.path.join( self.temp_dir.name , "test2.db" ) , True )
+        try :
+            database2.add_cards( self._make_cards( "/tmp/b.pdf" , ["b1"] ) )
+            self.assertEqual( [ c.name for c in database2.find_cards( "Moldovian" , db.TAGTYPE_VEHICLE ) ] , ["b1"] )
+            self.assertEqual( len( db.find_cards( "Moldovian" , db.TAGTYPE_VEHICLE ) ) , 5 )
+        finally :
+            database2.close()
+
+    def test_source_files( self ) :
+        """Test adding, replacing and removing the cards for a single source file."""
+        def make_cards( fname , names , content_hash="abc" ) :
+            cards = self._make_cards( fname , names , content_hash=content_hash )
+            for card in cards :
+                card.image_levels = [ AslCardImageLevel( width=10 , height=20 , image_data=b"thumbnail" ) ]
+            return cards[0].source_file , cards
+        def count_rows( table ) :
+            return db.db_session.execute( "SELECT count(*) FROM {}".format( table ) ).scalar()
+        # add the cards for 2 files
+        self.assertEqual( db.add_source_file( *make_cards( "/tmp/a.pdf" , ["a1","a2","a3"] ) ) , 3 )
+        self.assertEqual( db.add_source_file( *make_cards( "/tmp/b.pdf" , ["b1"] ) ) , 1 )
+        self.assertRaises( Exception , db.add_source_file , *make_cards( "/tmp/a.pdf" , ["a1"] ) )
+        card_ids = { c.name: c.card_id for c in db.find_source_file( "/tmp/a.pdf" ).cards }
+        b_card_ids = [ c.card_id for c in db.find_source_file( "/tmp/b.pdf" ).cards ]
+        # replace the cards for one of the files
+        self.assertEqual( db.replace_source_file( *make_cards( "/tmp/a.pdf" , ["a1","a2b"] , content_hash="def" ) ) , 2 )
+        self.assertEqual( [ ( c.card_id , c.name ) for c in db.find_source_file( "/tmp/a.pdf" ).cards ] ,
+            [ ( card_ids["a1"] , "a1" ) , ( card_ids["a2"] , "a2b" ) ]
+        )
+        self.assertEqual( [ c.card_id for c in db.find_source_file( "/tmp/b.pdf" ).cards ] , b_card_ids )
+        self.assertEqual( ( count_rows("card_image") , count_rows("card_image_level") ) , ( 3 , 3 ) )
+        # try to replace the cards, but fail part-way through (nothing should change)
+        source_file , cards = make_cards( "/tmp/a.pdf" , ["x1"] , content_hash="xyz" )
+        def bad_cards() :
+            yield cards[0]
+            raise RuntimeError( "Analysis failed." )
+        self.assertRaises( RuntimeError , db.replace_source_file , source_file , bad_cards() )
+        self.assertEqual( db.find_source_file( "/tmp/a.pdf" ).content_hash , "def" )
+        self.assertEqual( self._get_card_names() , ["a1","a2b","b1"] )
+        # remove one of the files
+        # nb: the foreign keys should remove the card images (they must be enabled on every connection)
+        self.assertEqual( db.db_session.execute( "PRAGMA foreign_keys" ).scalar() , 1 )
+        self.assertEqual( db.remove_source_file( "/tmp/a.pdf" ) , 2 )
+        self.assertIsNone( db.find_source_file( "/tmp/a.pdf" ) )
+        self.assertEqual( self._get_card_names() , ["b1"] )
+        self.assertEqual( ( count_rows("card_image") , count_rows("card_image_level") ) , ( 1 , 1 ) )
+        self.assertEqual( db.remove_source_file( "/tmp/a.pdf" ) , 0 )
+
+    def test_checkpoints( self ) :
+        """Test saving the card images for an analysis that didn't finish."""
+        source_file = AslSourceFile( fname="/tmp/a.pdf" , content_hash="abc" , index_hash=None , image_res=300 )
+        card_images = [ [ (100,50,b"full") , (20,10,b"thumbnail") ] , [ (100,50,b"full 2") ] ]
+        self.assertFalse( db.has_checkpoints() )
+        db.save_checkpoint( source_file , 1 , 8 , card_images )
+        db.save_checkpoint( source_file , 9 , 16 , [] )
+        self.assertTrue( db.has_checkpoints() )
+        self.assertEqual( db.load_checkpoint( source_file , 1 , 8 ) , card_images )
+        self.assertEqual( db.load_checkpoint( source_file , 9 , 16 ) , [] )
+        self.assertIsNone( db.load_checkpoint( source_file , 17 , 24 ) )
+        source_file2 = AslSourceFile( fname="/tmp/a.pdf" , content_hash="abc" , index_hash=None , image_res=600 )
+        self.assertIsNone( db.load_checkpoint( source_file2 , 1 , 8 ) )
+        # check that a checkpoint that's missing some of its card images is ignored
+        db.db_session.execute( "DELETE FROM render_checkpoint_image WHERE image_no = 1" )
+        self.assertIsNone( db.load_checkpoint( source_file , 1 , 8 ) )
+        # the checkpoints (and their images) are removed once the cards for the file have been saved
+        db.add_cards( self._make_cards( "/tmp/a.pdf" , ["a1"] ) )
+        self.assertFalse( db.has_checkpoints() )
+        self.assertEqual( db.db_session.execute( "SELECT count(*) FROM render_checkpoint_image" ).scalar() , 0 )
+
+    def test_image_levels( self ) :
+        """Test choosing which pre-scaled card image to show."""
+        cards = self._make_cards( "/tmp/a.pdf" , ["a1"] )
+        cards[0].set_card_image( [ (2000,1000,b"full") , (800,400,b"screen") , (200,100,b"thumbnail") ] )
+        db.add_cards( cards )
+        card = db.load_cards()["Moldovian"][db.TAGTYPE_VEHICLE][0]
+        self.assertEqual( [ l.width for l in card.image_levels ] , [ 200 , 800 ] )
+        def find_image_level( width , height ) :
+            level = card.find_image_level( width , height )
+            return level.image_data if level else None
+        self.assertEqual( find_image_level( 100 , 100 ) , b"thumbnail" )
+        self.assertEqual( find_image_level( 300 , 150 ) , b"screen" )
+        self.assertEqual( find_image_level( 1000 , 200 ) , b"screen" ) # nb: the height is the limiting dimension
+        self.assertEqual( find_image_level( 1000 , 1000 ) , None )
+        # make sure the images are removed with their card
+        db.purge_source_files( [] )
+        self.assertEqual( db.db_session.query( db.AslCardImageLevel ).count() , 0 )
+
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__" :
+    unittest.main()
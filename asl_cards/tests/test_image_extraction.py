@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import io
+import time
+import tempfile
+import shutil
+import multiprocessing
+import unittest
+from unittest import mock
+
+from PIL import Image , ImageDraw , ImageChops
+
+from _test_case_base import TestCaseBase , base_dir
+from asl_cards import parse , imaging , render
+from asl_cards.parse import PdfParser , AnalyzeCancelledException , _PngStreamSplitter , _get_page_count , _make_page_ranges
+
+# ---------------------------------------------------------------------
+
+class TestImageExtraction( TestCaseBase ) :
+    """Test extracting card images."""
+
+    def test_png_stream( self ) :
+        """Test splitting the stream of PNG files written by Ghostscript."""
+        # generate some PNG files
+        expected = []
+        for i,col in enumerate( ["red","green","blue"] ) :
+            buf = io.BytesIO()
+            Image.new( "RGB" , (20+i,30) , col ).save( buf , "PNG" )
+            expected.append( buf.getvalue() )
+        stream = b"".join( expected )
+        # feed the stream through in different-sized blocks
+        for block_size in [ 1 , 7 , 100 , len(stream) ] :
+            images = []
+            splitter = _PngStreamSplitter( images.append )
+            for pos in range( 0 , len(stream) , block_size ) :
+                splitter.feed( stream[ pos : pos+block_size ] )
+            self.assertEqual( images , expected )
+
+    def test_bad_png_stream( self ) :
+        """Test handling junk in the PNG stream."""
+        splitter = _PngStreamSplitter( lambda buf: None )
+        self.assertRaises( RuntimeError , splitter.feed , b"GPL Ghostscript 9.21" )
+
+    def test_page_count( self ) :
+        """Test counting the pages in a PDF file."""
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        self.assertEqual( _get_page_count( fname ) , 2 )
+
+    def test_page_ranges( self ) :
+        """Test splitting a file into page ranges."""
+        self.assertEqual( _make_page_ranges( 0 , 8 ) , [] )
+        self.assertEqual( _make_page_ranges( 5 , 8 ) , [ (1,5) ] )
+        self.assertEqual( _make_page_ranges( 16 , 8 ) , [ (1,8) , (9,16) ] )
+        self.assertEqual( _make_page_ranges( 21 , 8 ) , [ (1,8) , (9,16) , (17,21) ] )
+
+    def test_content_bounds( self ) :
+        """Test finding the content in an image."""
+        # check a blank image
+        img = Image.new( "RGB" , (100,200) , (250,250,240) )
+        mask = imaging.make_content_mask( img )
+        self.assertIsNone( imaging.get_content_bounds( mask ) )
+        # add some content (including some faint noise that should be ignored)
+        draw = ImageDraw.Draw( img )
+        draw.rectangle( (10,20,29,39) , fill=(250,250,100) ) # nb: only the blue channel is different
+        draw.point( (5,150) , fill=(0,0,0) )
+        draw.rectangle( (60,100,89,189) , fill=(200,200,200) )
+        mask = imaging.make_content_mask( img )
+        self.assertEqual( imaging.get_content_bounds( mask ) , (5,20,30,151) )
+        self.assertEqual( imaging.get_content_bounds( mask , (0,0,100,100) ) , (10,20,30,40) )
+        self.assertEqual( imaging.get_content_bounds( mask , (0,100,100,200) ) , (5,150,6,151) )
+        # compare the results with how we used to do it
+        bgd_img = Image.new( img.mode , img.size , img.getpixel( (0,0) ) )
+        diff = ImageChops.difference( img , bgd_img )
+        diff = ImageChops.add( diff , diff , 2.0 , -100 )
+        self.assertEqual( imaging.get_content_bounds( mask ) , diff.getbbox() )
+
+    def test_extract_images( self ) :
+        """Test extracting card images from the pages rendered by Ghostscript."""
+        # generate some page images (2 cards on the first page, 1 card on the second)
+        def make_page( card_rects ) :
+            img = Image.new( "RGB" , (200,300) , "white" )
+            draw = ImageDraw.Draw( img )
+            for rect in card_rects :
+                draw.rectangle( rect , fill="black" )
+            buf = io.BytesIO()
+            img.save( buf , "PNG" )
+            return buf.getvalue()
+        pages = [
+            make_page( [ (10,10,99,109) , (20,160,139,279) ] ) ,
+            make_page( [ (30,20,59,119) ] ) ,
+        ]
+        def render_pages( fname , first_page , last_page , stdout , poll=None ) :
+            self.assertEqual( ( first_page , last_page ) , (1,2) )
+            for page in pages :
+                stdout( page[:10] )
+                stdout( page[10:] )
+        # extract the card images
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        with mock.patch.object( render , "get_renderer" , lambda image_res,backend,profile: _MockRenderer(render_pages) ) :
+            card_images = PdfParser( None )._extract_images( fname , 300 , None , 1 , 2 , 2 )
+        sizes = [ Image.open( io.BytesIO(levels[0][2]) ).size for levels in card_images ]
+        self.assertEqual( sizes , [ (90,100) , (120,120) , (30,100) ] )
+
+    def test_cancel_render( self ) :
+        """Test cancelling Ghostscript while it is rendering a page."""
+        # NOTE: This simulates a page that takes a long time to render.
+        stopped = []
+        def render_pages( fname , first_page , last_page , stdout , poll=None ) :
+            start_time = time.time()
+            while time.time() - start_time < 10 :
+                if poll() is False :
+                    stopped.append( True )
+                    return
+                time.sleep( 0.01 )
+        # start rendering, then cancel
+        start_time = time.time()
+        is_cancelled = lambda: time.time() - start_time > 0.2
+        with mock.patch.object( render , "get_renderer" , lambda image_res,backend,profile: _MockRenderer(render_pages) ) :
+            pages = parse._render_pages( "test.pdf" , 300 , 1 , 1 , is_cancelled=is_cancelled )
+            self.assertRaises( AnalyzeCancelledException , list , pages )
+        self.assertLess( time.time() - start_time , 2 )
+        self.assertEqual( stopped , [True] )
+
+    def test_checkpoints( self ) :
+        """Test resuming an analysis that didn't finish."""
+        # NOTE: We simulate the analysis being cancelled after the first page has been rendered.
+        checkpoints = {}
+        def load_checkpoint( source_file , first_page , last_page ) :
+            return checkpoints.get( ( source_file.content_hash , first_page , last_page ) )
+        def save_checkpoint( source_file , first_page , last_page , card_images ) :
+            checkpoints[ ( source_file.content_hash , first_page , last_page ) ] = card_images
+        rendered = []
+        def iter_images( fname , image_res , image_encoding , first_page , last_page , npages ) :
+            rendered.append( first_page )
+            if cancel_page == first_page :
+                raise AnalyzeCancelledException()
+            yield [ [ (10,10,"page {}".format(first_page).encode()) ] ] * ( 2 if first_page == 1 else 1 )
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        def parse_file() :
+            pdf_parser = PdfParser( None , load_checkpoint=load_checkpoint , save_checkpoint=save_checkpoint )
+            with mock.patch.object( pdf_parser , "_iter_images" , iter_images ) :
+                return pdf_parser.parse( fname , image_res=300 , shard_pages=1 )
+        cancel_page = 2
+        self.assertRaises( AnalyzeCancelledException , parse_file )
+        self.assertEqual( ( rendered , len(checkpoints) ) , ( [1,2] , 1 ) )
+        # resume the analysis (only the second page should get rendered)
+        del rendered[:]
+        cancel_page = None
+        cards = parse_file()
+        self.assertEqual( rendered , [2] )
+        self.assertEqual(
+            [ c.card_image.image_data for c in cards ] ,
+            [ b"page 1" , b"page 1" , b"page 2" ]
+        )
+
+    def test_iter_cards( self ) :
+        """Test streaming the cards extracted from a file."""
+        # NOTE: Each card should be yielded as soon as its page has been cropped.
+        events = []
+        def iter_images( fname , image_res , image_encoding , first_page , last_page , npages ) :
+            for page_no in range( first_page , last_page+1 ) :
+                events.append( "page {}".format( page_no ) )
+                yield [ [ (10,10,b"") ] ] * ( 2 if page_no == 1 else 1 )
+        pdf_parser = PdfParser( None , on_file_completed=lambda fname,cards: events.append( "completed" ) )
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        with mock.patch.object( pdf_parser , "_iter_images" , iter_images ) :
+            for card in pdf_parser.iter_cards( fname , image_res=300 ) :
+                self.assertIsNotNone( card.card_image )
+                self.assertEqual( os.path.split( card.source_file.fname )[1] , "3-cards.pdf" )
+                events.append( card.name )
+        self.assertEqual( events , [ "page 1" , "Big Tank" , "Little Tank" , "page 2" , "Big Gun" , "completed" ] )
+        # check what happens if there are too many card images
+        del events[:]
+        with mock.patch.object( pdf_parser , "_iter_images" , lambda *args: iter( [ [ [ (10,10,b"") ] ] * 4 ] ) ) :
+            pdf_parser.on_error = events.append
+            cards = list( pdf_parser.iter_cards( fname , image_res=300 ) )
+        self.assertEqual( len(cards) , 3 )
+        self.assertEqual( len(events) , 1 )
+        self.assertIn( "found 3 cards, 4 card images" , events[0] )
+
+    @unittest.skipUnless( "fork" in multiprocessing.get_all_start_methods() , "The worker processes need to inherit the mock renderer." )
+    @mock.patch.object( parse , "_MP_START_METHOD" , "fork" )
+    def test_parallel_images( self ) :
+        """Test extracting card images in a pool of worker processes."""
+        # NOTE: We limit how many card images can be in flight, so that the results have to be streamed back
+        # from the worker pool as the cards are consumed.
+        checkpoints = []
+        with tempfile.TemporaryDirectory() as dname :
+            for fname in [ "1-card.pdf" , "2-cards.pdf" , "3-cards.pdf" ] :
+                shutil.copy( os.path.join( base_dir , "synthetic-data" , fname ) , dname )
+            with mock.patch.object( parse , "_render_pages" , _render_test_pages ) :
+                pdf_parser = PdfParser( None , save_checkpoint=lambda *args: checkpoints.append( args[1:3] ) )
+                cards = list( pdf_parser.iter_cards( dname , image_res=300 , workers=3 , shard_pages=1 , max_images=2 ) )
+        sizes = [
+            ( c.name , Image.open( io.BytesIO( c.card_image.image_data ) ).size )
+            for c in cards
+        ]
+        self.assertEqual( sorted( sizes ) , [
+            ( "Big Gun" , (30,100) ) , ( "Big Tank" , (90,100) ) , ( "Big Tank" , (90,100) ) ,
+            ( "Big Tank" , (100,100) ) , ( "Little Tank" , (120,120) ) , ( "Little Tank" , (120,120) )
+        ] )
+        self.assertEqual( sorted( checkpoints ) , [ (1,1) , (1,1) , (1,1) , (2,2) ] )
+
+    @unittest.skipUnless( "fork" in multiprocessing.get_all_start_methods() , "The worker processes need to inherit the mock renderer." )
+    @mock.patch.object( parse , "_MP_START_METHOD" , "fork" )
+    def test_worker_crash( self ) :
+        """Test recovering from a worker process crashing."""
+        with tempfile.TemporaryDirectory() as dname :
+            for fname in [ "2-cards.pdf" , "3-cards.pdf" ] :
+                shutil.copy( os.path.join( base_dir , "synthetic-data" , fname ) , dname )
+            # NOTE: The worker process that renders the last page of 3-cards.pdf will die the first time.
+            crash_fname = os.path.join( dname , "crashed" )
+            def render_pages( fname , image_res , first_page , last_page , is_cancelled=None , backend=None , profile=None ) :
+                if fname.endswith( "3-cards.pdf" ) and last_page == 2 and not os.path.isfile( crash_fname ) :
+                    open( crash_fname , "w" ).close()
+                    os._exit( 1 )
+                return _render_test_pages( fname , image_res , first_page , last_page , is_cancelled )
+            with mock.patch.object( parse , "_render_pages" , render_pages ) :
+                cards = list( PdfParser( None ).iter_cards( dname , image_res=300 , workers=2 , shard_pages=1 ) )
+            self.assertTrue( os.path.isfile( crash_fname ) )
+        self.assertEqual( sorted( c.name for c in cards if c.card_image ) , [
+            "Big Gun" , "Big Tank" , "Big Tank" , "Little Tank" , "Little Tank"
+        ] )
+
+    def test_synthetic_renderer( self ) :
+        """Test running the extraction pipeline with the synthetic renderer."""
+        # extract the cards
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        pdf_parser = PdfParser( None , render_backend="synthetic" )
+        cards = list( pdf_parser.iter_cards( fname , image_res=72 ) )
+        self.assertEqual( [ c.name for c in cards ] , [ "Big Tank" , "Little Tank" , "Big Gun" ] )
+        self.assertEqual( cards[0].source_file.render_backend , "synthetic" )
+        # check the card images
+        # nb: the cards are drawn 80% of the page width, and 40% of its height
+        images = [ c.card_image.image_data for c in cards ]
+        for image_data in images :
+            self.assertEqual( Image.open( io.BytesIO( image_data ) ).size , (490,317) )
+        self.assertEqual( len( set( images ) ) , 3 )
+        cards2 = list( PdfParser( None , render_backend="synthetic" ).iter_cards( fname , image_res=72 ) )
+        self.assertEqual( [ c.card_image.image_data for c in cards2 ] , images )
+        # benchmark the renderer
+        results = parse.benchmark_renderers( [ fname ] , 72 , backends=["synthetic"] )
+        self.assertEqual( [ r[:2] for r in results ] , [ ( "synthetic" , 2 ) ] )
+        self.assertIsNone( results[0][3] )
+        # nb: a backend that doesn't render the pages it's asked for shouldn't get timed
+        render_pages = render.SyntheticRenderer.render_pages
+        def all_pages( renderer , fname , first_page , last_page , stdout , poll=None ) :
+            render_pages( renderer , fname , 1 , 2 , stdout , poll )
+        with mock.patch.object( render.SyntheticRenderer , "render_pages" , all_pages ) :
+            results = parse.benchmark_renderers( [ fname ] , 72 , backends=["synthetic"] )
+        self.assertEqual( [ r[:3] for r in results ] , [ ( "synthetic" , 0 , 0 ) ] )
+        self.assertTrue( results[0][3].startswith( "Failed the renderer check: Got 2 pages, when rendering pages 1-1" ) )
+        # analyze the file again, but leave the card images to be extracted later
+        # nb: the cards we already have can't be used if the images are wanted later
+        cards4 = list( PdfParser( None , render_backend="synthetic" ).iter_cards( fname , image_res=72 , lazy_images=True ) )
+        self.assertEqual( [ c.card_image for c in cards4 ] , [ None , None , None ] )
+        self.assertEqual( ( cards4[0].source_file.images_extracted , cards[0].source_file.images_extracted ) , ( False , True ) )
+        self.assertFalse( cards[0].source_file.matches( cards4[0].source_file ) )
+        # extract the cards again, with a render profile that produces paletted pages
+        pdf_parser = PdfParser( None , render_backend="synthetic" , render_profile="fast-draft" )
+        cards3 = list( pdf_parser.iter_cards( fname , image_res=72 ) )
+        self.assertEqual( ( cards3[0].source_file.render_profile , cards[0].source_file.render_profile ) , ( "fast-draft" , "standard" ) )
+        self.assertFalse( cards3[0].source_file.matches( cards[0].source_file ) )
+        for card in cards3 :
+            img = Image.open( io.BytesIO( card.card_image.image_data ) )
+            self.assertEqual( ( img.mode , img.size ) , ( "RGB" , (490,317) ) )
+
+    def test_centred_card( self ) :
+        """Test extracting a single card that is centred on the last page."""
+        img = Image.new( "RGB" , (200,300) , "white" )
+        ImageDraw.Draw( img ).rectangle( (50,100,149,199) , fill="black" )
+        pdf_parser = PdfParser( None )
+        card_images = pdf_parser._extract_page_images( img , True )
+        self.assertEqual( [ Image.open( io.BytesIO(levels[0][2]) ).size for levels in card_images ] , [ (100,100) ] )
+        # nb: if it's not the last page, the card gets split in half
+        card_images = pdf_parser._extract_page_images( img , False )
+        self.assertEqual( [ Image.open( io.BytesIO(levels[0][2]) ).size for levels in card_images ] , [ (100,44) , (100,55) ] )
+
+    def test_image_encodings( self ) :
+        """Test encoding card images."""
+        # generate a test image
+        img = Image.new( "RGB" , (120,80) , (250,250,240) )
+        draw = ImageDraw.Draw( img )
+        draw.rectangle( (10,10,60,40) , fill="red" )
+        draw.text( (20,50) , "ASL" , fill="black" )
+        # encode it using each encoding
+        formats = { "png": "PNG" , "png-palette": "PNG" , "webp": "WEBP" , "jpeg": "JPEG" }
+        self.assertEqual( [ e[0] for e in imaging.get_encodings() ] , list( formats.keys() ) )
+        for encoding,fmt in formats.items() :
+            img2 = Image.open( io.BytesIO( imaging.encode_image( img , encoding ) ) )
+            self.assertEqual( ( img2.format , img2.size ) , ( fmt , img.size ) )
+            if encoding in ("png","webp") :
+                # nb: these are lossless
+                self.assertIsNone( ImageChops.difference( img , img2.convert("RGB") ).getbbox() )
+        self.assertRaises( RuntimeError , imaging.encode_image , img , "gif" )
+        # generate a report
+        report = imaging.EncodingReport( max_samples=2 )
+        self.assertEqual( report.format( "png" ) , "" )
+        for i in range(0,3) :
+            report.add_images( [ imaging.encode_image( img , "webp" ) , None ] )
+        self.assertEqual( ( len(report.samples) , report.total_images ) , ( 2 , 3 ) )
+        results = report.generate()
+        self.assertEqual( [ r[0] for r in results ] , list( formats.keys() ) )
+        self.assertEqual( len( report.format( "webp" ).split( "\n" ) ) , 1+len(formats) )
+
+    def test_image_levels( self ) :
+        """Test generating the pre-scaled card images."""
+        # check a large image
+        img = Image.new( "RGB" , (1500,1000) , "white" )
+        levels = imaging.encode_image_levels( img )
+        self.assertEqual( [ l[:2] for l in levels ] , [ (1500,1000) , (800,533) , (200,133) ] )
+        for width,height,image_data in levels :
+            self.assertEqual( Image.open( io.BytesIO(image_data) ).size , (width,height) )
+        # check a small image (that should never get scaled up)
+        levels = imaging.encode_image_levels( Image.new( "RGB" , (300,400) , "white" ) )
+        self.assertEqual( [ l[:2] for l in levels ] , [ (300,400) , (200,267) ] )
+
+# ---------------------------------------------------------------------
+
+class _MockRenderer :
+    """Stand-in for a Ghostscript renderer."""
+    def __init__( self , render_pages ) :
+        self.render_pages = render_pages
+
+def _render_test_pages( fname , image_res , first_page , last_page , is_cancelled=None , backend=None , profile=None ) :
+    """Generate some page images (instead of rendering them with Ghostscript)."""
+    pages = {
+        "1-card.pdf": [ [ (50,100,149,199) ] ] ,
+        "2-cards.pdf": [ [ (10,10,99,109) , (20,160,139,279) ] ] ,
+        "3-cards.pdf": [ [ (10,10,99,109) , (20,160,139,279) ] , [ (30,20,59,119) ] ] ,
+    }[ os.path.split(fname)[1] ]
+    for page_no in range( first_page , last_page+1 ) :
+        img = Image.new( "RGB" , (200,300) , "white" )
+        draw = ImageDraw.Draw( img )
+        for rect in pages[ page_no-1 ] :
+            draw.rectangle( rect , fill="black" )
+        buf = io.BytesIO()
+        img.save( buf , "PNG" )
+        yield buf.getvalue()
+
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import tempfile
+import unittest
+
+from _test_case_base import TestCaseBase
+from asl_cards.image_pack import ImagePack , get_pack_fname , get_image_key
+
+# ---------------------------------------------------------------------
+
+class TestImagePack( TestCaseBase ) :
+    """Test storing card images in a pack file."""
+
+    def setUp( self ) :
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fname = get_pack_fname( os.path.join( self.temp_dir.name , "test.db" ) )
+
+    def tearDown( self ) :
+        self.temp_dir.cleanup()
+
+    def test_pack( self ) :
+        """Test adding and retrieving images."""
+        # add some images to the pack
+        pack = ImagePack( self.fname )
+        key1 = pack.put( b"image 1" )
+        self.assertEqual( key1 , get_image_key( b"image 1" ) )
+        image1 = pack.get( key1 )
+        key2 = pack.put( b"image 2" )
+        self.assertEqual( bytes( image1 ) , b"image 1" )
+        self.assertEqual( bytes( pack.get( key2 ) ) , b"image 2" )
+        self.assertIsNone( pack.get( get_image_key( b"unknown" ) ) )
+        # add the same image again (it should only be stored once)
+        fsize = os.path.getsize( self.fname )
+        self.assertEqual( pack.put( b"image 1" ) , key1 )
+        self.assertEqual( os.path.getsize( self.fname ) , fsize )
+        self.assertEqual( len(pack) , 2 )
+        pack.sync()
+        pack.close()
+        # check that the images are still there when the pack is re-opened
+        pack = ImagePack( self.fname )
+        self.assertEqual( bytes( pack.get( key2 ) ) , b"image 2" )
+        self.assertEqual( bytes( image1 ) , b"image 1" ) # nb: the mapped image is still usable
+        pack.close()
+
+    def test_damaged_file( self ) :
+        """Test opening a pack file that was not completely written."""
+        pack = ImagePack( self.fname )
+        key1 , key2 = pack.put( b"image 1" ) , pack.put( b"image 2" )
+        pack.close()
+        # chop off the end of the file
+        # nb: this is what happens if the program dies while it's adding an image
+        with open( self.fname , "r+b" ) as fp :
+            fp.truncate( os.path.getsize( self.fname ) - 2 )
+        pack = ImagePack( self.fname )
+        self.assertEqual( bytes( pack.get( key1 ) ) , b"image 1" )
+        self.assertNotIn( key2 , pack )
+        self.assertEqual( pack.put( b"image 2" ) , key2 )
+        self.assertEqual( bytes( pack.get( key2 ) ) , b"image 2" )
+        pack.close()
+        # check that we don't touch a file that isn't a pack file
+        with open( self.fname , "wb" ) as fp :
+            fp.write( b"not a pack file" )
+        self.assertRaises( RuntimeError , ImagePack , self.fname )
+
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import tempfile
+import unittest
+
+from _test_case_base import TestCaseBase
+from asl_cards.db import AslSourceFile , AslCard
+from asl_cards.pixel_cache import PixelCache , get_cache_fname
+
+# ---------------------------------------------------------------------
+
+class TestPixelCache( TestCaseBase ) :
+    """Test caching decoded card images."""
+
+    def setUp( self ) :
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fname = get_cache_fname( os.path.join( self.temp_dir.name , "test.db" ) )
+
+    def tearDown( self ) :
+        self.temp_dir.cleanup()
+
+    def test_cache( self ) :
+        """Test adding and retrieving decoded card images."""
+        # add some images to the cache
+        cache = PixelCache( self.fname )
+        card1 , card2 = _make_card( 1 , 1 ) , _make_card( 2 , 2 )
+        self.assertIsNone( cache.get( card1 ) )
+        self.assertTrue( cache.put( card1 , None , 3 , 2 , 12 , bytes( range(0,24) ) ) )
+        self.assertTrue( cache.put( card1 , 200 , 1 , 1 , 4 , b"abcd" ) )
+        self.assertTrue( cache.put( card2 , None , 2 , 2 , 8 , b"x" * 16 ) )
+        self.assertFalse( cache.put( card2 , 200 , 2 , 2 , 8 , b"short" ) )
+        pixels = cache.get( card1 )
+        self.assertEqual( ( pixels.width , pixels.height , pixels.stride ) , ( 3 , 2 , 12 ) )
+        self.assertEqual( bytes( pixels.data ) , bytes( range(0,24) ) )
+        self.assertEqual( bytes( cache.get( card1 , 200 ).data ) , b"abcd" )
+        self.assertIsNone( cache.get( card2 , 200 ) )
+        cache.close()
+        # check that the images are still there when the cache is re-opened
+        # nb: the mapped pixels are still usable after the cache has been closed
+        cache = PixelCache( self.fname )
+        self.assertEqual( bytes( cache.get( card2 ).data ) , b"x" * 16 )
+        self.assertEqual( bytes( pixels.data ) , bytes( range(0,24) ) )
+        # check that cached images are not used if the card has changed
+        # nb: card ID's can be re-used when the database is re-built
+        card1.page_pos = 1
+        self.assertIsNone( cache.get( card1 ) )
+        self.assertIsNone( cache.get( _make_card( 1 , 1 , content_hash="xyz" ) ) )
+        cache.put( card1 , None , 1 , 1 , 4 , b"new!" )
+        self.assertEqual( bytes( cache.get( card1 ).data ) , b"new!" )
+        cache.close()
+
+    def test_damaged_file( self ) :
+        """Test opening a cache file that was not completely written."""
+        cache = PixelCache( self.fname )
+        card1 , card2 = _make_card( 1 , 1 ) , _make_card( 2 , 2 )
+        cache.put( card1 , None , 1 , 1 , 4 , b"abcd" )
+        cache.put( card2 , None , 4 , 4 , 16 , b"z" * 64 )
+        cache.close()
+        # chop off the end of the file
+        # nb: this is what happens if the program dies while it's adding an image
+        fsize = os.path.getsize( self.fname )
+        with open( self.fname , "r+b" ) as fp :
+            fp.truncate( fsize - 10 )
+        cache = PixelCache( self.fname )
+        self.assertEqual( bytes( cache.get( card1 ).data ) , b"abcd" )
+        self.assertIsNone( cache.get( card2 ) )
+        cache.put( card2 , None , 1 , 1 , 4 , b"efgh" )
+        self.assertEqual( bytes( cache.get( card2 ).data ) , b"efgh" )
+        cache.close()
+        # check that a file that isn't a cache file gets replaced
+        with open( self.fname , "wb" ) as fp :
+            fp.write( b"not a cache file" )
+        cache = PixelCache( self.fname )
+        self.assertIsNone( cache.get( card1 ) )
+        cache.close()
+
+    def test_max_size( self ) :
+        """Test limiting the size of the cache file."""
+        cache = PixelCache( self.fname , max_bytes=200 )
+        self.assertTrue( cache.put( _make_card( 1 , 1 ) , None , 4 , 4 , 16 , b"a" * 64 ) )
+        self.assertFalse( cache.put( _make_card( 2 , 2 ) , None , 4 , 4 , 16 , b"b" * 64 ) )
+        cache.close()
+        # check that the cache starts again, if it's too big
+        cache = PixelCache( self.fname , max_bytes=100 )
+        self.assertIsNone( cache.get( _make_card( 1 , 1 ) ) )
+        cache.close()
+
+# ---------------------------------------------------------------------
+
+def _make_card( card_id , page_id , content_hash="abc" ) :
+    """Make a card (that has an image)."""
+    source_file = AslSourceFile( fname="test.pdf" , content_hash=content_hash , image_res=300 , image_encoding="png" )
+    return AslCard( card_id=card_id , page_id=page_id , page_pos=0 , source_file=source_file )
+
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__" :
+    unittest.main()
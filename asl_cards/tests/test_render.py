@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import types
+import unittest
+from unittest import mock
+
+from _test_case_base import TestCaseBase , base_dir
+from asl_cards import render
+from asl_cards.parse import _PngStreamSplitter , check_renderer
+from asl_cards.render import GhostscriptRenderer , SyntheticRenderer
+
+# ---------------------------------------------------------------------
+
+class TestRender( TestCaseBase ) :
+    """Test rendering PDF pages."""
+
+    def setUp( self ) :
+        # NOTE: We don't want these tests to depend on Ghostscript being installed, so we give the renderer
+        # a mock version of the ghostscript module.
+        self.gsp = _MockGhostscript()
+        pkg = types.ModuleType( "ghostscript" )
+        pkg._gsprint = self.gsp
+        patcher = mock.patch.dict( sys.modules , { "ghostscript": pkg , "ghostscript._gsprint": self.gsp } )
+        patcher.start()
+        self.addCleanup( patcher.stop )
+
+    def test_reuse( self ) :
+        """Test re-using Ghostscript to render multiple files."""
+        renderer = GhostscriptRenderer( 300 )
+        self.assertFalse( renderer.ping() )
+        pages = []
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 2 , pages.append )
+        renderer.render_pages( "/tmp/b (1).pdf" , 3 , 3 , pages.append )
+        self.assertTrue( renderer.ping() )
+        self.assertEqual( pages , [ b"/tmp/a.pdf:1" , b"/tmp/a.pdf:2" , b"/tmp/b (1).pdf:3" ] )
+        self.assertEqual( ( renderer.nstarts , self.gsp.ninstances ) , ( 1 , 1 ) )
+        self.assertIn( b"-r300" , self.gsp.args )
+        self.assertIn( b"--permit-file-read=/tmp/" , self.gsp.args )
+        self.assertIn( b"-sDEVICE=png16m" , self.gsp.args ) # nb: the default "standard" profile
+        self.assertFalse( [ a for a in self.gsp.args if a.startswith( ( b"-dTextAlphaBits" , b"-dNumRenderingThreads" ) ) ] )
+        # render a file from another directory
+        # nb: Ghostscript has to be restarted, so that it can read the file
+        renderer.render_pages( "/tmp/x/c.pdf" , 1 , 1 , pages.append )
+        self.assertEqual( renderer.nstarts , 2 )
+        self.assertIn( b"--permit-file-read=/tmp/x/" , self.gsp.args )
+        renderer.close()
+        self.assertEqual( self.gsp.ninstances , 0 )
+
+    def test_restart( self ) :
+        """Test restarting Ghostscript after something goes wrong."""
+        renderer = GhostscriptRenderer( 300 )
+        pages = []
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 1 , pages.append )
+        # make Ghostscript fail
+        self.gsp.fail = True
+        self.assertRaises( RuntimeError , renderer.render_pages , "/tmp/a.pdf" , 2 , 2 , pages.append )
+        self.assertEqual( self.gsp.ninstances , 0 )
+        self.gsp.fail = False
+        renderer.render_pages( "/tmp/a.pdf" , 2 , 2 , pages.append )
+        self.assertEqual( renderer.nstarts , 2 )
+        # make Ghostscript stop responding
+        self.gsp.hung = True
+        self.assertFalse( renderer.ping() )
+        renderer.render_pages( "/tmp/a.pdf" , 3 , 3 , pages.append )
+        self.assertEqual( renderer.nstarts , 3 )
+        self.assertEqual( pages , [ b"/tmp/a.pdf:1" , b"/tmp/a.pdf:2" , b"/tmp/a.pdf:3" ] )
+        # check that errors in the stdout handler are passed back to the caller
+        def on_page( page ) :
+            raise ValueError( "Can't handle the page." )
+        self.assertRaises( ValueError , renderer.render_pages , "/tmp/a.pdf" , 1 , 1 , on_page )
+        # check that the stdout handler can abort the job
+        self.assertRaises( RuntimeError , renderer.render_pages , "/tmp/a.pdf" , 1 , 2 , lambda page: False )
+        self.assertEqual( ( renderer.nstarts , self.gsp.ninstances ) , ( 4 , 0 ) )
+        renderer.close()
+
+    def test_warnings( self ) :
+        """Test rendering a file that makes Ghostscript print warnings."""
+        renderer = GhostscriptRenderer( 300 )
+        pages = []
+        # NOTE: Ghostscript prints warnings when it has to repair a damaged PDF, which must not end up
+        # in the stream of pages.
+        self.gsp.warning = b"   **** Error: xref table was damaged.\n   Output may be incorrect.\n"
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 2 , pages.append )
+        self.assertEqual( pages , [ b"/tmp/a.pdf:1" , b"/tmp/a.pdf:2" ] )
+        renderer.close()
+
+    def test_cancel( self ) :
+        """Test cancelling a job, when Ghostscript doesn't have gsapi_set_poll()."""
+        renderer = GhostscriptRenderer( 300 )
+        # nb: the stdout handler should check the poll handler, and abort the job
+        pages = []
+        self.assertRaises( RuntimeError , renderer.render_pages , "/tmp/a.pdf" , 1 , 2 , pages.append , poll=lambda: False )
+        self.assertEqual( pages , [] )
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 2 , pages.append , poll=lambda: True )
+        self.assertEqual( pages , [ b"/tmp/a.pdf:1" , b"/tmp/a.pdf:2" ] )
+        renderer.close()
+
+    def test_backends( self ) :
+        """Test choosing a render backend."""
+        # check the available backends
+        self.assertEqual( [ b[0] for b in render.get_backends() ] , [ "ghostscript" , "synthetic" ] )
+        self.assertIs( render.get_backend_class() , GhostscriptRenderer )
+        self.assertIs( render.get_backend_class( "synthetic" ) , SyntheticRenderer )
+        self.assertRaises( RuntimeError , render.get_backend_class , "unknown" )
+        # nb: the synthetic backend is never used by default
+        with mock.patch.object( GhostscriptRenderer , "is_available" , lambda: False ) :
+            self.assertEqual( [ b[0] for b in render.get_backends() ] , [ "synthetic" ] )
+            self.assertIs( render.get_backend_class() , GhostscriptRenderer )
+        # check that each process keeps one renderer
+        renderer = render.get_renderer( 300 )
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 1 , lambda page: None )
+        self.assertIs( render.get_renderer( 300 ) , renderer )
+        self.assertEqual( self.gsp.ninstances , 1 )
+        renderer2 = render.get_renderer( 300 , "synthetic" )
+        self.assertIsInstance( renderer2 , SyntheticRenderer )
+        self.assertEqual( self.gsp.ninstances , 0 )
+        render.close_renderer()
+        self.assertIsNot( render.get_renderer( 300 , "synthetic" ) , renderer2 )
+        render.close_renderer()
+
+    def test_profiles( self ) :
+        """Test rendering with different render profiles."""
+        self.assertEqual( [ p[0] for p in render.get_profiles() ] , [ "standard" , "fast-draft" , "balanced" , "archival" ] )
+        self.assertRaises( RuntimeError , render.get_profile , "unknown" )
+        # check that the profile's settings are passed to Ghostscript
+        renderer = render.get_renderer( 300 , profile="fast-draft" )
+        renderer.render_pages( "/tmp/a.pdf" , 1 , 1 , lambda page: None )
+        for arg in [ "-sDEVICE=png256" , "-dTextAlphaBits=1" , "-dGraphicsAlphaBits=1" , "-dNumRenderingThreads=4" , "-dBufferSpace=67108864" ] :
+            self.assertIn( arg.encode() , self.gsp.args )
+        # check that changing the profile gives us a new renderer
+        self.assertIs( render.get_renderer( 300 , profile="fast-draft" ) , renderer )
+        renderer2 = render.get_renderer( 300 , profile="archival" )
+        self.assertIsNot( renderer2 , renderer )
+        self.assertEqual( self.gsp.ninstances , 0 )
+        renderer2.render_pages( "/tmp/a.pdf" , 1 , 1 , lambda page: None )
+        self.assertIn( b"-dGraphicsAlphaBits=4" , self.gsp.args )
+        # nb: the archival profile leaves these at Ghostscript's defaults
+        self.assertFalse( [ a for a in self.gsp.args if a.startswith( ( b"-dNumRenderingThreads" , b"-dBufferSpace" ) ) ] )
+        render.close_renderer()
+
+# ---------------------------------------------------------------------
+
+@unittest.skipUnless( GhostscriptRenderer.is_available() , "Ghostscript is not installed." )
+class TestGhostscript( TestCaseBase ) :
+    """Test rendering PDF pages using the real Ghostscript."""
+
+    def test_page_ranges( self ) :
+        """Test rendering ranges of pages from several files, using the same Ghostscript instance."""
+        dname = os.path.join( base_dir , "synthetic-data" )
+        renderer = GhostscriptRenderer( 50 )
+        def render_pages( fname , first_page , last_page , **kwargs ) :
+            pages = []
+            renderer.render_pages( os.path.join( dname , fname ) , first_page , last_page , _PngStreamSplitter(pages.append).feed , **kwargs )
+            return len( pages )
+        # render some pages
+        # nb: this checks that Ghostscript accepts jobs after it has been started (with -dBATCH), and that
+        # each job only renders the pages it was asked for (whichever PDF interpreter Ghostscript is using)
+        self.assertEqual( render_pages( "3-cards.pdf" , 1 , 1 ) , 1 )
+        self.assertEqual( render_pages( "3-cards.pdf" , 2 , 2 ) , 1 )
+        self.assertEqual( render_pages( "1-card.pdf" , 1 , 1 ) , 1 )
+        self.assertEqual( render_pages( "3-cards.pdf" , 1 , 2 ) , 2 )
+        self.assertEqual( renderer.nstarts , 1 )
+        self.assertTrue( renderer.ping() )
+        # check that a job can be cancelled
+        self.assertRaises( Exception , render_pages , "3-cards.pdf" , 1 , 2 , poll=lambda: False )
+        self.assertEqual( render_pages( "2-cards.pdf" , 1 , 1 ) , 1 )
+        renderer.close()
+        # nb: the renderer benchmark also does this check, before it times Ghostscript
+        check_renderer( os.path.join( dname , "3-cards.pdf" ) , 50 , "ghostscript" )
+        render.close_renderer()
+
+# ---------------------------------------------------------------------
+
+class _MockGhostscript :
+    """Stand-in for ghostscript._gsprint.
+
+    "Rendering" a page writes its file name and page number to stdout.
+    """
+
+    libgs = object() # nb: no gsapi_set_poll()
+
+    def __init__( self ) :
+        self.ninstances = 0
+        self.args = None
+        self.fail = self.hung = False
+        self.warning = None # nb: set this to have the interpreter print a warning before the pages are rendered
+        self._stdout = self._stderr = None
+
+    def c_stdstream_call_t( self , func ) :
+        return func
+    def revision( self ) :
+        return types.SimpleNamespace( revision=1000 )
+    def new_instance( self ) :
+        self.ninstances += 1
+        self.hung = False
+        return object()
+    def delete_instance( self , inst ) :
+        self.ninstances -= 1
+    def set_stdio( self , inst , stdin , stdout , stderr ) :
+        self._stdout , self._stderr = stdout , stderr
+    def init_with_args( self , inst , args ) :
+        self.args = args
+    def exit( self , inst ) :
+        pass
+
+    def run_string( self , inst , cmd ) :
+        if self.hung :
+            raise RuntimeError( "Ghostscript error." )
+        if cmd == b"0 pop\n" :
+            return 0
+        if self.fail :
+            raise RuntimeError( "Ghostscript error." )
+        # parse the command
+        mo = re.search( r"/FirstPage (\d+) def /LastPage (\d+) def \((.*)\) \(r\) file runpdf" , cmd.decode() )
+        first_page , last_page = int( mo.group(1) ) , int( mo.group(2) )
+        fname = mo.group(3).replace( "\\" , "" )
+        if self.warning :
+            # nb: Ghostscript writes interpreter messages to stdout, unless it's been told otherwise
+            out = self._stderr if b"-sstdout=%stderr" in self.args else self._stdout
+            out( None , self.warning , len(self.warning) )
+        for page_no in range( first_page , last_page+1 ) :
+            buf = "{}:{}".format( fname , page_no ).encode()
+            if self._stdout( None , buf , len(buf) ) < 0 :
+                raise RuntimeError( "Ghostscript error." )
+        return 0
+
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__" :
+    unittest.main()
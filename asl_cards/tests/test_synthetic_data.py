@@ -3,11 +3,19 @@
 import sys
 import os
 import unittest
+import tempfile
+import shutil
+import hashlib
+import json
+import random
+from collections import namedtuple
+from unittest import mock
 
 from pdfminer.pdfparser import PDFSyntaxError
+from PyQt5.QtWidgets import QMessageBox
 
-from _test_case_base import TestCaseBase
-from asl_cards.parse import AslCard
+from _test_case_base import TestCaseBase , base_dir
+from asl_cards.parse import PdfParser , AslCard , CARD_HEADER_REGIONS , _find_info_boxes
 
 # ---------------------------------------------------------------------
 
@@ -18,9 +26,9 @@ class TestSyntheticData( TestCaseBase ) :
     so we can't keep them in source control.
     """
 
-    def _test_pdf_parser( self , fname , expected_cards ) :
+    def _test_pdf_parser( self , fname , expected_cards , layout_cache_dir=None ) :
         """Test the PDF parser."""
-        super()._test_pdf_parser( os.path.join("synthetic-data",fname) , expected_cards )
+        super()._test_pdf_parser( os.path.join("synthetic-data",fname) , expected_cards , layout_cache_dir=layout_cache_dir )
 
     def test_null_file( self ) :
         # try parsing a zero-byte file
@@ -61,6 +69,150 @@ class TestSyntheticData( TestCaseBase ) :
             AslCard( page_id=1 , page_pos=1 , card_tag="Vehicle #2" , nationality="Moldovia" , name="" ) ,
         ] )
 
+    def test_parallel_parse( self ) :
+        # parse a directory of files in a pool of worker processes
+        with tempfile.TemporaryDirectory() as dname :
+            for fname in [ "1-card.pdf" , "2-cards.pdf" , "3-cards.pdf" ] :
+                shutil.copy( os.path.join( base_dir , "synthetic-data" , fname ) , dname )
+            fnames = [ os.path.join( dname , f ) for f in os.listdir( dname ) ]
+            completed = []
+            pdf_parser = PdfParser( None , on_file_completed=lambda fname,cards: completed.append( fname ) )
+            cards = pdf_parser.parse( dname , image_res=None , workers=3 )
+            cards2 = PdfParser( None ).parse( dname , image_res=None , workers=1 )
+        # check the results (the files must be reported in the same order as for a serial parse)
+        self.assertEqual( completed , fnames )
+        self.assertEqual( [ str(c) for c in cards ] , [ str(c) for c in cards2 ] )
+        self.assertEqual( len(cards) , 6 )
+
+    def test_parallel_pages( self ) :
+        # parse the pages of a file in a pool of worker processes
+        fname = os.path.join( base_dir , "synthetic-data" , "3-cards.pdf" )
+        with tempfile.TemporaryDirectory() as dname :
+            cards = PdfParser( None , layout_cache_dir=dname ).parse( fname , image_res=None , workers=2 , shard_pages=1 )
+            cards2 = PdfParser( None ).parse( fname , image_res=None , workers=1 )
+            self.assertEqual( [ str(c) for c in cards ] , [ str(c) for c in cards2 ] )
+            self.assertEqual( [ (c.page_id,c.page_pos) for c in cards ] , [ (1,0) , (1,1) , (2,0) ] )
+            # parse the file again (this time, the pages should come from the cache)
+            self.assertEqual( len( os.listdir( dname ) ) , 1 )
+            with mock.patch.object( PdfParser , "_parse_page" , side_effect=RuntimeError("Cache miss.") ) :
+                cards3 = PdfParser( None , layout_cache_dir=dname ).parse( fname , image_res=None , workers=2 , shard_pages=1 )
+            self.assertEqual( [ str(c) for c in cards3 ] , [ str(c) for c in cards2 ] )
+
+    def test_layout_regions( self ) :
+        # parse the files, only analyzing the layout of the card info boxes
+        # nb: we should get the same cards as when the whole page is analyzed
+        for fname in [ "1-card.pdf" , "2-cards.pdf" , "3-cards.pdf" , "bad-spacing.pdf" , "empty.pdf" ] :
+            fname = os.path.join( base_dir , "synthetic-data" , fname )
+            cards = PdfParser( None , layout_regions=CARD_HEADER_REGIONS ).parse( fname , image_res=None )
+            cards2 = PdfParser( None ).parse( fname , image_res=None )
+            self.assertEqual( [ str(c) for c in cards ] , [ str(c) for c in cards2 ] )
+        # check that the text outside the regions was ignored
+        text_boxes = []
+        def find_info_boxes( items ) :
+            text_boxes.extend( i.get_text().strip() for i in items )
+            return _find_info_boxes( items )
+        with mock.patch( "asl_cards.parse._find_info_boxes" , find_info_boxes ) :
+            PdfParser( None , layout_regions=CARD_HEADER_REGIONS ).parse( os.path.join( base_dir , "synthetic-data" , "bad-spacing.pdf" ) , image_res=None )
+        self.assertEqual( [ t for t in text_boxes if not t.startswith("[") ] , [ "Vehicle #1" , "Vehicle #2" , "Moldovia" ] )
+        # check that the layout cache knows which parts of the page were analyzed
+        fname = os.path.join( base_dir , "synthetic-data" , "1-card.pdf" )
+        with tempfile.TemporaryDirectory() as dname :
+            PdfParser( None , layout_cache_dir=dname , layout_regions=CARD_HEADER_REGIONS ).parse( fname , image_res=None )
+            PdfParser( None , layout_cache_dir=dname ).parse( fname , image_res=None )
+            self.assertEqual( len( os.listdir( dname ) ) , 2 )
+
+    def test_cached_files( self ) :
+        # parse a directory of files, where we already have the cards for some of them
+        dname = os.path.join( base_dir , "synthetic-data" )
+        source_files = {}
+        def is_cached( source_file ) :
+            source_files[ os.path.split(source_file.fname)[1] ] = source_file
+            return source_file.fname.endswith( ( "1-card.pdf" , "null.pdf" ) )
+        cards = PdfParser( None , is_cached=is_cached ).parse( dname , image_res=None )
+        # check the results
+        self.assertEqual( len(cards) , 2+3+2 )
+        self.assertTrue( all( c.source_file.fname.endswith( ("2-cards.pdf","3-cards.pdf","bad-spacing.pdf") ) for c in cards ) )
+        source_file = source_files[ "1-card.pdf" ]
+        with open( os.path.join( dname , "1-card.pdf" ) , "rb" ) as fp :
+            self.assertEqual( source_file.content_hash , hashlib.sha1( fp.read() ).hexdigest() )
+        self.assertIsNone( source_file.index_hash )
+        self.assertIsNone( source_file.image_res )
+        # check that the user is only asked about the files we don't already have the cards for
+        # nb: this has to work the same way when the files are parsed in worker processes
+        for workers in (1,2) :
+            asked = []
+            def on_ask( msg , btns , default ) :
+                asked.append( msg.split( "\n" )[0] )
+                return QMessageBox.No
+            cards = PdfParser( None , is_cached=is_cached , on_ask=on_ask ).parse( dname , image_res=None , workers=workers )
+            self.assertEqual( cards , [] )
+            self.assertEqual( sorted( asked ) , [
+                "Can't find an index file for {}.".format( f ) for f in [ "2-cards.pdf" , "3-cards.pdf" , "bad-spacing.pdf" , "empty.pdf" ]
+            ] )
+
+    def test_bad_card_tag( self ) :
+        # parse a directory of files, where one of them has a card with a bad tag
+        # nb: the file should be reported, and the other files still parsed
+        from asl_cards import db
+        classify_card_tag = db.classify_card_tag
+        def bad_tags( card_tag ) :
+            if card_tag.startswith( "Ordnance" ) :
+                raise RuntimeError( "Invalid card tag: {}".format( card_tag ) )
+            return classify_card_tag( card_tag )
+        dname = os.path.join( base_dir , "synthetic-data" )
+        for workers in (1,2) :
+            errors = []
+            with mock.patch( "asl_cards.db.classify_card_tag" , bad_tags ) :
+                cards = PdfParser( None , on_error=errors.append ).parse( dname , image_res=None , workers=workers )
+            self.assertEqual( len(cards) , 1+2+2 )
+            self.assertFalse( any( c.source_file.fname.endswith( "3-cards.pdf" ) for c in cards ) )
+            self.assertEqual( len( [ e for e in errors if "3-cards.pdf" in e and "Ordnance #1" in e ] ) , 1 )
+            self.assertEqual( [ c.tag_type for c in cards ] , [ db.TAGTYPE_VEHICLE ] * 5 )
+
+    def test_layout_cache( self ) :
+        # parse a file, caching the results
+        expected_cards = [
+            AslCard( page_id=1 , page_pos=0 , card_tag="Vehicle #1" , nationality="Moldovia" , name="Big Tank" ) ,
+            AslCard( page_id=1 , page_pos=1 , card_tag="Vehicle #2" , nationality="Moldovia" , name="Little Tank" ) ,
+            AslCard( page_id=2 , page_pos=0 , card_tag="Ordnance #1" , nationality="Moldovia" , name="Big Gun" ) ,
+        ]
+        with tempfile.TemporaryDirectory() as dname :
+            self._test_pdf_parser( "3-cards.pdf" , expected_cards , layout_cache_dir=dname )
+            self.assertEqual( len( os.listdir( dname ) ) , 1 )
+            # parse the file again (this time, the pages should come from the cache)
+            with mock.patch.object( PdfParser , "_parse_page" , side_effect=RuntimeError("Cache miss.") ) :
+                self._test_pdf_parser( "3-cards.pdf" , expected_cards , layout_cache_dir=dname )
+            # remove one of the pages from the cache, and parse the file again
+            fname = os.path.join( dname , os.listdir(dname)[0] )
+            with open( fname , "r" ) as fp :
+                pages = json.load( fp )
+            del pages[ "0" ]
+            with open( fname , "w" ) as fp :
+                json.dump( pages , fp )
+            self._test_pdf_parser( "3-cards.pdf" , expected_cards , layout_cache_dir=dname )
+
+    def test_info_boxes( self ) :
+        # generate a page with lots of text boxes
+        TextBox = namedtuple( "TextBox" , "text x0 y0 x1 y1" )
+        TextBox.get_text = lambda self: self.text
+        rand = random.Random( 42 )
+        text_boxes = []
+        for i in range(0,500) :
+            x0 , y0 = rand.uniform(0,600) , rand.uniform(0,800)
+            text = rand.choice( [ "Vehicle #{}".format(i) , "Ordnance #{}".format(i) , "Moldovia" , "Big Tank" , "blah" , "blah" ] )
+            text_boxes.append( TextBox( text , x0 , y0 , x0+rand.uniform(5,150) , y0+rand.uniform(5,40) ) )
+        # find the info boxes
+        info_boxes = _find_info_boxes( text_boxes )
+        # compare the results with checking every text box against every info box
+        expected = [ [item] for item in text_boxes if item.text.startswith( ("Vehicle","Ordnance") ) ]
+        for item in text_boxes :
+            for info_box in expected :
+                if item.x0 >= info_box[0].x0 - 50 and item.x1 <= info_box[0].x1 + 50 \
+                    and item.y1 < info_box[0].y1 and info_box[0].y0 - item.y1 < 50 :
+                    info_box.append( item )
+        self.assertEqual( info_boxes , expected )
+        self.assertTrue( any( len(ib) > 2 for ib in info_boxes ) )
+
 # ---------------------------------------------------------------------
 
 if __name__ == "__main__" :
@@ -8,3 +8,10 @@ APP_DESCRIPTION = "ASL Cards viewer."
 MAINWINDOW_GEOMETRY = "MainWindow/geometry"
 #
 CONFIRM_EXIT = "Settings/ConfirmExit"
+ANALYZE_WORKERS = "Settings/AnalyzeWorkers"
+WARM_CARD_IMAGES = "Settings/WarmCardImages"
+PIXEL_CACHE = "Settings/PixelCache"
+IMAGE_PACK = "Settings/ImagePack"
+IMAGE_ENCODING = "Settings/ImageEncoding"
+RENDER_PROFILE = "Settings/RenderProfile"
+ANALYZE_HEADER_REGIONS = "Settings/AnalyzeHeaderRegions"
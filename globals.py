@@ -6,5 +6,5 @@ app_name = None
 app_settings = None
 debug_settings = None
 
-# AslCard table
-card = {} # { nationality: { tag-type: [ AslCard's ] } }
+# decoded card images (see asl_cards.pixel_cache)
+pixel_cache = None
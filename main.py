@@ -3,6 +3,7 @@
 import sys
 import os
 import getopt
+import multiprocessing
 
 from PyQt5.QtCore import QSettings , QDir
 from PyQt5.QtWidgets import QApplication
@@ -81,4 +82,5 @@ def print_help() :
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 if __name__ == "__main__" :
+    multiprocessing.freeze_support() # nb: needed for the analysis worker processes in a frozen app
     sys.exit( do_main( sys.argv ) )
@@ -1,13 +1,17 @@
 import sys
 import os
 
-from PyQt5.QtCore import Qt , QPoint , QSize
+from collections import defaultdict
+
+from PyQt5.QtCore import Qt , QPoint , QPointF , QSize , QThread , pyqtSignal
 from PyQt5.QtWidgets import QApplication , QMainWindow , QVBoxLayout , QHBoxLayout , QWidget , QTabWidget , QLabel , QMenu
 from PyQt5.QtWidgets import QMessageBox , QAction
-from PyQt5.QtGui import QPainter , QPixmap , QIcon , QBrush
+from PyQt5.QtGui import QPainter , QPixmap , QImage , QIcon , QBrush
 
 import asl_cards.db as db
 from asl_cards import natinfo
+from asl_cards.pixel_cache import PixelCache , get_cache_fname
+from asl_cards.parse import extract_card_images
 from constants import *
 import globals
 from add_card_widget import AddCardWidget
@@ -16,6 +20,94 @@ from about_widget import AboutWidget
 
 # ---------------------------------------------------------------------
 
+def check_card_image( card ) :
+    """Make sure the image for an ASL Card is available (extracting it from its PDF, if necessary)."""
+    # nb: a card's image hash is only set once its image has been extracted (so we don't have to load the image to check)
+    if not card.image_hash :
+        # the card image hasn't been extracted yet - do it now
+        source_file = card.source_file
+        if not source_file or not source_file.image_res :
+            raise RuntimeError( "There is no image for this card." )
+        card_images = extract_card_images( source_file.fname , source_file.image_res , card.page_id ,
+            source_file.image_encoding , source_file.render_backend , source_file.render_profile
+        )
+        if card.page_pos >= len(card_images) :
+            raise RuntimeError( "Can't find the image for this card in {}.".format(
+                os.path.split( source_file.fname )[1]
+            ) )
+        db.save_card_image( card , card_images[ card.page_pos ] )
+
+def load_card_image( card , width=None , height=None ) :
+    """Get the image data for an ASL Card (extracting it from its PDF, if necessary).
+
+    If a size is given, the smallest pre-scaled image that can be shown at that size is returned.
+    """
+    check_card_image( card )
+    level = card.find_image_level( width , height ) if width and height else None
+    for _,image_data in db.load_card_images( [ card.card_id ] , level.width if level else None ) :
+        return image_data
+    raise RuntimeError( "Can't find the image for this card." )
+
+def load_card_qimage( card , width , height ) :
+    """Get the smallest image for an ASL Card that can be shown at the specified size."""
+    level = card.find_image_level( width , height )
+    level_width = level.width if level else None
+    # check if we have the decoded image in the pixel cache
+    pixel_cache = globals.pixel_cache
+    if pixel_cache :
+        pixels = pixel_cache.get( card , level_width )
+        if pixels :
+            # NOTE: The QImage uses the pixels where they are (in the mapped cache file), and keeps
+            # a reference to them, so there's nothing to decode or copy.
+            return QImage( pixels.data , pixels.width , pixels.height , pixels.stride , QImage.Format_RGBX8888 )
+    # nope - decode the image, and add it to the cache
+    img = QImage.fromData( load_card_image( card , width , height ) )
+    if pixel_cache and not img.isNull() :
+        img = img.convertToFormat( QImage.Format_RGBX8888 )
+        bits = img.constBits()
+        bits.setsize( img.byteCount() ) # nb: sizeInBytes() needs Qt 5.10
+        pixel_cache.put( card , level_width , img.width() , img.height() , img.bytesPerLine() , bits.asstring() )
+    return img
+
+# ---------------------------------------------------------------------
+
+class WarmCardImagesThread( QThread ) :
+    """Extract card images in the background (for databases that were built without them)."""
+
+    # define our signals
+    image_signal = pyqtSignal( int , object , name="image" )
+
+    def __init__( self , cards ) :
+        # initialize
+        # NOTE: We can only access the database from the GUI thread, so we take a copy of what we need here,
+        # and send the extracted images back to the GUI thread to be saved.
+        super().__init__()
+        self.pages = defaultdict( list )
+        for card in cards :
+            source_file = card.source_file
+            if not source_file or not source_file.image_res :
+                continue
+            key = ( source_file.fname , source_file.image_res , source_file.image_encoding , source_file.render_backend , source_file.render_profile , card.page_id )
+            self.pages[ key ].append( ( card.page_pos , card.card_id ) )
+        self.stopping = False
+
+    def run( self ) :
+        """Run the worker thread."""
+        # extract the images for each page
+        for (fname,image_res,image_encoding,render_backend,render_profile,page_id),page_cards in self.pages.items() :
+            if self.stopping :
+                break
+            try :
+                card_images = extract_card_images( fname , image_res , page_id , image_encoding , render_backend , render_profile )
+            except Exception :
+                # nb: the user will get an error message if they try to view one of these cards
+                continue
+            for page_pos,card_id in page_cards :
+                if page_pos < len(card_images) :
+                    self.image_signal.emit( card_id , card_images[page_pos] )
+
+# ---------------------------------------------------------------------
+
 class AslCardWidget( QWidget ) :
     """Simple widget that displays the image for an ASL Card."""
 
@@ -23,24 +115,70 @@ class AslCardWidget( QWidget ) :
         # initialize
         super().__init__()
         self.card = card
-        self.pixmap = QPixmap()
-        self.pixmap.loadFromData( card.card_image.image_data )
+        self.image = None
+        self.image_level = None # nb: the image level the image was loaded from
+        self.scaled_pixmap = None
+        self.scaled_pixmap_key = None
+        self.error_msg = None # nb: shown instead of the card image, if we couldn't get it
+        try :
+            # NOTE: We don't know how big we're going to be yet, so we just make sure the card image is available.
+            check_card_image( card )
+        except Exception as ex :
+            self.error_msg = "Can't show the card image:\n\n{}".format( ex )
+            MainWindow.show_error_msg( self.error_msg )
 
     def paintEvent( self , evt ) :
         qp = QPainter()
         qp.begin( self )
-        qp_size = evt.rect().size()
+        qp_size = self.size()
+        # get the AslCard image
+        # NOTE: We work in device pixels, so that the image is sharp on high-DPI screens.
+        dpr = self.devicePixelRatioF()
+        width , height = int( qp_size.width() * dpr ) , int( qp_size.height() * dpr )
+        key = ( width , height )
+        if key != self.scaled_pixmap_key and not self.error_msg :
+            try :
+                image = self._get_image( width , height )
+                if image.isNull() :
+                    raise RuntimeError( "The card image is not valid." )
+            except Exception as ex :
+                # NOTE: Exceptions can't be allowed to escape from a paint handler (e.g. if the card image couldn't
+                # be extracted because its PDF is missing), so we show the error instead of the card image.
+                self.error_msg = "Can't show the card image:\n\n{}".format( ex )
+        if self.error_msg :
+            qp.drawText( self.rect() , Qt.AlignCenter | Qt.TextWordWrap , self.error_msg )
+            qp.end()
+            return
+        if key != self.scaled_pixmap_key :
+            image_size = image.size()
+            image_size.scale( width , height , Qt.KeepAspectRatio )
+            self.scaled_pixmap = QPixmap.fromImage(
+                image.scaled( image_size , Qt.KeepAspectRatio , Qt.SmoothTransformation )
+            )
+            self.scaled_pixmap.setDevicePixelRatio( dpr )
+            self.scaled_pixmap_key = key
         # draw the AslCard image
         qp.setRenderHint( QPainter.Antialiasing )
-        pixmap_size = self.pixmap.size()
-        pixmap_size.scale( qp_size , Qt.KeepAspectRatio )
-        pixmap = self.pixmap.scaled( pixmap_size , Qt.KeepAspectRatio , Qt.SmoothTransformation )
         qp.drawPixmap(
-            (qp_size.width()-pixmap_size.width())/2 , (qp_size.height()-pixmap_size.height())/2 ,
-            pixmap
+            QPointF(
+                ( qp_size.width() - self.scaled_pixmap.width()/dpr ) / 2 ,
+                ( qp_size.height() - self.scaled_pixmap.height()/dpr ) / 2
+            ) ,
+            self.scaled_pixmap
         )
         qp.end()
 
+    def _get_image( self , width , height ) :
+        """Get the smallest card image that can be shown at the specified size."""
+        # check if we need to load a different image level
+        # NOTE: We only keep the one image, so that tabs that have been made smaller don't hang on to large images.
+        level = self.card.find_image_level( width , height )
+        level_width = level.width if level else None
+        if self.image is None or level_width != self.image_level :
+            self.image = load_card_qimage( self.card , width , height )
+            self.image_level = level_width
+        return self.image
+
 # ---------------------------------------------------------------------
 
 class MainWindow( QMainWindow ) :
@@ -87,6 +225,7 @@ class MainWindow( QMainWindow ) :
             self.resize( 1 , 1 ) # nb: the layout manager will set the correct size
         # show the startup form
         self.tab_widget = None
+        self.warm_images_thread = None
         self.setCentralWidget(
             StartupWidget( db_fname , parent=self )
         )
@@ -135,7 +274,19 @@ class MainWindow( QMainWindow ) :
         self.setCentralWidget( self.tab_widget )
         # open the database
         db.open_database( db_fname , False )
-        globals.cards = db.load_cards()
+        if globals.app_settings.value( PIXEL_CACHE , True , type=bool ) :
+            try :
+                globals.pixel_cache = PixelCache( get_cache_fname( db_fname ) )
+            except Exception :
+                pass # nb: the cache is optional (e.g. the database might be somewhere we can't write to)
+        # check if there are card images that haven't been extracted yet
+        if globals.app_settings.value( WARM_CARD_IMAGES , True , type=bool ) :
+            cards = db.find_cards_without_images()
+            if cards :
+                # yup - extract them in the background
+                self.warm_images_thread = WarmCardImagesThread( cards )
+                self.warm_images_thread.image_signal.connect( self.on_card_image_extracted )
+                self.warm_images_thread.start()
         # show the View menu
         self.view_menu = QMenu( "&View" )
         self.menuBar().insertMenu( self.help_menu.menuAction() , self.view_menu )
@@ -144,6 +295,12 @@ class MainWindow( QMainWindow ) :
         self.add_card_action.setEnabled( True )
         self.on_add_card()
 
+    def on_card_image_extracted( self , card_id , image_levels ) :
+        """Save a card image that was extracted in the background."""
+        card = db.db_session.query( db.AslCard ).get( card_id )
+        if card :
+            db.save_card_image( card , image_levels )
+
     @staticmethod
     def show_info_msg( msg ) :
         """Show an informational message."""
@@ -193,6 +350,12 @@ class MainWindow( QMainWindow ) :
                 )
                 if rc != QMessageBox.Ok :
                     evt.ignore()
+                    return
+        # stop extracting card images in the background
+        if self.warm_images_thread :
+            self.warm_images_thread.stopping = True
+            self.warm_images_thread.wait()
+            self.warm_images_thread = None
         # save the window settings
         globals.app_settings.setValue( MAINWINDOW_GEOMETRY , self.saveGeometry() )
 
@@ -1,11 +1,14 @@
 import os
 
 from PyQt5 import uic
-from PyQt5.QtCore import Qt , QMetaObject , QThread , pyqtSignal , pyqtSlot , Q_ARG , Q_RETURN_ARG
+from PyQt5.QtCore import Qt , QMetaObject , QThread , QStandardPaths , pyqtSignal , pyqtSlot , Q_ARG , Q_RETURN_ARG
 from PyQt5.QtWidgets import QWidget , QFrame , QFileDialog , QMessageBox
 from PyQt5.QtGui import QPixmap , QIcon , QMovie
 
-from asl_cards.parse import PdfParser
+from asl_cards.parse import PdfParser , find_pdf_files , CARD_HEADER_REGIONS
+from asl_cards import imaging
+from asl_cards import render
+from asl_cards.image_pack import get_pack_fname
 import asl_cards.db as db
 
 from constants import *
@@ -20,28 +23,51 @@ class AnalyzeThread( QThread ) :
     progress2_signal = pyqtSignal( float , name="progress2" )
     completed_signal = pyqtSignal( str , name="completed" )
 
-    def __init__( self , cards_dir , image_res , db_fname ) :
+    def __init__( self , cards_dir , image_res , db_fname , workers=1 , lazy_images=False , image_encoding=None , render_profile=None , use_image_pack=False , header_regions=False ) :
         # initialize
         super().__init__()
         self.cards_dir = cards_dir
         self.image_res = image_res
         self.db_fname = db_fname
+        self.workers = workers
+        self.lazy_images = lazy_images
+        self.image_encoding = image_encoding
+        self.render_profile = render_profile
+        self.use_image_pack = use_image_pack
+        self.header_regions = header_regions
+        self.encoding_report = None
 
     def run( self ) :
         """Run the worker thread."""
+        total_cards = 0
         try :
             # initialize
+            # NOTE: If the database already exists, we keep the cards for files that haven't changed
+            # since it was built, and only analyze new or changed files.
             if os.path.isfile( self.db_fname ) :
-                os.unlink( self.db_fname )
-            db.open_database( self.db_fname , True )
+                db.open_database( self.db_fname , False , use_image_pack=self.use_image_pack )
+                if not db.has_build_cache() :
+                    db.close_database()
+                    os.unlink( self.db_fname )
+            if not os.path.isfile( self.db_fname ) :
+                db.open_database( self.db_fname , True , use_image_pack=self.use_image_pack )
             # parse the files
-            total_cards = 0
+            # NOTE: We keep the cards for every file that's still there, even if it doesn't get parsed
+            # (e.g. because the user decided not to parse a file that doesn't have an index file).
+            # nb: source files are recorded using their absolute path (see PdfParser._make_source_file())
+            fnames = set( os.path.abspath( f ) for f in find_pdf_files( self.cards_dir ) )
+            def is_cached( source_file ) :
+                # check if we already have the cards for this file
+                source_file2 = db.find_source_file( source_file.fname )
+                if not source_file2 or not source_file2.matches( source_file ) :
+                    return False
+                nonlocal total_cards
+                total_cards += len( source_file2.cards )
+                return True
             def on_file_completed( fname , cards ) :
-                # save the extracted cards
-                db.add_cards( cards )
+                # the cards for this file have all been saved
                 nonlocal total_cards
-                total_cards += len(cards)
-                del cards[:]
+                total_cards += db.complete_source_file( fname )
             self.parser = PdfParser(
                 os.path.join( globals.base_dir , "index" ) ,
                 progress = lambda pval,msg: self.progress_signal.emit( -1 if pval is None else pval , msg ) ,
@@ -49,9 +75,31 @@ class AnalyzeThread( QThread ) :
                 on_file_completed = on_file_completed ,
                 on_ask = self.on_ask ,
                 on_error = self.on_error ,
+                is_cached = is_cached ,
+                load_checkpoint = db.load_checkpoint ,
+                save_checkpoint = db.save_checkpoint ,
+                layout_cache_dir = os.path.join(
+                    QStandardPaths.writableLocation( QStandardPaths.CacheLocation ) , "layout-cache"
+                ) ,
+                render_profile = self.render_profile ,
+                layout_regions = CARD_HEADER_REGIONS if self.header_regions else None
+            )
+            # NOTE: We save each card as soon as it has been extracted, so that we don't have to hold
+            # all the card images in memory.
+            cards = self.parser.iter_cards( self.cards_dir ,
+                image_res = self.image_res ,
+                workers = self.workers ,
+                lazy_images = self.lazy_images ,
+                image_encoding = self.image_encoding
             )
-            cards = self.parser.parse( self.cards_dir , image_res=self.image_res )
-            assert len(cards) == 0 # nb: on_file_completed() del'ed everything
+            with db.build_mode() :
+                for card in cards :
+                    db.add_card( card )
+                if self.parser.encoding_report :
+                    self.encoding_report = self.parser.encoding_report.format( self.image_encoding )
+                # remove the cards for files that are no longer there
+                db.purge_source_files( fnames )
+                db.clear_checkpoints()
             if total_cards <= 0 :
                 raise RuntimeError( "No cards were found." )
         except Exception as ex :
@@ -64,11 +112,24 @@ class AnalyzeThread( QThread ) :
             # notify slots that we've finished
             self.completed_signal.emit( "" )
         finally :
-            db.close_database()
-            if total_cards <= 0 :
+            # NOTE: If the analysis was cancelled or failed, we keep the database, since it has the cards
+            # for the files that were completed, and the card images for any partially-completed files
+            # (so that the next analysis can pick up where this one left off).
+            keep_db = total_cards > 0
+            if db.db_session is not None :
+                try :
+                    # nb: we might have got here because something failed part-way through a transaction
+                    db.db_session.rollback()
+                    keep_db = keep_db or db.has_checkpoints()
+                except Exception :
+                    pass # nb: if the database is broken, we just go with what we know
+                db.close_database()
+            if not keep_db and os.path.isfile( self.db_fname ) :
                 # NOTE: If we extracted nothing (e.g. because Ghostscript isn't installed), we delete the database
                 # so that we don't start up next time with an empty database.
                 os.unlink( self.db_fname )
+                if os.path.isfile( get_pack_fname( self.db_fname ) ) :
+                    os.unlink( get_pack_fname( self.db_fname ) )
 
     def on_error( self , msg ) :
         """Show the user an error message."""
@@ -156,6 +217,14 @@ class StartupWidget( QWidget ) :
         self.cbo_resolution.addItem( "300 dpi" )
         self.cbo_resolution.addItem( "600 dpi" )
         self.cbo_resolution.setCurrentIndex( 1 )
+        for key,caption in render.get_profiles() :
+            self.cbo_profile.addItem( caption , key )
+        index = self.cbo_profile.findData( globals.app_settings.value( RENDER_PROFILE , render.DEFAULT_PROFILE ) )
+        self.cbo_profile.setCurrentIndex( max( index , 0 ) )
+        for key,caption in imaging.get_encodings() :
+            self.cbo_encoding.addItem( caption , key )
+        index = self.cbo_encoding.findData( globals.app_settings.value( IMAGE_ENCODING , imaging.DEFAULT_ENCODING ) )
+        self.cbo_encoding.setCurrentIndex( max( index , 0 ) )
         if os.path.isfile( db_fname ) :
             self.le_load_db_fname.setText( db_fname )
         else :
@@ -208,6 +277,11 @@ class StartupWidget( QWidget ) :
             return
         # unload other settings
         image_res = int( self.cbo_resolution.currentText().split()[ 0 ] )
+        workers = globals.app_settings.value( ANALYZE_WORKERS , os.cpu_count() or 1 , type=int )
+        image_encoding = self.cbo_encoding.currentData()
+        globals.app_settings.setValue( IMAGE_ENCODING , image_encoding )
+        render_profile = self.cbo_profile.currentData()
+        globals.app_settings.setValue( RENDER_PROFILE , render_profile )
         # run the analysis (in a worker thread)
         self.frm_open_db.hide()
         self.frm_analyze_progress.show()
@@ -215,7 +289,14 @@ class StartupWidget( QWidget ) :
         self._update_analyze_ui( False )
         self.btn_cancel_analyze.setEnabled( True )
         self.btn_cancel_analyze.clicked.connect( self.on_cancel_analyze )
-        self.analyze_thread = AnalyzeThread( cards_dir , image_res , fname )
+        self.analyze_thread = AnalyzeThread( cards_dir , image_res , fname ,
+            workers = max( workers , 1 ) ,
+            lazy_images = self.cb_lazy_images.isChecked() ,
+            image_encoding = image_encoding ,
+            render_profile = render_profile ,
+            use_image_pack = globals.app_settings.value( IMAGE_PACK , False , type=bool ) ,
+            header_regions = globals.app_settings.value( ANALYZE_HEADER_REGIONS , False , type=bool )
+        )
         self.analyze_thread.progress_signal.connect( self.on_analyze_progress )
         self.analyze_thread.progress2_signal.connect( self.on_analyze_progress2 )
         self.analyze_thread.completed_signal.connect( self.on_analyze_completed )
@@ -260,6 +341,7 @@ class StartupWidget( QWidget ) :
 
     def on_analyze_completed( self , ex ) :
         # clean up
+        encoding_report = self.analyze_thread.encoding_report
         self.analyze_thread = None
         self.progress_animation.stop()
         # check if the analysis failed
@@ -272,13 +354,17 @@ class StartupWidget( QWidget ) :
         # the analysis completed successully - start the main app
         self.pb_files.setValue( 100 )
         self.pb_pages.setValue( 100 )
-        MainWindow.show_info_msg( "The \"ASL Cards\" files were analyzed successully." )
+        msg = "The \"ASL Cards\" files were analyzed successully."
+        if encoding_report :
+            msg += "\n\n" + encoding_report
+        MainWindow.show_info_msg( msg )
         self.parent().start_main_app( self.le_save_db_fname.text().strip() )
 
     def _update_analyze_ui( self , enable ) :
         # update the UI
         widgets = [ self.lbl_cards_dir , self.le_cards_dir, self.btn_cards_dir ]
-        widgets.extend( [ self.lbl_resolution , self.cbo_resolution , self.lbl_resolution_hint ] )
+        widgets.extend( [ self.lbl_resolution , self.cbo_resolution , self.lbl_resolution_hint , self.lbl_profile , self.cbo_profile ] )
+        widgets.extend( [ self.lbl_encoding , self.cbo_encoding , self.cb_lazy_images ] )
         widgets.extend( [ self.lbl_save_db_fname , self.le_save_db_fname , self.btn_save_db_fname ] )
         widgets.append( self.btn_analyze )
         for w in widgets :